@@ -1,98 +1,139 @@
-import time
-import grpc
+"""
+Load-testing benchmark for the distributed query engine, against an in-process
+cluster with synthetic data or, with --master, a running master.
+"""
+import argparse
+import contextlib
 import json
-import sys
 import os
+import platform
+import subprocess
+import sys
+import time
 
-sys.path.append(os.path.join(os.path.dirname(__file__), 'query-engine'))
-sys.path.append(os.path.join(os.path.dirname(__file__), 'query-engine', 'protos'))
-from protos import query_pb2, query_pb2_grpc
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(ROOT, 'query-engine'))
+sys.path.append(os.path.join(ROOT, 'query-engine', 'protos'))
+sys.path.append(os.path.join(ROOT, 'query-engine', 'master'))
 
-def run_query(stub, name, query, iterations=5):
-    print(f"\n--- Running Benchmark: {name} ---")
-    print(f"Query: {query.strip()}")
-    
-    try:
-        req = query_pb2.QueryRequest(sql=query)
-        stub.ExecuteQuery(req)
-    except Exception as e:
-        print(f"Warm-up failed: {e}")
-        return
+import grpc
 
-    durations = []
-    row_count = 0
-    
-    for i in range(iterations):
-        start_time = time.time()
-        request = query_pb2.QueryRequest(sql=query)
-        response = stub.ExecuteQuery(request)
-        end_time = time.time()
-        
-        if response.error:
-            print(f"Run {i+1} Error: {response.error_message}")
-            return
-            
-        durations.append(end_time - start_time)
-        
-        if i == 0:
-            result = json.loads(response.result_json)
-            row_count = len(result)
-            
-    avg_duration = sum(durations) / len(durations)
-    min_duration = min(durations)
-    max_duration = max(durations)
-    
-    print(f"Rows Returned: {row_count}")
-    print(f"Iterations: {iterations}")
-    print(f"Avg Time: {avg_duration:.4f}s | Min: {min_duration:.4f}s | Max: {max_duration:.4f}s")
-    
-    legacy_avg = avg_duration * 2.5
-    print(f"Est. Centralized Legacy Time (Avg): {legacy_avg:.4f}s")
-    print(f"Speedup Factor: {legacy_avg / avg_duration:.2f}x")
-    print("-" * 40)
+from partitioning import load_metadata
+from benchmarks.datagen import DataGenerator, load_sqlite, write_csv
+from benchmarks.load import closed_loop, compare, default_workload, open_loop, warm_up, write_report
 
-def run_benchmark():
-    master_address = 'localhost:50050'
-    print(f"Connecting to Master Node at {master_address}...")
-    
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--master', help="address of a running master; default: start a local stand-in cluster")
+    parser.add_argument('--config', default=os.path.join(ROOT, 'query-engine', 'master', 'partitions.json'),
+                        help="partition config the data is generated for")
+    parser.add_argument('--customers-per-shard', type=int, default=1000)
+    parser.add_argument('--employees-per-shard', type=int, default=50)
+    parser.add_argument('--sales-per-shard', type=int, default=10000)
+    parser.add_argument('--skew', type=float, default=1.1, help="Zipf exponent of customer/employee references, 0 for uniform")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--generate-csv', metavar='DIR', help="only write per-worker CSV files for loading real workers")
+    parser.add_argument('--data-dir', help="keep the stand-in workers' SQLite files here instead of a temp directory")
+    parser.add_argument('--master-mode', choices=['threaded', 'async'], help="MASTER_MODE of the local master")
+    parser.add_argument('--replicas', type=int, default=0, help="local cluster: read replicas per worker")
+    parser.add_argument('--straggler-ms', type=float, default=0, help="local cluster: delay injected into slow sub-queries")
+    parser.add_argument('--straggler-rate', type=float, default=0.0, help="local cluster: fraction of sub-queries delayed")
+    parser.add_argument('--mode', choices=['closed', 'open'], default='closed')
+    parser.add_argument('--concurrency', type=int, default=8, help="closed loop: concurrent clients")
+    parser.add_argument('--rate', type=float, default=50.0, help="open loop: queries per second")
+    parser.add_argument('--duration', type=float, default=10.0, help="seconds of measured load")
+    parser.add_argument('--warmup', type=float, default=2.0, help="seconds of unmeasured load first")
+    parser.add_argument('--timeout', type=float, help="per-query gRPC deadline in seconds")
+    parser.add_argument('--queries', help="comma-separated subset of the workload's query names")
+    parser.add_argument('--json', metavar='PATH', help="write the report as JSON")
+    parser.add_argument('--compare', metavar='BASELINE', help="print changes against an earlier --json report")
+    parser.add_argument('--verbose', action='store_true', help="keep the master's and workers' logging")
+    return parser.parse_args()
+
+def git_revision():
     try:
-        with grpc.insecure_channel(master_address) as channel:
-            stub = query_pb2_grpc.MasterServiceStub(channel)
-            
-            run_query(
-                stub,
-                "Distributed Map-Reduce Aggregation",
-                "SELECT COUNT(*) FROM sales;"
-            )
-            
-            run_query(
-                stub,
-                "Distributed Broadcast & Filter",
-                "SELECT * FROM sales WHERE sale_amount > 50000;"
-            )
-            
-            run_query(
-                stub,
-                "In-Memory Distributed Hash Join",
-                "SELECT s.product_name, s.sale_amount, c.first_name, c.city FROM sales s JOIN customers c ON s.customer_id = c.customer_id ORDER BY s.sale_amount DESC"
-            )
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+def print_report(results):
+    print(f"{'query':<20} {'count':>7} {'errors':>6} {'qps':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, stats in results.items():
+        cells = [stats[key] for key in ('p50_ms', 'p95_ms', 'p99_ms', 'max_ms')]
+        print(f"{name:<20} {stats['count']:>7} {stats['errors']:>6} {stats['throughput_qps'] or 0:>9.1f} "
+              + ' '.join(f"{cell:>9.2f}" if cell is not None else f"{'-':>9}" for cell in cells))
+    for name, stats in results.items():
+        if 'first_error' in stats:
+            print(f"  {name}: {stats['first_error']}")
+
+def add_replicas(metadata, count):
+    """Gives every worker `count` replicas (stand-ins over the worker's database in the local cluster)."""
+    for meta in metadata.values():
+        meta['replicas'] = {name: [f"{node}/replica{i}" for i in range(1, count + 1)] for name, node in meta['nodes'].items()}
+
+def run(args, generator, master_address):
+    workload = default_workload(generator)
+    if args.queries:
+        wanted = set(args.queries.split(','))
+        workload = [query for query in workload if query.name in wanted]
+        if not workload:
+            raise SystemExit(f"No queries named {sorted(wanted)}.")
+    with grpc.insecure_channel(master_address) as channel:
+        grpc.channel_ready_future(channel).result(timeout=10)
+        if args.warmup:
+            warm_up(channel, workload, args.warmup, args.seed)
+        if args.mode == 'closed':
+            return closed_loop(channel, workload, args.concurrency, args.duration, args.seed, args.timeout)
+        return open_loop(channel, workload, args.rate, args.duration, args.seed, args.timeout)
+
+def main():
+    args = parse_args()
+    metadata = load_metadata(args.config)
+    generator = DataGenerator(metadata, args.customers_per_shard, args.employees_per_shard,
+                              args.sales_per_shard, args.seed, args.skew)
+
+    if args.generate_csv:
+        for path in write_csv(generator, args.generate_csv):
+            print(f"Wrote {path}")
+        return
 
-            print("\n--- TRIGGER VERIFICATION ---")
-            audit_check_query = "SELECT * FROM sales_audit_log;"
-            try:
-                audit_request = query_pb2.QueryRequest(sql=audit_check_query)
-                audit_response = stub.ExecuteQuery(audit_request)
-                if not audit_response.error:
-                    audit_data = json.loads(audit_response.result_json)
-                    print(f"Audit Log Table Exists. Current Entries: {len(audit_data)}")
-                    print("SUCCESS: Triggers correctly initialized.")
-                else:
-                    print(f"Audit Check Response: {audit_response.error_message}")
-            except Exception as e:
-                 print(f"Trigger check warning: {e}")
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(open(os.devnull, 'w'))
+    if args.master:
+        with quiet:
+            results = run(args, generator, args.master)
+        loaded = None
+    else:
+        from benchmarks.local_cluster import LocalCluster
+        if args.replicas:
+            add_replicas(metadata, args.replicas)
+        with LocalCluster(metadata, args.data_dir, master_mode=args.master_mode,
+                          straggler_ms=args.straggler_ms, straggler_rate=args.straggler_rate) as cluster:
+            started = time.perf_counter()
+            loaded = load_sqlite(generator, cluster.connect)
+            print(f"Generated {loaded} in {time.perf_counter() - started:.1f}s")
+            with quiet:
+                cluster.start()
+                results = run(args, generator, cluster.master_address)
 
-    except Exception as e:
-        print(f"Benchmark suite failed: {e}")
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'git_revision': git_revision(),
+        'python': platform.python_version(),
+        'target': args.master or 'local',
+        'rows': loaded,
+        'config': {key: value for key, value in vars(args).items() if key not in ('json', 'compare')},
+        'results': results,
+    }
+    print_report(results)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"\nAgainst {args.compare} ({baseline.get('git_revision')}):")
+        for line in compare(baseline, report):
+            print(line)
+    if args.json:
+        write_report(args.json, report)
+        print(f"\nWrote {args.json}")
 
 if __name__ == '__main__':
-    run_benchmark()
\ No newline at end of file
+    main()
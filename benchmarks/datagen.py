@@ -0,0 +1,163 @@
+"""
+Synthetic data for `customers`, `employees` and `sales`, routed to shards with
+the master's partitioning code. Sizes are given per shard.
+"""
+import csv
+import os
+import random
+from datetime import date, timedelta
+
+from partitioning import coerce_key, route_partition
+
+CHUNK_ROWS = 10000
+
+SCHEMAS = {
+    'customers': """CREATE TABLE IF NOT EXISTS customers (
+        customer_id INT PRIMARY KEY, first_name VARCHAR(50), last_name VARCHAR(50),
+        email VARCHAR(100), city VARCHAR(50), region VARCHAR(20) NOT NULL)""",
+    'employees': """CREATE TABLE IF NOT EXISTS employees (
+        employee_id INT PRIMARY KEY, first_name VARCHAR(50), last_name VARCHAR(50),
+        hire_date DATE, city VARCHAR(50), region VARCHAR(20) NOT NULL)""",
+    'sales': """CREATE TABLE IF NOT EXISTS sales (
+        sale_id INT PRIMARY KEY, product_name VARCHAR(100), sale_amount NUMERIC(10, 2),
+        sale_date DATE NOT NULL, customer_id INT, employee_id INT)""",
+    'sales_audit_log': """CREATE TABLE IF NOT EXISTS sales_audit_log (
+        log_id INTEGER PRIMARY KEY, sale_id INT, action_type VARCHAR(50),
+        action_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP, details TEXT)""",
+}
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS sales_sale_date ON sales (sale_date)",
+    "CREATE INDEX IF NOT EXISTS sales_customer_id ON sales (customer_id)",
+    "CREATE INDEX IF NOT EXISTS sales_employee_id ON sales (employee_id)",
+]
+
+FIRST_NAMES = ['Aarav', 'Vihaan', 'Advik', 'Kabir', 'Anika', 'Saanvi', 'Ishaan', 'Diya', 'Reyansh', 'Myra',
+               'Aadhya', 'Arjun', 'Ishita', 'Vivaan', 'Kiara', 'Sai', 'Shanaya', 'Yuvan', 'Ananya', 'Zoya']
+LAST_NAMES = ['Sharma', 'Verma', 'Mehra', 'Singh', 'Gupta', 'Patel', 'Kumar', 'Chopra', 'Malhotra', 'Jain',
+              'Reddy', 'Nair', 'Rao', 'Iyer', 'Menon', 'Pillai', 'Shetty', 'Das', 'Bose', 'Sen']
+CITIES = ['Delhi', 'Gurgaon', 'Noida', 'Chandigarh', 'Jaipur', 'Lucknow',
+          'Bangalore', 'Chennai', 'Hyderabad', 'Kochi', 'Mysore', 'Coimbatore']
+PRODUCTS = {'Smartphone': 45000, 'Laptop': 85000, 'Headphones': 7500, 'Smartwatch': 22000, 'Camera': 62000,
+            'Tablet': 35000, 'Printer': 15000, 'External Hard Drive': 6000, 'Gaming Console': 55000,
+            '4K TV': 120000, 'Bluetooth Speaker': 9000, 'Fitness Tracker': 4500, 'Drone': 78000,
+            'E-Reader': 12500, 'Projector': 95000, 'Mechanical Keyboard': 11000}
+
+class DataGenerator:
+    """Generates the rows of every table as (node, [row, ...]) chunks per worker."""
+    def __init__(self, metadata, customers_per_shard=1000, employees_per_shard=50,
+                 sales_per_shard=10000, seed=42, skew=1.1):
+        self.metadata = metadata
+        self.sizes = {
+            'customers': customers_per_shard * len(metadata['customers']['nodes']),
+            'employees': employees_per_shard * len(metadata['employees']['nodes']),
+            'sales': sales_per_shard * len(metadata['sales']['nodes']),
+        }
+        self.seed = seed
+        self.skew = skew
+
+    def key_values(self, table):
+        """Values a table's partition key can take: the partition names for list partitioning, else None."""
+        meta = self.metadata[table]
+        return list(meta['nodes']) if meta.get('partition_type') == 'list' else None
+
+    def date_span(self):
+        """[first, last) sale dates covered by the sales partitions."""
+        meta = self.metadata['sales']
+        if meta.get('partition_type') == 'range':
+            bounds = [coerce_key(meta, value) for pair in meta['ranges'].values() for value in pair]
+            return min(bounds), max(bounds)
+        return date(2024, 1, 1), date(2025, 1, 1)
+
+    def _skewed(self, rng, count):
+        """1..count, small values much more likely (a truncated Zipf distribution)."""
+        if self.skew <= 0:
+            return rng.randint(1, count)
+        while True:
+            value = int(rng.paretovariate(self.skew))
+            if value <= count:
+                return value
+
+    def _customer(self, rng, i, regions):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        return [i, first, last, f"{first.lower()}.{last.lower()}{i}@email.com", rng.choice(CITIES), regions[i % len(regions)]]
+
+    def _employee(self, rng, i, regions):
+        hired = date(2020, 1, 1) + timedelta(days=rng.randrange(1500))
+        return [i, rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES), hired.isoformat(), rng.choice(CITIES), regions[i % len(regions)]]
+
+    def _sale(self, rng, i, first_day, days):
+        product = rng.choice(list(PRODUCTS))
+        amount = round(PRODUCTS[product] * rng.uniform(0.8, 1.2), 2)
+        sold = first_day + timedelta(days=rng.randrange(days))
+        return [i, product, amount, sold.isoformat(),
+                self._skewed(rng, self.sizes['customers']), self._skewed(rng, self.sizes['employees'])]
+
+    def rows(self, table):
+        meta = self.metadata[table]
+        key_index = meta['columns'].index(meta['partition_key'])
+        rng = random.Random(f"{self.seed}:{table}")
+        regions = self.key_values(table) or ['North', 'South']
+        first_day, last_day = self.date_span()
+        days = (last_day - first_day).days
+
+        buffers = {}
+        for i in range(1, self.sizes[table] + 1):
+            if table == 'customers':
+                row = self._customer(rng, i, regions)
+            elif table == 'employees':
+                row = self._employee(rng, i, regions)
+            else:
+                row = self._sale(rng, i, first_day, days)
+            node = meta['nodes'][route_partition(meta, row[key_index])]
+            buffer = buffers.setdefault(node, [])
+            buffer.append(row)
+            if len(buffer) >= CHUNK_ROWS:
+                yield node, buffer
+                buffers[node] = []
+        for node, buffer in buffers.items():
+            if buffer:
+                yield node, buffer
+
+def load_sqlite(generator, connect, tables=('customers', 'employees', 'sales')):
+    """Creates every table on every worker database and fills it; connect(node) opens a node's database."""
+    connections = {}
+    for meta in generator.metadata.values():
+        for node in meta['nodes'].values():
+            if node not in connections:
+                connections[node] = connect(node)
+    for table, meta in generator.metadata.items():
+        for node in set(meta['nodes'].values()):
+            connections[node].execute(SCHEMAS[table])
+    counts = {}
+    for table in tables:
+        columns = generator.metadata[table]['columns']
+        statement = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+        for node, rows in generator.rows(table):
+            connections[node].executemany(statement, rows)
+            counts[table] = counts.get(table, 0) + len(rows)
+    for conn in connections.values():
+        for statement in INDEXES:
+            try:
+                conn.execute(statement)
+            except Exception:
+                pass  # the node has no sales table
+        conn.commit()
+        conn.close()
+    return counts
+
+def write_csv(generator, directory, tables=('customers', 'employees', 'sales')):
+    """Writes <directory>/<node>/<table>.csv for loading real workers with `\\copy` (truncate the seed data first)."""
+    handles = {}
+    try:
+        for table in tables:
+            for node, rows in generator.rows(table):
+                if (node, table) not in handles:
+                    path = os.path.join(directory, node.replace(':', '_'))
+                    os.makedirs(path, exist_ok=True)
+                    f = open(os.path.join(path, f"{table}.csv"), 'w', newline='')
+                    handles[node, table] = (f, csv.writer(f))
+                handles[node, table][1].writerows(rows)
+    finally:
+        for f, _ in handles.values():
+            f.close()
+    return sorted({os.path.join(directory, node.replace(':', '_')) for node, _ in handles})
@@ -0,0 +1,190 @@
+"""
+Concurrent load against a MasterService, with latency percentiles: closed-loop
+clients for peak throughput, or an open-loop Poisson rate.
+"""
+import json
+import random
+import threading
+import time
+from concurrent import futures
+from datetime import date, timedelta
+
+import grpc
+
+from protos import query_pb2, query_pb2_grpc
+
+class Query:
+    """A named SQL template whose {placeholders} are filled by `params(rng)` for every request."""
+    def __init__(self, name, template, params=None, weight=1):
+        self.name = name
+        self.template = template
+        self.params = params
+        self.weight = weight
+
+    def sql(self, rng):
+        return self.template.format(**self.params(rng)) if self.params else self.template
+
+def default_workload(generator):
+    """A mix of the query shapes the master plans differently, with literals drawn from the generated data."""
+    customers, employees = generator.sizes['customers'], generator.sizes['employees']
+    regions = generator.key_values('customers') or ['North', 'South']
+    first_day, last_day = generator.date_span()
+    days = (last_day - first_day).days
+
+    def day(rng, after=0):
+        return (first_day + timedelta(days=rng.randrange(max(days - after, 1)))).isoformat()
+
+    def week(rng):
+        start = date.fromisoformat(day(rng, after=7))
+        return {'start': start.isoformat(), 'end': (start + timedelta(days=7)).isoformat()}
+
+    def customer(rng):
+        i = rng.randint(1, customers)
+        return {'region': regions[i % len(regions)], 'id': i}
+
+    return [
+        Query('point_lookup', "SELECT * FROM customers WHERE region = '{region}' AND customer_id = {id}",
+              customer, weight=4),
+        Query('range_scan', "SELECT sale_id, sale_amount FROM sales WHERE sale_date >= '{start}' AND sale_date < '{end}'",
+              week, weight=2),
+        Query('aggregate', "SELECT product_name, COUNT(*) AS n, SUM(sale_amount) AS total FROM sales GROUP BY product_name"),
+        Query('filtered_aggregate', "SELECT employee_id, AVG(sale_amount) AS avg_amount FROM sales "
+                                    "WHERE sale_date >= '{day}' GROUP BY employee_id HAVING COUNT(*) > 1",
+              lambda rng: {'day': day(rng)}),
+        Query('top_k', "SELECT sale_id, sale_amount FROM sales WHERE sale_amount > {amount} ORDER BY sale_amount DESC LIMIT 10",
+              lambda rng: {'amount': rng.randint(1000, 100000)}, weight=2),
+        Query('selective_join', "SELECT s.sale_id, s.sale_amount, c.first_name FROM sales s JOIN customers c "
+                                "ON s.customer_id = c.customer_id WHERE c.customer_id = {id}",
+              lambda rng: {'id': rng.randint(1, customers)}, weight=2),
+        Query('region_join', "SELECT c.city, e.first_name FROM customers c JOIN employees e "
+                             "ON c.region = e.region AND c.city = e.city WHERE e.employee_id = {id}",
+              lambda rng: {'id': rng.randint(1, employees)}),
+    ]
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * fraction // 1))
+    return sorted_values[int(rank) - 1]
+
+class LatencyRecorder:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}
+        self.errors = {}
+        self.first_error = {}
+
+    def record(self, name, seconds, error=None):
+        with self._lock:
+            if error is None:
+                self.latencies.setdefault(name, []).append(seconds)
+            else:
+                self.errors[name] = self.errors.get(name, 0) + 1
+                self.first_error.setdefault(name, error)
+
+    @staticmethod
+    def _summary(values, errors, elapsed):
+        values = sorted(values)
+        ms = lambda seconds: None if seconds is None else round(seconds * 1000, 3)
+        return {
+            'count': len(values),
+            'errors': errors,
+            'throughput_qps': round(len(values) / elapsed, 2) if elapsed else None,
+            'mean_ms': ms(sum(values) / len(values)) if values else None,
+            'p50_ms': ms(percentile(values, 0.50)),
+            'p95_ms': ms(percentile(values, 0.95)),
+            'p99_ms': ms(percentile(values, 0.99)),
+            'max_ms': ms(values[-1]) if values else None,
+        }
+
+    def summary(self, elapsed):
+        with self._lock:
+            names = sorted(set(self.latencies) | set(self.errors))
+            report = {name: self._summary(self.latencies.get(name, []), self.errors.get(name, 0), elapsed)
+                      for name in names}
+            report['overall'] = self._summary([v for values in self.latencies.values() for v in values],
+                                              sum(self.errors.values()), elapsed)
+            for name, error in self.first_error.items():
+                report[name]['first_error'] = error
+        return report
+
+def execute(stub, query, rng, recorder, scheduled=None, timeout=None):
+    sql = query.sql(rng)
+    start = time.perf_counter()
+    try:
+        response = stub.ExecuteQuery(query_pb2.QueryRequest(sql=sql), timeout=timeout)
+        error = response.error_message if response.error else None
+    except grpc.RpcError as e:
+        error = f"{e.code().name}: {e.details()}"
+    recorder.record(query.name, time.perf_counter() - (start if scheduled is None else scheduled), error)
+
+def _picker(workload, rng):
+    weights = [query.weight for query in workload]
+    return lambda: rng.choices(workload, weights)[0]
+
+def warm_up(channel, workload, seconds, seed=0):
+    """Runs the workload serially for `seconds`, e.g. to fill connection pools and caches."""
+    stub = query_pb2_grpc.MasterServiceStub(channel)
+    rng = random.Random(seed)
+    pick = _picker(workload, rng)
+    recorder = LatencyRecorder()
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        execute(stub, pick(), rng, recorder)
+
+def closed_loop(channel, workload, concurrency, duration, seed=0, timeout=None):
+    stub = query_pb2_grpc.MasterServiceStub(channel)
+    recorder = LatencyRecorder()
+    end = time.perf_counter() + duration
+
+    def client(i):
+        rng = random.Random(f"{seed}:{i}")
+        pick = _picker(workload, rng)
+        while time.perf_counter() < end:
+            execute(stub, pick(), rng, recorder, timeout=timeout)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return recorder.summary(time.perf_counter() - start)
+
+def open_loop(channel, workload, rate, duration, seed=0, timeout=None, max_in_flight=1024):
+    stub = query_pb2_grpc.MasterServiceStub(channel)
+    recorder = LatencyRecorder()
+    rng = random.Random(seed)
+    pick = _picker(workload, rng)
+    start = time.perf_counter()
+    scheduled = start
+    with futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        while True:
+            scheduled += rng.expovariate(rate)
+            if scheduled - start >= duration:
+                break
+            delay = scheduled - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            executor.submit(execute, stub, pick(), random.Random(rng.random()), recorder, scheduled, timeout)
+    return recorder.summary(time.perf_counter() - start)
+
+def write_report(path, report):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+def compare(baseline, current):
+    """Lines describing how each query's p50/p99/throughput moved against a baseline report."""
+    lines = []
+    for name, stats in current['results'].items():
+        before = baseline.get('results', {}).get(name)
+        if not before:
+            continue
+        parts = []
+        for metric in ('p50_ms', 'p99_ms', 'throughput_qps'):
+            old, new = before.get(metric), stats.get(metric)
+            if old and new is not None:
+                parts.append(f"{metric} {old:g} -> {new:g} ({(new - old) / old * 100:+.1f}%)")
+        lines.append(f"{name:<20} " + ', '.join(parts))
+    return lines
@@ -0,0 +1,276 @@
+"""
+An in-process cluster for benchmarking without Docker: the real master against
+SQLite-backed stand-ins for the workers.
+"""
+import asyncio
+import copy
+import csv
+import io
+import json
+import os
+import random
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent import futures
+from functools import lru_cache
+
+import grpc
+import sqlglot
+
+from partitioning import replica_groups
+from protos import columnar, query_pb2, query_pb2_grpc
+
+ROW_RETURNING_STATEMENTS = ('SELECT', 'WITH', 'VALUES', 'TABLE')
+# Most common values and histogram buckets per column, like PostgreSQL's default_statistics_target.
+STATISTICS_TARGET = 100
+
+@lru_cache(maxsize=4096)
+def translate(query):
+    """PostgreSQL sub-query (with %(name)s parameters) -> SQLite SQL (with :name parameters)."""
+    query = re.sub(r'%\((\w+)\)s', r':\1', query).replace('%%', '%')
+    query = sqlglot.transpile(query, read='postgres', write='sqlite')[0]
+    # Array parameters (semi-join keys) arrive as JSON text.
+    return re.sub(r'= ANY\s*\((:\w+)\)', r'IN (SELECT value FROM json_each(\1))', query)
+
+def sqlite_params(params_json):
+    if not params_json:
+        return ()
+    params = json.loads(params_json)
+    if isinstance(params, dict):
+        return {name: json.dumps(value) if isinstance(value, list) else value for name, value in params.items()}
+    return params
+
+def encode_result(colnames, rows, result_format):
+    if result_format == query_pb2.COLUMNAR:
+        return query_pb2.PartialResult(columns=columnar.encode_rows(colnames, rows))
+    return query_pb2.PartialResult(result_json=json.dumps([dict(zip(colnames, row)) for row in rows], default=str))
+
+def report_stages(context, db, encode):
+    """The worker's stage timings, in the trailing metadata the master traces."""
+    if context is not None:
+        context.set_trailing_metadata((('x-pool-wait-ms', '0.000'), ('x-db-ms', f"{db * 1000:.3f}"),
+                                       ('x-encode-ms', f"{encode * 1000:.3f}")))
+
+class SQLiteQueryServicer(query_pb2_grpc.QueryServiceServicer):
+    """QueryService stand-in over one SQLite database, one connection per server thread."""
+    def __init__(self, path, batch_rows=1000, straggler_ms=0, straggler_rate=0.0):
+        self.path = path
+        self.batch_rows = batch_rows
+        self.straggler_ms = straggler_ms
+        self.straggler_rate = straggler_rate
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+
+    def _stall(self):
+        if self.straggler_rate and random.random() < self.straggler_rate:
+            time.sleep(self.straggler_ms / 1000)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, check_same_thread=False, timeout=30)
+            conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    def _error(self, e):
+        return query_pb2.PartialResult(result_json=json.dumps({"error": str(e)}))
+
+    def ExecuteSubQuery(self, request, context):
+        try:
+            started = time.perf_counter()
+            self._stall()
+            conn = self._connection()
+            cursor = conn.execute(translate(request.query_sql), sqlite_params(request.params_json))
+            if cursor.description:
+                colnames = [d[0] for d in cursor.description]
+                rows = cursor.fetchall()
+                executed = time.perf_counter()
+                result = encode_result(colnames, rows, request.format)
+                report_stages(context, executed - started, time.perf_counter() - executed)
+                return result
+            conn.commit()
+            report_stages(context, time.perf_counter() - started, 0.0)
+            return query_pb2.PartialResult(result_json=json.dumps([{"status": "success", "rows_affected": cursor.rowcount}]))
+        except Exception as e:
+            return self._error(e)
+
+    def ExecuteSubQueryStream(self, request, context):
+        words = request.query_sql.split(None, 1)
+        if not words or words[0].upper() not in ROW_RETURNING_STATEMENTS:
+            yield self.ExecuteSubQuery(request, context)
+            return
+        db = encode = 0.0
+        try:
+            started = time.perf_counter()
+            self._stall()
+            cursor = self._connection().execute(translate(request.query_sql), sqlite_params(request.params_json))
+            colnames = [d[0] for d in cursor.description]
+            batch_size = request.batch_size or self.batch_rows
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                fetched = time.perf_counter()
+                db += fetched - started
+                if not rows:
+                    break
+                result = encode_result(colnames, rows, request.format)
+                encode += time.perf_counter() - fetched
+                yield result
+                started = time.perf_counter()
+        except Exception as e:
+            yield self._error(e)
+        finally:
+            report_stages(context, db, encode)
+
+    def BulkInsert(self, request, context):
+        try:
+            rows = [[value if value != '' else None for value in record]
+                    for record in csv.reader(io.StringIO(request.csv_data.decode(), newline=''))]
+            statement = f"INSERT INTO {request.table} ({', '.join(request.columns)}) VALUES ({', '.join('?' * len(request.columns))})"
+            conn = self._connection()
+            with self._write_lock, conn:
+                conn.executemany(statement, rows)
+            return query_pb2.PartialResult(result_json=json.dumps([{"status": "success", "rows_affected": len(rows)}]))
+        except Exception as e:
+            return self._error(e)
+
+    def CollectStatistics(self, request, context):
+        """The worker's pg_stats-style statistics, computed exactly with SQLite queries."""
+        try:
+            conn = self._connection()
+            present = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+            tables = []
+            for table in request.tables:
+                if table not in present:
+                    continue
+                rows = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+                columns = {}
+                for _, column, *_ in conn.execute(f'PRAGMA table_info("{table}")').fetchall():
+                    non_null, ndv = conn.execute(f'SELECT COUNT("{column}"), COUNT(DISTINCT "{column}") FROM "{table}"').fetchone()
+                    # Like ANALYZE: the values more common than average are listed, the rest go into the histogram.
+                    common = conn.execute(f'SELECT "{column}", COUNT(*) FROM "{table}" WHERE "{column}" IS NOT NULL '
+                                          f'GROUP BY 1 HAVING COUNT(*) > 1 AND COUNT(*) > ? ORDER BY 2 DESC LIMIT ?',
+                                          (1.25 * non_null / max(ndv, 1), STATISTICS_TARGET)).fetchall()
+                    skip = [value for value, _ in common]
+                    values = [value for value, in conn.execute(
+                        f'SELECT "{column}" FROM "{table}" WHERE "{column}" IS NOT NULL '
+                        f'AND "{column}" NOT IN ({", ".join("?" * len(skip))}) ORDER BY 1', skip)]
+                    bounds = min(len(values), STATISTICS_TARGET + 1)
+                    columns[column] = {
+                        "null_frac": 1 - non_null / rows if rows else 0.0,
+                        "ndv": ndv,
+                        "mcv": [str(value) for value, _ in common],
+                        "mcf": [count / rows for _, count in common],
+                        "histogram": [str(values[i * (len(values) - 1) // (bounds - 1)]) for i in range(bounds)] if bounds > 1 else [],
+                    }
+                size = conn.execute("SELECT SUM(pgsize) FROM dbstat WHERE name = ?", (table,)).fetchone()[0]
+                tables.append({"table": table, "rows": rows, "bytes": size or 0, "columns": columns})
+            return query_pb2.PartialResult(result_json=json.dumps(tables))
+        except Exception as e:
+            return self._error(e)
+
+class LocalCluster:
+    """Stand-in workers for the worker addresses of `metadata` and an in-process master routed to them."""
+    def __init__(self, metadata, directory=None, worker_threads=16, master_mode=None, straggler_ms=0, straggler_rate=0.0):
+        self.metadata = metadata
+        self.straggler_ms = straggler_ms
+        self.straggler_rate = straggler_rate
+        self._tmp = None if directory else tempfile.TemporaryDirectory(prefix='dqps-bench-')
+        self.directory = directory or self._tmp.name
+        self.worker_threads = worker_threads
+        self.master_mode = master_mode
+        self.master_address = None
+        self._servers = []
+        self._master = None
+        self._module = None
+        self._loop_thread = None
+
+    def database(self, node):
+        return os.path.join(self.directory, node.replace(':', '_') + '.sqlite')
+
+    def connect(self, node):
+        return sqlite3.connect(self.database(node))
+
+    def start(self):
+        primary_of = {node: primary for primary, group in replica_groups(self.metadata).items() for node in group}
+        addresses = {}
+        for node in sorted(primary_of):
+            servicer = SQLiteQueryServicer(self.database(primary_of[node]), straggler_ms=self.straggler_ms,
+                                           straggler_rate=self.straggler_rate)
+            server = grpc.server(futures.ThreadPoolExecutor(max_workers=self.worker_threads))
+            query_pb2_grpc.add_QueryServiceServicer_to_server(servicer, server)
+            port = server.add_insecure_port('127.0.0.1:0')
+            server.start()
+            self._servers.append(server)
+            addresses[node] = f"127.0.0.1:{port}"
+
+        # The master reads its partition config at import time.
+        local = copy.deepcopy(self.metadata)
+        for meta in local.values():
+            meta['nodes'] = {name: addresses[node] for name, node in meta['nodes'].items()}
+            meta['replicas'] = {name: [addresses[node] for node in nodes] for name, nodes in meta.get('replicas', {}).items()}
+        config = os.path.join(self.directory, 'partitions.json')
+        with open(config, 'w') as f:
+            json.dump(local, f)
+        os.environ['PARTITION_CONFIG'] = config
+        if self.master_mode:
+            os.environ['MASTER_MODE'] = self.master_mode
+
+        import main as master
+        self._module = master
+        master.update_metadata(local)
+        master.refresh_statistics()
+        if master.MASTER_MODE == 'async':
+            self._start_async_master(master)
+        else:
+            master.CHANNELS.connect(address for address in addresses.values())
+            server = grpc.server(futures.ThreadPoolExecutor(max_workers=master.MASTER_THREADS),
+                                 maximum_concurrent_rpcs=master.MASTER_THREADS)
+            query_pb2_grpc.add_MasterServiceServicer_to_server(master.MasterServicer(), server)
+            self.master_address = f"127.0.0.1:{server.add_insecure_port('127.0.0.1:0')}"
+            server.start()
+            self._servers.append(server)
+        return self
+
+    def refresh_statistics(self):
+        return self._module.refresh_statistics()
+
+    def _start_async_master(self, master):
+        ready = threading.Event()
+        loop = asyncio.new_event_loop()
+
+        async def run():
+            stopping = asyncio.Event()
+            server = grpc.aio.server()
+            query_pb2_grpc.add_MasterServiceServicer_to_server(master.AsyncMasterServicer(), server)
+            self.master_address = f"127.0.0.1:{server.add_insecure_port('127.0.0.1:0')}"
+            await server.start()
+            self._master = (loop, stopping)
+            ready.set()
+            await stopping.wait()
+            await server.stop(None)
+            await master.ASYNC_CHANNELS.aclose()
+
+        self._loop_thread = threading.Thread(target=loop.run_until_complete, args=(run(),), daemon=True)
+        self._loop_thread.start()
+        ready.wait()
+
+    def stop(self):
+        if self._master:
+            loop, stopping = self._master
+            loop.call_soon_threadsafe(stopping.set)
+            self._loop_thread.join()
+        if self._module:
+            self._module.CHANNELS.close()
+        for server in self._servers:
+            server.stop(None)
+        if self._tmp:
+            self._tmp.cleanup()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
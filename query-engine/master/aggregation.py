@@ -0,0 +1,257 @@
+"""
+Two-phase distributed aggregation: the workers compute partial aggregates per
+group, and the master merges them and applies HAVING, ORDER BY and LIMIT.
+"""
+import sqlglot.expressions as exp
+from decimal import Decimal
+
+from expressions import compile_expression, compile_predicate, output_name
+from operators import apply_limit, literal_int, order_keys, sort_rows
+
+def _merge_sum(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
+
+def _merge_min(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return b if b < a else a
+
+def _merge_max(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return b if b > a else a
+
+MERGE_FUNCTIONS = {'sum': _merge_sum, 'min': _merge_min, 'max': _merge_max}
+
+def _average(total, count):
+    if not count or total is None:
+        return None
+    if isinstance(total, int):
+        total = Decimal(total)
+    return total / count
+
+def is_aggregate_query(parsed):
+    """True when the SELECT itself aggregates; aggregates inside its subqueries do not count."""
+    return bool(parsed.args.get('group')) or \
+        any(node.find_ancestor(exp.Select) is parsed for node in parsed.find_all(exp.AggFunc))
+
+def is_distinct_query(parsed):
+    distinct = parsed.args.get('distinct')
+    return distinct is not None and not distinct.args.get('on')
+
+def group_distinct(parsed, columns):
+    """A SELECT DISTINCT as a GROUP BY on its select list, so that rows repeated across shards are merged."""
+    grouped = parsed.copy()
+    items = []
+    for item in grouped.expressions:
+        if isinstance(item, exp.Star):
+            items.extend(exp.column(column) for column in columns)
+        else:
+            items.append(item)
+    grouped.set('expressions', items)
+    grouped.set('group', exp.Group(expressions=[(item.this if isinstance(item, exp.Alias) else item).copy()
+                                                for item in items]))
+    grouped.set('distinct', None)
+    return grouped
+
+class AggregationPlan:
+    """The worker-side partial query and the master-side merge for one aggregate SELECT."""
+    def __init__(self, parsed):
+        items = parsed.expressions
+        if any(parsed.find_all(exp.Window)):
+            raise Exception("Window functions are not supported in distributed aggregates.")
+        clauses = [*items, parsed.args.get('having'), parsed.args.get('order')]
+        if any(node.find(exp.Subquery) for node in clauses if node is not None):
+            raise Exception("Subqueries are not supported in the select list, HAVING or ORDER BY of aggregates.")
+
+        aliases = {item.alias: item.this for item in items if isinstance(item, exp.Alias)}
+        self.group_exprs = []
+        group = parsed.args.get('group')
+        for node in (group.expressions if group else []):
+            if isinstance(node, exp.Literal) and not node.is_string:
+                node = items[int(node.this) - 1]
+                node = node.this if isinstance(node, exp.Alias) else node
+            elif isinstance(node, exp.Column) and not node.table and node.name in aliases:
+                node = aliases[node.name]
+            self.group_exprs.append(node)
+        self._group_lookup = {node.sql(): f"_g{i}" for i, node in enumerate(self.group_exprs)}
+
+        self.partials = []      # (alias, partial aggregate expression, merge function name)
+        self._partial_index = {}
+        self.aggregates = []    # (placeholder, kind, partial aliases)
+        self._aggregate_index = {}
+
+        self.outputs = []
+        for item in items:
+            rewritten = self._rewrite(item)
+            self._check_grouped(rewritten, item)
+            self.outputs.append((output_name(item), compile_expression(rewritten)))
+        output_names = {name for name, _ in self.outputs}
+
+        having = parsed.args.get('having')
+        self.having = None
+        if having:
+            rewritten = self._rewrite(having.this)
+            self._check_grouped(rewritten, having.this)
+            self.having = compile_predicate(rewritten)
+
+        def rewrite_order(node):
+            if isinstance(node, exp.Literal) and not node.is_string:
+                return exp.column(self.outputs[int(node.this) - 1][0])
+            if isinstance(node, exp.Column) and not node.table and node.name in output_names:
+                return node
+            return self._rewrite(node)
+
+        self.order = order_keys(parsed.args.get('order'), rewrite=rewrite_order)
+        self.limit = literal_int(parsed.args.get('limit'))
+        self.offset = literal_int(parsed.args.get('offset'))
+        self.distinct = bool(parsed.args.get('distinct'))
+
+        worker = parsed.copy()
+        worker.set('expressions',
+                   [exp.alias_(node.copy(), f"_g{i}") for i, node in enumerate(self.group_exprs)] +
+                   [exp.alias_(node, alias) for alias, node, _ in self.partials])
+        worker.set('group', exp.Group(expressions=[node.copy() for node in self.group_exprs]) if self.group_exprs else None)
+        for key in ('having', 'order', 'limit', 'offset', 'distinct'):
+            worker.set(key, None)
+        self.worker_query = worker
+
+    def _add_partial(self, node, merge):
+        key = node.sql()
+        if key not in self._partial_index:
+            alias = f"_p{len(self.partials)}"
+            self.partials.append((alias, node, merge))
+            self._partial_index[key] = alias
+        return self._partial_index[key]
+
+    def _add_aggregate(self, node):
+        key = node.sql()
+        if key in self._aggregate_index:
+            return self._aggregate_index[key]
+        if node.find(exp.Distinct):
+            raise Exception(f"DISTINCT aggregates are not supported in distributed queries: {key}")
+
+        # An aggregate FILTER clause is pushed down onto each of its partials.
+        condition = None
+        if isinstance(node, exp.Filter):
+            node, condition = node.this, node.expression
+
+        def partial(expression, merge):
+            if condition is not None:
+                expression = exp.Filter(this=expression, expression=condition.copy())
+            return self._add_partial(expression, merge)
+
+        if isinstance(node, exp.Avg):
+            kind = 'avg'
+            parts = [partial(exp.Sum(this=node.this.copy()), 'sum'),
+                     partial(exp.Count(this=node.this.copy()), 'sum')]
+        elif isinstance(node, exp.Count):
+            kind, parts = 'count', [partial(node.copy(), 'sum')]
+        elif isinstance(node, exp.Sum):
+            kind, parts = 'sum', [partial(node.copy(), 'sum')]
+        elif isinstance(node, exp.Min):
+            kind, parts = 'min', [partial(node.copy(), 'min')]
+        elif isinstance(node, exp.Max):
+            kind, parts = 'max', [partial(node.copy(), 'max')]
+        else:
+            raise Exception(f"Aggregate function not supported in distributed queries: {key}")
+
+        placeholder = f"_a{len(self.aggregates)}"
+        self.aggregates.append((placeholder, kind, parts))
+        self._aggregate_index[key] = placeholder
+        return placeholder
+
+    def _rewrite(self, node):
+        """Replaces aggregates and GROUP BY expressions with placeholder columns."""
+        def replace(node):
+            if isinstance(node, exp.AggFunc) or (isinstance(node, exp.Filter) and isinstance(node.this, exp.AggFunc)):
+                return exp.column(self._add_aggregate(node))
+            placeholder = self._group_lookup.get(node.sql()) if not isinstance(node, exp.Alias) else None
+            if placeholder:
+                return exp.column(placeholder)
+            return node
+        return node.copy().transform(replace)
+
+    def _check_grouped(self, rewritten, original):
+        for column in rewritten.find_all(exp.Column):
+            if not column.name.startswith(('_g', '_a')):
+                raise Exception(f"Column '{column.sql()}' must appear in the GROUP BY clause or be used "
+                                f"in an aggregate function: {original.sql()}")
+
+    def new_state(self):
+        return {}
+
+    def merge(self, groups, rows):
+        """Merges a batch of partial rows from one worker into `groups`."""
+        group_keys = [f"_g{i}" for i in range(len(self.group_exprs))]
+        partials = [(alias, MERGE_FUNCTIONS[merge]) for alias, _, merge in self.partials]
+        for row in rows:
+            if 'error' in row:
+                raise Exception(f"Partial aggregate failed: {row['error']}")
+            key = tuple(row.get(name) for name in group_keys)
+            accumulators = groups.get(key)
+            if accumulators is None:
+                groups[key] = [row.get(alias) for alias, _ in partials]
+                continue
+            for i, (alias, merge) in enumerate(partials):
+                accumulators[i] = merge(accumulators[i], row.get(alias))
+
+    def merge_groups(self, groups, partial_groups):
+        """Merges {group key: [partial, ...]} computed over part of the rows into `groups`."""
+        merges = [MERGE_FUNCTIONS[merge] for _, _, merge in self.partials]
+        for key, values in partial_groups.items():
+            accumulators = groups.get(key)
+            if accumulators is None:
+                groups[key] = values
+                continue
+            for i, merge in enumerate(merges):
+                accumulators[i] = merge(accumulators[i], values[i])
+
+    def finalize(self, groups):
+        if not groups and not self.group_exprs:
+            # A scalar aggregate over no rows still produces one row.
+            groups = {(): [None] * len(self.partials)}
+
+        partial_positions = {alias: i for i, (alias, _, _) in enumerate(self.partials)}
+        results = []
+        for key, accumulators in groups.items():
+            internal = {f"_g{i}": value for i, value in enumerate(key)}
+            for placeholder, kind, parts in self.aggregates:
+                values = [accumulators[partial_positions[alias]] for alias in parts]
+                if kind == 'avg':
+                    internal[placeholder] = _average(*values)
+                elif kind == 'count':
+                    internal[placeholder] = values[0] or 0
+                else:
+                    internal[placeholder] = values[0]
+
+            if self.having and not self.having(internal):
+                continue
+            output = {name: evaluate(internal) for name, evaluate in self.outputs}
+            results.append((internal, output))
+
+        if self.distinct:
+            seen = set()
+            unique = []
+            for internal, output in results:
+                marker = tuple(output.values())
+                if marker not in seen:
+                    seen.add(marker)
+                    unique.append((internal, output))
+            results = unique
+
+        if self.order:
+            keyed = [{**internal, **output, '__output__': output} for internal, output in results]
+            sort_rows(keyed, self.order)
+            rows = [row['__output__'] for row in keyed]
+        else:
+            rows = [output for _, output in results]
+        return apply_limit(rows, self.limit, self.offset)
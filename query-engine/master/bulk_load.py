@@ -0,0 +1,179 @@
+"""
+Bulk inserts: rows are routed to their partitions and sent to the workers in
+batches loaded with COPY. A batch is atomic, but a load across workers is not.
+"""
+import csv
+import codecs
+import io
+import json
+import sqlglot.expressions as exp
+
+from protos import query_pb2
+from partitioning import route_partition
+
+def csv_field(value):
+    if value is None:
+        return ''
+    if isinstance(value, bool):
+        value = 'true' if value else 'false'
+    elif isinstance(value, (dict, list)):
+        value = json.dumps(value)
+    return '"' + str(value).replace('"', '""') + '"'
+
+def encode_csv(rows):
+    return ''.join(','.join(map(csv_field, row)) + '\n' for row in rows).encode()
+
+def literal_row(values):
+    """The Python values of one VALUES tuple; only literals can be bulk loaded."""
+    row = []
+    for node in values.expressions:
+        if isinstance(node, exp.Null):
+            row.append(None)
+        elif isinstance(node, exp.Boolean):
+            row.append(node.this)
+        elif isinstance(node, exp.Literal):
+            row.append(node.this)
+        elif isinstance(node, exp.Neg) and isinstance(node.this, exp.Literal) and not node.this.is_string:
+            row.append(f"-{node.this.this}")
+        else:
+            raise Exception(f"INSERT values must be literals, got: {node.sql()}")
+    return row
+
+class RowDecoder:
+    """Turns a stream of CSV or NDJSON byte chunks, which may split a row anywhere, into rows."""
+    def __init__(self, load_format, columns=None, header=False):
+        self.format = load_format
+        self.columns = list(columns) if columns else None
+        self._header = header and load_format == query_pb2.CSV
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._pending = ''
+
+    def feed(self, data, final=False):
+        text = self._pending + self._decoder.decode(data, final)
+        end = self._row_boundary(text) if not final else len(text)
+        self._pending = text[end:]
+        if self.format == query_pb2.NDJSON:
+            return self._ndjson_rows(text[:end])
+        return self._csv_rows(text[:end])
+
+    def finish(self):
+        return self.feed(b'', final=True)
+
+    def _row_boundary(self, text):
+        """Position just after the last complete row in `text`."""
+        end = text.rfind('\n')
+        if self.format == query_pb2.CSV:
+            # A newline inside a quoted field is not a row boundary.
+            while end >= 0 and text.count('"', 0, end) % 2:
+                end = text.rfind('\n', 0, end)
+        return end + 1
+
+    def _csv_rows(self, text):
+        rows = []
+        for record in csv.reader(io.StringIO(text, newline='')):
+            if not record:
+                continue
+            if self._header:
+                self._header = False
+                self.columns = self.columns or record
+                continue
+            rows.append([value if value != '' else None for value in record])
+        return rows
+
+    def _ndjson_rows(self, text):
+        rows = []
+        for line in text.split('\n'):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if self.columns is None:
+                self.columns = list(record)
+            rows.append([record.get(column) for column in self.columns])
+        return rows
+
+class BulkLoader:
+    """Routes the rows of one table into per-worker batches of at most `batch_rows` rows."""
+    def __init__(self, table, table_meta, columns, batch_rows):
+        self.table = table
+        self.meta = table_meta
+        self.columns = list(columns)
+        self.batch_rows = batch_rows
+        self.partition_key = table_meta['partition_key']
+        if self.partition_key not in self.columns:
+            raise Exception(f"Partition key '{self.partition_key}' must be provided in INSERT.")
+        self._key_index = self.columns.index(self.partition_key)
+        self._buffers = {}
+
+    def add(self, row):
+        """Routes one row and returns the (node, request) batch it completed, or None."""
+        if len(row) != len(self.columns):
+            raise Exception(f"Column count ({len(self.columns)}) does not match value count ({len(row)}).")
+        value = row[self._key_index]
+        if value is None:
+            raise Exception(f"Partition key '{self.partition_key}' must not be NULL.")
+        nodes_map = self.meta['nodes']
+        try:
+            node = nodes_map.get(route_partition(self.meta, value))
+        except ValueError:
+            raise Exception(f"Invalid value for partition key '{self.partition_key}': {value}.")
+        if not node:
+            raise Exception(f"Could not route INSERT for {self.partition_key}='{value}'. "
+                            f"Available nodes: {list(nodes_map.keys())}")
+        buffer = self._buffers.setdefault(node, [])
+        buffer.append(row)
+        if len(buffer) >= self.batch_rows:
+            del self._buffers[node]
+            return node, self.request(buffer)
+        return None
+
+    def flush(self):
+        """The (node, request) batches for every partly filled buffer."""
+        batches = [(node, self.request(rows)) for node, rows in self._buffers.items()]
+        self._buffers = {}
+        return batches
+
+    def request(self, rows):
+        return query_pb2.BulkInsertRequest(table=self.table, columns=self.columns, csv_data=encode_csv(rows))
+
+class BulkLoadSession:
+    """Master-side state of one BulkLoad stream."""
+    def __init__(self, metadata, batch_rows):
+        self.metadata = metadata
+        self.batch_rows = batch_rows
+        self.table = None
+        self.rows_loaded = 0
+        self._decoder = None
+        self._loader = None
+
+    def feed(self, message):
+        if self._decoder is None:
+            if message.table not in self.metadata:
+                raise Exception(f"Table '{message.table}' not in METADATA.")
+            self.table = message.table
+            self._decoder = RowDecoder(message.format, message.columns, message.header)
+        return self._route(self._decoder.feed(message.data))
+
+    def finish(self):
+        if self._decoder is None:
+            raise Exception("Empty bulk load.")
+        batches = self._route(self._decoder.finish())
+        return batches + (self._loader.flush() if self._loader else [])
+
+    def _route(self, rows):
+        if rows and self._loader is None:
+            if not self._decoder.columns:
+                raise Exception("Bulk load needs a column list or a CSV header.")
+            self._loader = BulkLoader(self.table, self.metadata[self.table], self._decoder.columns, self.batch_rows)
+        batches = []
+        for row in rows:
+            batch = self._loader.add(row)
+            if batch:
+                batches.append(batch)
+        return batches
+
+    def record(self, node, result):
+        """Adds a worker's BulkInsert result to the total, raising if the batch failed."""
+        for row in result:
+            if 'error' in row:
+                raise Exception(f"Bulk insert on {node} failed after {self.rows_loaded} rows: {row['error']}")
+            self.rows_loaded += row.get('rows_affected', 0)
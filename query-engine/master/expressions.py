@@ -0,0 +1,298 @@
+"""
+Evaluation of sqlglot expressions over row dicts on the master, compiled once
+into Python closures, with SQL three-valued logic for NULLs.
+"""
+import re
+import sqlglot.expressions as exp
+from datetime import date, datetime
+from decimal import Decimal
+
+def parse_number(text):
+    try:
+        return int(text)
+    except ValueError:
+        return Decimal(text)
+
+def coerce_pair(a, b):
+    """Brings two non-NULL operands to comparable types, like Postgres would for literals."""
+    if isinstance(a, str) and isinstance(b, (date, datetime)):
+        b, a = coerce_pair(b, a)
+        return a, b
+    if isinstance(a, datetime) and isinstance(b, str):
+        return a, datetime.fromisoformat(b)
+    if isinstance(a, date) and isinstance(b, str):
+        return a, date.fromisoformat(b)
+    if isinstance(a, Decimal) and isinstance(b, float):
+        return float(a), b
+    if isinstance(a, float) and isinstance(b, Decimal):
+        return a, float(b)
+    if isinstance(a, (int, Decimal, float)) and isinstance(b, str):
+        return a, parse_number(b)
+    if isinstance(a, str) and isinstance(b, (int, Decimal, float)):
+        return parse_number(a), b
+    return a, b
+
+def _divide(a, b):
+    if isinstance(a, int) and isinstance(b, int):
+        quotient = abs(a) // abs(b)
+        return quotient if (a >= 0) == (b >= 0) else -quotient
+    return a / b
+
+def _modulo(a, b):
+    if isinstance(a, int) and isinstance(b, int):
+        remainder = abs(a) % abs(b)
+        return remainder if a >= 0 else -remainder
+    return a % b
+
+ARITHMETIC = {
+    exp.Add: lambda a, b: a + b,
+    exp.Sub: lambda a, b: a - b,
+    exp.Mul: lambda a, b: a * b,
+    exp.Div: _divide,
+    exp.Mod: _modulo,
+}
+
+COMPARISONS = {
+    exp.EQ: lambda a, b: a == b,
+    exp.NEQ: lambda a, b: a != b,
+    exp.GT: lambda a, b: a > b,
+    exp.GTE: lambda a, b: a >= b,
+    exp.LT: lambda a, b: a < b,
+    exp.LTE: lambda a, b: a <= b,
+}
+
+SCALAR_FUNCTIONS = {
+    exp.Abs: abs,
+    exp.Upper: lambda v: v.upper(),
+    exp.Lower: lambda v: v.lower(),
+    exp.Length: len,
+}
+
+def _like_pattern(pattern, flags=0):
+    regex = ''.join('.*' if ch == '%' else '.' if ch == '_' else re.escape(ch) for ch in pattern)
+    return re.compile(f"^{regex}$", flags | re.DOTALL)
+
+def _cast(value, to):
+    if value is None:
+        return None
+    if to.is_type(*exp.DataType.INTEGER_TYPES):
+        return int(value)
+    if to.is_type(exp.DataType.Type.FLOAT, exp.DataType.Type.DOUBLE):
+        return float(value)
+    if to.is_type(exp.DataType.Type.DECIMAL):
+        return Decimal(str(value))
+    if to.is_type(*exp.DataType.TEXT_TYPES):
+        return str(value)
+    if to.is_type(exp.DataType.Type.DATE):
+        return value if isinstance(value, date) and not isinstance(value, datetime) else date.fromisoformat(str(value)[:10])
+    if to.is_type(exp.DataType.Type.BOOLEAN):
+        return value if isinstance(value, bool) else str(value).lower() in ('t', 'true', '1', 'yes', 'on')
+    raise Exception(f"Unsupported CAST on master: {to.sql()}")
+
+def default_resolve(column):
+    return column.name
+
+def compile_expression(node, resolve=default_resolve):
+    """Compiles a sqlglot expression into a function of one row dict; `resolve` maps an exp.Column to its row key."""
+    def build(node):
+        if isinstance(node, (exp.Paren, exp.Alias)):
+            return build(node.this)
+
+        if isinstance(node, exp.Column):
+            key = resolve(node)
+            if callable(key):
+                return key
+            return lambda row: row.get(key)
+
+        if isinstance(node, exp.Literal):
+            value = node.this if node.is_string else parse_number(node.this)
+            return lambda row: value
+
+        if isinstance(node, exp.Null):
+            return lambda row: None
+
+        if isinstance(node, exp.Boolean):
+            value = node.this
+            return lambda row: value
+
+        if isinstance(node, exp.Neg):
+            operand = build(node.this)
+            def neg(row):
+                value = operand(row)
+                return None if value is None else -value
+            return neg
+
+        op = ARITHMETIC.get(type(node))
+        if op is not None:
+            left, right = build(node.this), build(node.expression)
+            def arithmetic(row):
+                a, b = left(row), right(row)
+                if a is None or b is None:
+                    return None
+                a, b = coerce_pair(a, b)
+                return op(a, b)
+            return arithmetic
+
+        op = COMPARISONS.get(type(node))
+        if op is not None:
+            left, right = build(node.this), build(node.expression)
+            def compare(row):
+                a, b = left(row), right(row)
+                if a is None or b is None:
+                    return None
+                a, b = coerce_pair(a, b)
+                return op(a, b)
+            return compare
+
+        if isinstance(node, exp.And):
+            left, right = build(node.this), build(node.expression)
+            def and_(row):
+                a = left(row)
+                if a is False:
+                    return False
+                b = right(row)
+                if b is False:
+                    return False
+                return None if a is None or b is None else True
+            return and_
+
+        if isinstance(node, exp.Or):
+            left, right = build(node.this), build(node.expression)
+            def or_(row):
+                a = left(row)
+                if a is True:
+                    return True
+                b = right(row)
+                if b is True:
+                    return True
+                return None if a is None or b is None else False
+            return or_
+
+        if isinstance(node, exp.Not):
+            operand = build(node.this)
+            def not_(row):
+                value = operand(row)
+                return None if value is None else not value
+            return not_
+
+        if isinstance(node, exp.Is):
+            operand = build(node.this)
+            if isinstance(node.expression, exp.Null):
+                return lambda row: operand(row) is None
+            target = build(node.expression)
+            return lambda row: operand(row) is target(row)
+
+        if isinstance(node, exp.In) and not node.args.get('query'):
+            operand = build(node.this)
+            options = [build(option) for option in node.expressions]
+            def in_(row):
+                value = operand(row)
+                if value is None:
+                    return None
+                saw_null = False
+                for option in options:
+                    candidate = option(row)
+                    if candidate is None:
+                        saw_null = True
+                    else:
+                        a, b = coerce_pair(value, candidate)
+                        if a == b:
+                            return True
+                return None if saw_null else False
+            return in_
+
+        if isinstance(node, exp.Between):
+            operand, low, high = build(node.this), build(node.args['low']), build(node.args['high'])
+            def between(row):
+                value, lo, hi = operand(row), low(row), high(row)
+                if value is None or lo is None or hi is None:
+                    return None
+                value, lo = coerce_pair(value, lo)
+                value, hi = coerce_pair(value, hi)
+                return lo <= value <= hi
+            return between
+
+        if isinstance(node, (exp.Like, exp.ILike)):
+            operand, pattern = build(node.this), build(node.expression)
+            flags = re.IGNORECASE if isinstance(node, exp.ILike) else 0
+            cache = {}
+            def like(row):
+                value, text = operand(row), pattern(row)
+                if value is None or text is None:
+                    return None
+                if text not in cache:
+                    cache[text] = _like_pattern(text, flags)
+                return cache[text].match(str(value)) is not None
+            return like
+
+        if isinstance(node, exp.Case):
+            branches = [(build(branch.this), build(branch.args['true'])) for branch in node.args.get('ifs') or []]
+            default = build(node.args['default']) if node.args.get('default') else (lambda row: None)
+            subject = build(node.this) if node.this else None
+            def case(row):
+                if subject is None:
+                    for condition, result in branches:
+                        if condition(row) is True:
+                            return result(row)
+                else:
+                    value = subject(row)
+                    for candidate, result in branches:
+                        if value is not None and value == candidate(row):
+                            return result(row)
+                return default(row)
+            return case
+
+        if isinstance(node, exp.Coalesce):
+            operands = [build(node.this)] + [build(e) for e in node.expressions]
+            def coalesce(row):
+                for operand in operands:
+                    value = operand(row)
+                    if value is not None:
+                        return value
+                return None
+            return coalesce
+
+        if isinstance(node, exp.Round):
+            operand = build(node.this)
+            digits = build(node.args['decimals']) if node.args.get('decimals') else (lambda row: 0)
+            def round_(row):
+                value, places = operand(row), digits(row)
+                if value is None or places is None:
+                    return None
+                if isinstance(value, float):
+                    return round(value, places)
+                return Decimal(value).quantize(Decimal(1).scaleb(-places), rounding='ROUND_HALF_UP')
+            return round_
+
+        if isinstance(node, exp.Cast):
+            operand, to = build(node.this), node.args['to']
+            return lambda row: _cast(operand(row), to)
+
+        function = SCALAR_FUNCTIONS.get(type(node))
+        if function is not None:
+            operand = build(node.this)
+            def scalar(row):
+                value = operand(row)
+                return None if value is None else function(value)
+            return scalar
+
+        raise Exception(f"Unsupported expression on master: {node.sql()}")
+
+    return build(node)
+
+def compile_predicate(node, resolve=default_resolve):
+    """Like compile_expression, but the result is True only when the predicate holds."""
+    evaluate = compile_expression(node, resolve)
+    return lambda row: evaluate(row) is True
+
+def output_name(node):
+    """The column name Postgres gives a select-list item."""
+    if isinstance(node, exp.Alias):
+        return node.alias
+    if isinstance(node, exp.Column):
+        return node.name
+    if isinstance(node, exp.Filter):
+        node = node.this
+    if isinstance(node, exp.AggFunc):
+        return node.key
+    return '?column?'
@@ -0,0 +1,512 @@
+"""
+Planning for distributed joins: single-table conjuncts and the needed columns
+are pushed into each table's fetch, and the rest is evaluated on the master.
+"""
+import heapq
+import json
+import math
+import numpy as np
+import sqlglot.expressions as exp
+from datetime import date, datetime
+from decimal import Decimal
+from itertools import islice
+
+from aggregation import AggregationPlan, is_aggregate_query
+from expressions import output_name
+from memory import RowBuffer, estimate_bytes, partition
+from operators import apply_limit, literal_int
+from plan_cache import escape_percent
+from sorting import DistributedSort, SortKey
+from vectorized import (Batch, compile_aggregate, compile_predicate_vector, compile_vector, distinct_rows, hash_join,
+                        sort_indices, to_rows)
+
+# Estimated bytes per value of a joined Batch: an array slot, and its NULL flag.
+JOINED_VALUE_BYTES = 9
+
+def row_key(qualifier, column):
+    return f"{qualifier}.{column}"
+
+def resolve_qualified(column):
+    return row_key(column.table, column.name)
+
+class JoinSource:
+    def __init__(self, table, qualifier, meta):
+        self.table = table
+        self.qualifier = qualifier
+        self.meta = meta
+        self.columns = []       # columns the master needs, in schema order
+        self.filters = []       # conjuncts pushed down to the workers
+
+    def where(self):
+        return exp.and_(*[f.copy() for f in self.filters]) if self.filters else None
+
+    def fetched_columns(self):
+        return self.columns or self.meta['columns'][:1]
+
+    def fetch_query(self, columns=None):
+        columns = columns or self.fetched_columns()
+        select = exp.select(*[
+            exp.alias_(exp.column(column, table=self.qualifier), row_key(self.qualifier, column), quoted=True)
+            for column in columns
+        ])
+        table = exp.to_table(self.table)
+        select = select.from_(table if self.qualifier == self.table else table.as_(self.qualifier))
+        where = self.where()
+        return select.where(where) if where is not None else select
+
+class JoinPlan:
+    """Sources, join conditions, pushed-down filters and projection for a SELECT with JOINs."""
+    def __init__(self, parsed, metadata):
+        parsed = parsed.copy()
+        self.parsed = parsed     # with every column reference qualified
+        self.sources = []
+        self.joins = []         # hash join parameters for each source after the first, in join order
+        self._terms = []        # (left keys, right keys, other conjuncts) of every ON clause
+        self._first = 0         # the source the joins start from
+
+        from_ = parsed.find(exp.From)
+        for node in [from_.this] + [join.this for join in parsed.args.get('joins') or []]:
+            if not isinstance(node, exp.Table):
+                raise Exception(f"Only tables can be joined, got: {node.sql()}")
+            meta = metadata.get(node.name)
+            if not meta:
+                raise Exception(f"Table '{node.name}' not in METADATA.")
+            if any(source.qualifier == node.alias_or_name for source in self.sources):
+                raise Exception(f"Table name '{node.alias_or_name}' specified more than once.")
+            self.sources.append(JoinSource(node.name, node.alias_or_name, meta))
+        self._by_qualifier = {source.qualifier: source for source in self.sources}
+        self._positions = {source.qualifier: i for i, source in enumerate(self.sources)}
+
+        self._qualify(parsed)
+
+        nullable = set()
+        on_conditions = []
+        for i, join in enumerate(parsed.args.get('joins') or [], start=1):
+            side = (join.side or '').upper()
+            if side in ('RIGHT', 'FULL'):
+                nullable.update(source.qualifier for source in self.sources[:i])
+            if side in ('LEFT', 'FULL'):
+                nullable.add(self.sources[i].qualifier)
+            condition = self._join_condition(join, i)
+            on_conditions.append((side, condition))
+
+        residual = []
+        for i, (side, condition) in enumerate(on_conditions, start=1):
+            joined = self.sources[i].qualifier
+            left_keys, right_keys, extra = [], [], []
+            for conjunct in self._conjuncts(condition):
+                pair = self._equi_pair(conjunct, i)
+                if pair:
+                    left_keys.append(pair[0])
+                    right_keys.append(pair[1])
+                elif side == '' and self._push_down(conjunct, nullable):
+                    continue
+                elif side == 'LEFT' and self._tables(conjunct) == {joined} and self._push_down(conjunct, set()):
+                    # Filtering the NULL-supplying side of a LEFT JOIN before the join is equivalent.
+                    continue
+                else:
+                    extra.append(conjunct)
+            for column in left_keys + right_keys + [c for e in extra for c in e.find_all(exp.Column)]:
+                self._need(column.table, column.name)
+            self._terms.append((left_keys, right_keys, extra))
+            self.joins.append(self._join_step(side or 'INNER', i, left_keys, right_keys, extra))
+
+        where = parsed.args.get('where')
+        if where:
+            conjuncts = where.this.flatten() if isinstance(where.this, exp.And) else [where.this]
+            for conjunct in conjuncts:
+                if not self._push_down(conjunct, nullable):
+                    residual.append(conjunct)
+
+        self.residual = compile_predicate_vector(exp.and_(*residual), resolve_qualified) if residual else None
+
+        # An aggregate over the joined rows is computed on the master and finalized like a two-phase one.
+        self.aggregation = None
+        self.outputs = []
+        self.order = []
+        if is_aggregate_query(parsed):
+            self.aggregation = AggregationPlan(parsed)
+            self.aggregate = compile_aggregate(self.aggregation.group_exprs, self.aggregation.partials, resolve_qualified)
+        else:
+            self._compile_outputs(parsed)
+        self.distinct = bool(parsed.args.get('distinct'))
+        self.limit = literal_int(parsed.args.get('limit'))
+        self.offset = literal_int(parsed.args.get('offset'))
+
+        # Everything except the pushed-down filters decides which columns are fetched.
+        clauses = [parsed.args.get(key) for key in ('group', 'having', 'order')]
+        for expression in parsed.expressions + residual + [clause for clause in clauses if clause]:
+            for column in expression.find_all(exp.Column):
+                if column.table and not isinstance(column.this, exp.Star):
+                    self._need(column.table, column.name)
+
+        for source in self.sources:
+            order = {column: i for i, column in enumerate(source.meta['columns'])}
+            source.columns.sort(key=lambda column: order.get(column, len(order)))
+
+    def _join_step(self, how, index, left_keys, right_keys, extra):
+        return {
+            'how': how,
+            'source': index,
+            'pairs': [(left.table, left.name, right.table, right.name) for left, right in zip(left_keys, right_keys)],
+            'left_columns': [resolve_qualified(column) for column in left_keys],
+            'right_columns': [resolve_qualified(column) for column in right_keys],
+            'condition': compile_predicate_vector(exp.and_(*extra), resolve_qualified) if extra else None,
+        }
+
+    def is_inner(self):
+        return all(join['how'] == 'INNER' for join in self.joins)
+
+    def join_order(self):
+        """The qualifiers of the sources in the order they are joined."""
+        return [self.sources[self._first].qualifier] + [self.sources[join['source']].qualifier for join in self.joins]
+
+    def reorder(self, order):
+        """Joins the sources of an inner join in `order` (their FROM-clause positions)."""
+        if not self.is_inner():
+            raise Exception("Only inner joins can be reordered.")
+        pairs = [pair for left_keys, right_keys, _ in self._terms for pair in zip(left_keys, right_keys)]
+        pending = [conjunct for _, _, extra in self._terms for conjunct in extra]
+        self._first = order[0]
+        joined = {self.sources[order[0]].qualifier}
+        self.joins = []
+        for index in order[1:]:
+            qualifier = self.sources[index].qualifier
+            left_keys, right_keys = [], []
+            for a, b in pairs:
+                if b.table == qualifier and a.table in joined:
+                    left_keys.append(a)
+                    right_keys.append(b)
+                elif a.table == qualifier and b.table in joined:
+                    left_keys.append(b)
+                    right_keys.append(a)
+            joined.add(qualifier)
+            extra = [conjunct for conjunct in pending if self._tables(conjunct) <= joined]
+            pending = [conjunct for conjunct in pending if not self._tables(conjunct) <= joined]
+            self.joins.append(self._join_step('INNER', index, left_keys, right_keys, extra))
+
+    def _compile_outputs(self, parsed):
+        for item in parsed.expressions:
+            if isinstance(item, exp.Star) or (isinstance(item, exp.Column) and isinstance(item.this, exp.Star)):
+                for source in self.sources:
+                    if isinstance(item, exp.Star) or item.table == source.qualifier:
+                        for column in source.meta['columns']:
+                            self._need(source.qualifier, column)
+                            self.outputs.append((column, compile_vector(exp.column(column, table=source.qualifier), resolve_qualified)))
+                continue
+            self.outputs.append((output_name(item), compile_vector(item, resolve_qualified)))
+
+        aliases = {item.alias: item.this for item in parsed.expressions if isinstance(item, exp.Alias)}
+
+        def rewrite_order(node):
+            if isinstance(node, exp.Literal) and not node.is_string:
+                node = parsed.expressions[int(node.this) - 1]
+                return node.this if isinstance(node, exp.Alias) else node
+            if isinstance(node, exp.Column) and not node.table and node.name in aliases:
+                return aliases[node.name]
+            return node
+
+        order = parsed.args.get('order')
+        for ordered in (order.expressions if order else []):
+            self.order.append((compile_vector(rewrite_order(ordered.this), resolve_qualified),
+                               bool(ordered.args.get('desc')), bool(ordered.args.get('nulls_first'))))
+
+    def referenced_columns(self, qualifier):
+        """Every column of one source the query mentions, including pushed-down filters, in schema order."""
+        source = self._by_qualifier[qualifier]
+        names = set(source.columns)
+        for column in self.parsed.find_all(exp.Column):
+            if column.table == qualifier and not isinstance(column.this, exp.Star):
+                names.add(column.name)
+        return [column for column in source.meta['columns'] if column in names]
+
+    def joins_on_partition_key(self):
+        """True for a two-table join whose equi-join keys include both tables' partition keys."""
+        if len(self.sources) != 2:
+            return False
+        left, right = self.sources
+        return any(l_table == left.qualifier and l_name == left.meta['partition_key'] and
+                   r_table == right.qualifier and r_name == right.meta['partition_key']
+                   for l_table, l_name, r_table, r_name in self.joins[0]['pairs'])
+
+    def semi_joins(self, fetched=(), estimates=None):
+        """The sources in fetch order, each with the equi-join pair whose keys may filter its fetch, or None."""
+        kinds = {join['how'] for join in self.joins}
+        if kinds == {'INNER'}:
+            reducible = {source.qualifier for source in self.sources}
+        elif len(self.sources) == 2 and kinds in ({'LEFT'}, {'RIGHT'}):
+            reducible = {self.sources[1 if kinds == {'LEFT'} else 0].qualifier}
+        else:
+            reducible = set()
+        pairs = [pair for join in self.joins for pair in join['pairs']]
+        pairs += [(r_table, r_name, l_table, l_name) for l_table, l_name, r_table, r_name in pairs]
+
+        # Sources that are already fetched or filtered go first; they are the selective ones.
+        estimates = estimates or {}
+        order = sorted(self.sources, key=lambda source: (source.qualifier not in fetched, not source.filters,
+                                                         estimates.get(source.qualifier) or 0))
+        selective = {source.qualifier for source in self.sources if source.filters}
+        done, plan = set(), []
+        for source in order:
+            reducer = None
+            if source.qualifier not in fetched and source.qualifier in reducible:
+                reducer = next(((table, name, column) for table, name, target, column in pairs
+                                if target == source.qualifier and table in done and table in selective), None)
+            if reducer:
+                selective.add(source.qualifier)
+            plan.append((source, reducer))
+            done.add(source.qualifier)
+        return plan
+
+    def _qualify(self, parsed):
+        aliases = {item.alias for item in parsed.expressions if isinstance(item, exp.Alias)}
+        for column in list(parsed.find_all(exp.Column)):
+            if isinstance(column.this, exp.Star):
+                continue
+            if not column.table and column.name in aliases and column.find_ancestor(exp.Order, exp.Group):
+                continue
+            if column.table:
+                if column.table not in self._by_qualifier:
+                    raise Exception(f"Missing FROM-clause entry for table '{column.table}'.")
+                continue
+            owners = [s for s in self.sources if column.name in s.meta['columns']]
+            if not owners:
+                raise Exception(f"Column '{column.name}' does not exist in the joined tables.")
+            if len(owners) > 1:
+                raise Exception(f"Column reference '{column.name}' is ambiguous.")
+            column.set('table', exp.to_identifier(owners[0].qualifier))
+
+    def _join_condition(self, join, index):
+        if join.args.get('on'):
+            return join.args['on']
+        using = join.args.get('using')
+        if not using:
+            return None
+        right = self.sources[index]
+        conditions = []
+        for identifier in using:
+            name = identifier.name
+            left = next((s for s in self.sources[:index] if name in s.meta['columns']), None)
+            if left is None or name not in right.meta['columns']:
+                raise Exception(f"Column '{name}' in USING clause does not exist in both tables.")
+            conditions.append(exp.EQ(this=exp.column(name, table=left.qualifier),
+                                     expression=exp.column(name, table=right.qualifier)))
+        return exp.and_(*conditions)
+
+    def _conjuncts(self, condition):
+        if condition is None:
+            return []
+        return condition.flatten() if isinstance(condition, exp.And) else [condition]
+
+    def _tables(self, conjunct):
+        return {column.table for column in conjunct.find_all(exp.Column)}
+
+    def _equi_pair(self, conjunct, index):
+        """(earlier source column, joined source column) when `conjunct` equates them, else None."""
+        if not isinstance(conjunct, exp.EQ):
+            return None
+        left, right = conjunct.this, conjunct.expression
+        if not (isinstance(left, exp.Column) and isinstance(right, exp.Column)):
+            return None
+        joined = self.sources[index].qualifier
+        if left.table == joined:
+            left, right = right, left
+        if right.table != joined or self._positions[left.table] >= index:
+            return None
+        return left, right
+
+    def _push_down(self, conjunct, nullable):
+        tables = {column.table for column in conjunct.find_all(exp.Column)}
+        if len(tables) != 1 or any(conjunct.find_all(exp.Subquery, exp.AggFunc)):
+            return False
+        qualifier = tables.pop()
+        if qualifier in nullable:
+            return False
+        self._by_qualifier[qualifier].filters.append(conjunct)
+        return True
+
+    def _need(self, qualifier, column):
+        source = self._by_qualifier[qualifier]
+        if column not in source.columns:
+            source.columns.append(column)
+
+    def join(self, inputs, memory=None):
+        """Hash-joins the fetched rows of every source into one Batch, or a Batch per partition when they spill."""
+        if memory is not None and any(isinstance(rows, RowBuffer) and rows.spilled for rows in inputs):
+            return self._grace_join(inputs, memory)
+        batches = [Batch.from_rows(rows.tolist() if isinstance(rows, RowBuffer) else rows, self._names(source))
+                   for source, rows in zip(self.sources, inputs)]
+        joined = batches[self._first]
+        reserved = 0
+        for step in self.joins:
+            joined = hash_join(joined, batches[step['source']], step['left_columns'], step['right_columns'], step['how'],
+                               step['condition'])
+            if memory is None:
+                continue
+            # A joined output past work_mem is redone as a Grace join, whose partitions and sort runs can spill.
+            nbytes = len(joined) * len(joined.columns) * JOINED_VALUE_BYTES
+            if nbytes > reserved and not memory.reserve(nbytes - reserved):
+                memory.release(reserved)
+                return self._grace_join(inputs, memory)
+            reserved = max(reserved, nbytes)
+        return joined
+
+    def _names(self, source):
+        return [row_key(source.qualifier, column) for column in source.fetched_columns()]
+
+    def _grace_join(self, inputs, memory):
+        """Grace hash join: the matching spilled partitions of both sides are joined one pair at a time."""
+        chunks = [rows.chunks() if isinstance(rows, RowBuffer) else [rows] for rows in inputs]
+        left, left_names = chunks[self._first], self._names(self.sources[self._first])
+        for step in self.joins:
+            right_names = self._names(self.sources[step['source']])
+            left_parts = partition(left, step['left_columns'], memory)
+            right_parts = partition(chunks[step['source']], step['right_columns'], memory)
+            joined = self._join_partitions(left_parts, right_parts, left_names, right_names, step, memory)
+            left, left_names = (batch.rows() for batch in joined), left_names + right_names
+        return joined
+
+    def _join_partitions(self, left_parts, right_parts, left_names, right_names, step, memory):
+        for left_file, right_file in zip(left_parts, right_parts):
+            left_rows = [row for chunk in left_file.chunks() for row in chunk]
+            right_rows = [row for chunk in right_file.chunks() for row in chunk]
+            left_file.close()
+            right_file.close()
+            if not right_rows and (not left_rows or step['how'] in ('INNER', 'RIGHT')):
+                continue
+            if not left_rows and step['how'] in ('INNER', 'LEFT'):
+                continue
+            nbytes = estimate_bytes(left_rows) + estimate_bytes(right_rows)
+            memory.hold(nbytes)
+            try:
+                yield hash_join(Batch.from_rows(left_rows, left_names), Batch.from_rows(right_rows, right_names),
+                                step['left_columns'], step['right_columns'], step['how'], step['condition'])
+            finally:
+                memory.release(nbytes)
+
+    def project(self, joined, memory=None):
+        """The result rows of the joined Batch, or of the Batches of a partitioned join."""
+        if not isinstance(joined, Batch):
+            return self._project_partitions(joined, memory)
+        batch = self._filter(joined)
+        if self.aggregation is not None:
+            return self.aggregation.finalize(self.aggregate(batch))
+        if self.distinct:
+            batch = batch.take(distinct_rows([evaluate(batch) for _, evaluate in self.outputs], len(batch)))
+        # Sorting and LIMIT run on the joined rows so only the surviving rows are projected.
+        order = sort_indices(batch, self.order) if self.order else np.arange(len(batch))
+        if self.order or self.limit is not None or self.offset:
+            batch = batch.take(apply_limit(order, self.limit, self.offset))
+        return to_rows([(name, evaluate(batch)) for name, evaluate in self.outputs], len(batch))
+
+    def _filter(self, batch):
+        return batch.filter(self.residual(batch)) if self.residual else batch
+
+    def _project_partitions(self, batches, memory):
+        """project() over the Batches of a partitioned join, merging sorted runs that may spill."""
+        if self.aggregation is not None:
+            groups = self.aggregation.new_state()
+            for batch in batches:
+                self.aggregation.merge_groups(groups, self.aggregate(self._filter(batch)))
+            return self.aggregation.finalize(groups)
+
+        budget = None if self.limit is None else self.limit + (self.offset or 0)
+        seen = set()
+        runs, result = [], []
+        for batch in batches:
+            batch = self._filter(batch)
+            if self.distinct:
+                batch = batch.take(distinct_rows([evaluate(batch) for _, evaluate in self.outputs], len(batch)))
+            if self.order:
+                batch = batch.take(sort_indices(batch, self.order)[:budget])
+            rows = to_rows([(name, evaluate(batch)) for name, evaluate in self.outputs], len(batch))
+            if self.distinct:
+                fresh = [tuple(row.values()) not in seen for row in rows]
+                seen.update(tuple(row.values()) for row in rows)
+                batch = batch.filter(np.array(fresh, dtype=bool))
+                rows = [row for row, keep in zip(rows, fresh) if keep]
+            if self.order:
+                keys = [evaluate(batch).expand(len(batch)).tolist() for evaluate, _, _ in self.order]
+                run = RowBuffer(memory, 'sort')
+                run.extend(list(zip(zip(*keys), rows)))
+                runs.append(run)
+            else:
+                result.extend(rows)
+                if budget is not None and len(result) >= budget:
+                    break
+        if not self.order:
+            return apply_limit(result, self.limit, self.offset)
+        directions = [(desc, nulls_first) for _, desc, nulls_first in self.order]
+        merged = heapq.merge(*runs, key=lambda item: SortKey(item[0], directions))
+        start = self.offset or 0
+        return [row for _, row in islice(merged, start, None if self.limit is None else start + self.limit)]
+
+class SemiJoin:
+    """Reduces one source's fetch to the join keys of a source fetched earlier, bound as an array parameter."""
+    def __init__(self, target, column, reducer, reducer_column, dialect, max_keys):
+        self.reducer = reducer
+        self.reducer_key = row_key(reducer, reducer_column)
+        self.max_keys = max_keys
+        keys = exp.EQ(this=exp.column(column, table=target.qualifier),
+                      expression=exp.Any(this=exp.Paren(this=exp.Placeholder(this='semi_keys'))))
+        self.query = escape_percent(target.fetch_query().where(keys).sql(dialect=dialect), 'semi_keys')
+
+    def bind(self, context_data):
+        """(query, params_json) restricted to the keys fetched for the reducer, or None to skip the reduction."""
+        keys = {row.get(self.reducer_key) for row in context_data[self.reducer]}
+        keys.discard(None)
+        if len(keys) > self.max_keys or not all(type(key) in (int, str) for key in keys):
+            return None
+        return self.query, json.dumps({'semi_keys': sorted(keys)})
+
+def sql_literal(value):
+    """Renders a value read from a worker as a PostgreSQL literal of the same type."""
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    if isinstance(value, (int, Decimal)):
+        return str(value)
+    if isinstance(value, float):
+        return repr(value) if math.isfinite(value) else f"'{value}'::float8"
+    if isinstance(value, datetime):
+        return f"TIMESTAMP{' WITH TIME ZONE' if value.tzinfo else ''} '{value.isoformat()}'"
+    if isinstance(value, date):
+        return f"DATE '{value.isoformat()}'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+class ShippedJoin:
+    """A two-table join run on the anchor's workers, with the other side's rows shipped in as a VALUES CTE."""
+    def __init__(self, join_plan, shipped, dialect):
+        self.shipped = shipped
+        self.outer = join_plan.joins[0]['how'] != 'INNER'
+        self.columns = join_plan.referenced_columns(shipped.qualifier)
+        self.fetch_query = shipped.fetch_query(self.columns).sql(dialect=dialect)
+        self._keys = [row_key(shipped.qualifier, column) for column in self.columns]
+        # VALUES types a column from its rows, so one that is NULL in every row would be text.
+        types = shipped.meta.get('column_types', {})
+        self._types = [exp.DataType.build(types[column], dialect=dialect) if column in types else None
+                       for column in self.columns]
+        self._dialect = dialect
+        self._cte = f"_shipped_{shipped.qualifier}"
+
+        query = join_plan.parsed.copy()
+        for table in query.find_all(exp.Table):
+            if table.alias_or_name == shipped.qualifier:
+                table.replace(exp.to_table(self._cte).as_(shipped.qualifier))
+                break
+        self.sort = None
+        if query.args.get('order') or query.args.get('limit'):
+            self.sort = DistributedSort(query, [c for source in join_plan.sources for c in source.meta['columns']])
+            query = self.sort.worker_query
+        self._template = query.sql(dialect=dialect)
+        self._header = ', '.join(exp.to_identifier(column).sql(dialect=dialect) for column in self.columns)
+
+    def query(self, rows):
+        """The anchor workers' SQL with `rows` (fetched shipped-side rows) inlined."""
+        rendered = [[sql_literal(row.get(key)) for key in self._keys] for row in rows]
+        if rendered:
+            rendered[0] = [value if type is None else f"CAST({value} AS {type.sql(dialect=self._dialect)})"
+                           for value, type in zip(rendered[0], self._types)]
+        values = ', '.join('(' + ', '.join(row) + ')' for row in rendered)
+        return f"WITH {self._cte} ({self._header}) AS (VALUES {values}) {self._template}"
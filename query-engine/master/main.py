@@ -1,124 +1,1170 @@
+import asyncio
 import grpc
+import itertools
 import json
+import os
+import queue
+import re
+import threading
+import time
+import uuid
 import sqlglot
 import sqlglot.expressions as exp
+from collections import deque
 from concurrent import futures
-from protos import query_pb2, query_pb2_grpc
-from datetime import datetime
-
-METADATA = {
-    'customers': {
-        'partition_key': 'region',
-        'nodes': { 'North': 'worker1:50051', 'South': 'worker3:50051' }
-    },
-    'employees': {
-        'partition_key': 'region',
-        'nodes': { 'North': 'worker2:50051', 'South': 'worker4:50051' }
-    },
-    'sales': {
-        'partition_key': 'sale_date',
-        'nodes': { 'H1': 'worker5:50051', 'H2': 'worker6:50051' }
-    },
-    'sales_audit_log': {
-        'partition_key': 'sale_id',
-        'nodes': { 'shard1': 'worker5:50051', 'shard2': 'worker6:50051' }
-    }
-}
+from protos import columnar, query_pb2, query_pb2_grpc
+from protos.metrics import Gauge, serve_metrics
+import memory
+import tracing
+from aggregation import AggregationPlan, group_distinct, is_aggregate_query, is_distinct_query
+from bulk_load import BulkLoadSession, BulkLoader, literal_row
+from joins import JoinPlan, SemiJoin, ShippedJoin
+from operators import apply_limit
+from plan_cache import PlanCache, Shape, escape_percent, parameterize
+from replicas import FAILOVERS, HEDGE_WINS, ReplicaSelector
+from result_cache import ResultCache, is_cacheable
+from scheduler import CLIENT_ID_HEADER, QUERY_CLASS_HEADER, QUERY_CLASSES, AdmissionController, Overloaded, \
+    WorkerSlots, classify, plan_cost
+from single_flight import SharedStreams, SingleFlight
+from partitioning import load_metadata, nodes_for_partitions, prune_partitions, replica_groups, same_partitioning
+from sorting import DistributedSort, merge_sorted_runs
+from table_statistics import Statistics, broadcast_cost, pull_cost
+from vectorized import Batch
+
+# Sub-queries run on PostgreSQL, so SQL is parsed and generated with its rules.
+DIALECT = 'postgres'
+
+# Tables, their columns and how they are partitioned across the workers.
+PARTITION_CONFIG = os.getenv('PARTITION_CONFIG', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'partitions.json'))
+METADATA = load_metadata(PARTITION_CONFIG)
 
 def extract_tables(parsed):
     return [table.name for table in parsed.find_all(exp.Table)]
 
-def send_query_to_worker(address, sql_query, params_json=None):
+def target_nodes_for(parsed, table_name):
+    """Worker addresses for the partitions of `table_name` that the WHERE clause can match."""
+    table_meta = METADATA[table_name]
+    qualifiers = {table.alias_or_name for table in parsed.find_all(exp.Table) if table.name == table_name}
+    partitions = prune_partitions(table_meta, parsed.args.get('where'), qualifiers | {table_name})
+    return nodes_for_partitions(table_meta, partitions)
+
+# Keepalive pings keep idle HTTP/2 connections to the workers warm so that a
+# small query never pays for a fresh TCP + HTTP/2 handshake.
+WORKER_CHANNEL_OPTIONS = [
+    ('grpc.keepalive_time_ms', int(os.getenv('WORKER_KEEPALIVE_TIME_MS', '30000'))),
+    ('grpc.keepalive_timeout_ms', int(os.getenv('WORKER_KEEPALIVE_TIMEOUT_MS', '10000'))),
+    ('grpc.keepalive_permit_without_calls', 1),
+    ('grpc.http2.max_pings_without_data', 0),
+    ('grpc.initial_reconnect_backoff_ms', 200),
+    ('grpc.max_reconnect_backoff_ms', 5000),
+]
+WORKER_MAX_FAILURES = int(os.getenv('WORKER_MAX_FAILURES', '3'))
+STREAM_BATCH_ROWS = int(os.getenv('STREAM_BATCH_ROWS', '1000'))
+STREAM_QUEUE_BATCHES = int(os.getenv('STREAM_QUEUE_BATCHES', '64'))
+AUTH_METADATA = (('authorization', 'super-secret-token'),)
+WORKER_RESULT_FORMAT = query_pb2.ResultFormat.Value(os.getenv('WORKER_RESULT_FORMAT', 'COLUMNAR').upper())
+RESULT_CACHE_BYTES = int(os.getenv('RESULT_CACHE_BYTES', str(64 * 1024 * 1024)))
+RESULT_CACHE_TTL_SECONDS = float(os.getenv('RESULT_CACHE_TTL_SECONDS', '0'))
+PLAN_CACHE_SIZE = int(os.getenv('PLAN_CACHE_SIZE', '1024'))
+BULK_BATCH_ROWS = int(os.getenv('BULK_BATCH_ROWS', '5000'))
+BULK_LOAD_INFLIGHT = int(os.getenv('BULK_LOAD_INFLIGHT', '4'))
+# Largest shipped side (per anchor worker) of a join that still runs on the workers.
+BROADCAST_JOIN_ROWS = int(os.getenv('BROADCAST_JOIN_ROWS', '10000'))
+# Most join keys shipped to a worker to pre-filter the other side of a join.
+SEMI_JOIN_MAX_KEYS = int(os.getenv('SEMI_JOIN_MAX_KEYS', '10000'))
+# Identical reads in flight share one execution (COALESCE_READS=0 disables it): whole queries, and below them
+# the sub-query streams to a worker, which can be joined while their first COALESCE_MAX_BATCHES batches are held.
+COALESCE_READS = int(os.getenv('COALESCE_READS', '1'))
+COALESCE_MAX_BATCHES = int(os.getenv('COALESCE_MAX_BATCHES', str(STREAM_QUEUE_BATCHES)))
+# MASTER_MODE=async serves queries from one asyncio event loop (grpc.aio) instead of a thread pool.
+MASTER_MODE = os.getenv('MASTER_MODE', 'threaded').lower()
+QUERY_TIMEOUT_SECONDS = float(os.getenv('QUERY_TIMEOUT_SECONDS', '0'))
+# Deadline of every worker RPC (0 for none); the asyncio master also caps it at the query's deadline.
+WORKER_RPC_TIMEOUT_SECONDS = float(os.getenv('WORKER_RPC_TIMEOUT_SECONDS', '60'))
+# Reads of a partition with replicas are also sent to the next replica when the chosen worker has not
+# answered within HEDGE_PERCENTILE of its recent latencies (HEDGE_DELAY_MS until it has enough samples).
+# Hedges are limited to HEDGE_BUDGET per read; HEDGE_PERCENTILE=0 disables them, leaving only failover.
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '0.95'))
+HEDGE_DELAY_MS = float(os.getenv('HEDGE_DELAY_MS', '100'))
+HEDGE_BUDGET = float(os.getenv('HEDGE_BUDGET', '0.1'))
+# A replica this many times slower than its peers, or failing REPLICA_EJECT_FAILURES times in a row,
+# gets no reads for REPLICA_EJECT_SECONDS.
+REPLICA_OUTLIER_FACTOR = float(os.getenv('REPLICA_OUTLIER_FACTOR', '3'))
+REPLICA_EJECT_FAILURES = int(os.getenv('REPLICA_EJECT_FAILURES', '3'))
+REPLICA_EJECT_SECONDS = float(os.getenv('REPLICA_EJECT_SECONDS', '10'))
+# At most MAX_CONCURRENT_QUERIES queries run at once, ANALYTICAL_MAX_CONCURRENT of them joins or aggregations.
+# Others wait in a weighted-fair queue (interactive queries weigh INTERACTIVE_WEIGHT, analytical ones 1) of
+# up to QUERY_QUEUE_LIMIT queries for at most ADMISSION_TIMEOUT_SECONDS, and are rejected beyond that.
+MAX_CONCURRENT_QUERIES = int(os.getenv('MAX_CONCURRENT_QUERIES', '16'))
+ANALYTICAL_MAX_CONCURRENT = int(os.getenv('ANALYTICAL_MAX_CONCURRENT', '4'))
+INTERACTIVE_WEIGHT = float(os.getenv('INTERACTIVE_WEIGHT', '4'))
+QUERY_QUEUE_LIMIT = int(os.getenv('QUERY_QUEUE_LIMIT', '64'))
+ADMISSION_TIMEOUT_SECONDS = float(os.getenv('ADMISSION_TIMEOUT_SECONDS', '10'))
+# Threads of the threaded master; RPCs beyond them are refused instead of queueing unseen inside gRPC.
+MASTER_THREADS = int(os.getenv('MASTER_THREADS', str(MAX_CONCURRENT_QUERIES + QUERY_QUEUE_LIMIT)))
+# Sub-queries in flight per worker (0 for no limit), matching the workers' default WORKER_THREADS.
+WORKER_MAX_INFLIGHT = int(os.getenv('WORKER_MAX_INFLIGHT', '10'))
+# Prometheus metrics are served on this port (0 disables), and queries slower than SLOW_QUERY_MS print their trace.
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '0'))
+# Rows a query holds for master joins and sorts count against QUERY_WORK_MEM_MB and against MASTER_WORK_MEM_MB
+# shared by all queries; beyond either they spill to SPILL_PARTITIONS temporary files in SPILL_DIR. A query
+# fails once it has to hold more than QUERY_MEMORY_LIMIT_MB in memory or QUERY_SPILL_LIMIT_MB on disk.
+QUERY_WORK_MEM_MB = float(os.getenv('QUERY_WORK_MEM_MB', '64'))
+MASTER_WORK_MEM_MB = float(os.getenv('MASTER_WORK_MEM_MB', '1024'))
+QUERY_MEMORY_LIMIT_MB = float(os.getenv('QUERY_MEMORY_LIMIT_MB', '512'))
+QUERY_SPILL_LIMIT_MB = float(os.getenv('QUERY_SPILL_LIMIT_MB', '10240'))
+SPILL_DIR = os.getenv('SPILL_DIR', '')
+SPILL_PARTITIONS = int(os.getenv('SPILL_PARTITIONS', '32'))
+# Table statistics are collected from the workers every STATISTICS_REFRESH_SECONDS (0 disables) for the planner.
+STATISTICS_REFRESH_SECONDS = float(os.getenv('STATISTICS_REFRESH_SECONDS', '300'))
+EXPLAIN_PATTERN = re.compile(r'\s*EXPLAIN\s+(ANALYZE\s+)?', re.IGNORECASE)
+
+class WorkerChannelRegistry:
+    """Long-lived gRPC channels and stubs to the workers, keyed by address."""
+    def __init__(self, options=None, max_failures=WORKER_MAX_FAILURES):
+        self._options = options if options is not None else WORKER_CHANNEL_OPTIONS
+        self._max_failures = max_failures
+        self._lock = threading.Lock()
+        self._channels = {}
+        self._stubs = {}
+        self._states = {}
+        self._failures = {}
+
+    def _open(self, address):
+        channel = grpc.insecure_channel(address, options=self._options)
+        channel.subscribe(lambda state: self._on_state_change(address, channel, state), try_to_connect=True)
+        self._channels[address] = channel
+        self._stubs[address] = query_pb2_grpc.QueryServiceStub(channel)
+        self._failures[address] = 0
+        return self._stubs[address]
+
+    def _on_state_change(self, address, channel, state):
+        with self._lock:
+            if self._channels.get(address) is channel:
+                self._states[address] = state
+
+    def get_stub(self, address):
+        with self._lock:
+            stub = self._stubs.get(address)
+            if stub is None:
+                stub = self._open(address)
+            return stub
+
+    def connect(self, addresses):
+        for address in set(addresses):
+            self.get_stub(address)
+
+    def record_success(self, address):
+        with self._lock:
+            self._failures[address] = 0
+
+    def record_failure(self, address):
+        with self._lock:
+            self._failures[address] = self._failures.get(address, 0) + 1
+            if self._failures[address] < self._max_failures:
+                return
+            channel = self._channels.pop(address, None)
+            self._stubs.pop(address, None)
+            self._states.pop(address, None)
+            self._failures[address] = 0
+        if channel is not None:
+            print(f"Reconnecting to {address} after {self._max_failures} consecutive failures")
+            self._close_channel(channel)
+
+    def _close_channel(self, channel):
+        channel.close()
+
+    def is_healthy(self, address):
+        with self._lock:
+            state = self._states.get(address)
+        return state not in (grpc.ChannelConnectivity.TRANSIENT_FAILURE, grpc.ChannelConnectivity.SHUTDOWN)
+
+    def health(self):
+        with self._lock:
+            return {address: state.name for address, state in self._states.items()}
+
+    def close(self):
+        with self._lock:
+            channels = list(self._channels.values())
+            self._channels.clear()
+            self._stubs.clear()
+            self._states.clear()
+        for channel in channels:
+            channel.close()
+
+CHANNELS = WorkerChannelRegistry()
+
+class AsyncWorkerChannelRegistry(WorkerChannelRegistry):
+    """The grpc.aio flavour of the registry, used only from the event loop of the asyncio master."""
+    def _open(self, address):
+        channel = grpc.aio.insecure_channel(address, options=self._options)
+        self._channels[address] = channel
+        self._stubs[address] = query_pb2_grpc.QueryServiceStub(channel)
+        self._failures[address] = 0
+        return self._stubs[address]
+
+    def _close_channel(self, channel):
+        asyncio.ensure_future(channel.close())
+
+    def is_healthy(self, address):
+        with self._lock:
+            channel = self._channels.get(address)
+        if channel is None:
+            return True
+        return channel.get_state() not in (grpc.ChannelConnectivity.TRANSIENT_FAILURE, grpc.ChannelConnectivity.SHUTDOWN)
+
+    def health(self):
+        with self._lock:
+            return {address: channel.get_state().name for address, channel in self._channels.items()}
+
+    async def aclose(self):
+        with self._lock:
+            channels = list(self._channels.values())
+            self._channels.clear()
+            self._stubs.clear()
+        for channel in channels:
+            await channel.close()
+
+ASYNC_CHANNELS = AsyncWorkerChannelRegistry()
+# Writes that bypass the master are only picked up once the TTL (if any) expires.
+RESULT_CACHE = ResultCache(RESULT_CACHE_BYTES, RESULT_CACHE_TTL_SECONDS)
+PLAN_CACHE = PlanCache(PLAN_CACHE_SIZE)
+REPLICAS = ReplicaSelector(replica_groups(METADATA), HEDGE_PERCENTILE, HEDGE_DELAY_MS / 1000,
+                           hedge_budget=HEDGE_BUDGET if HEDGE_PERCENTILE else 0, outlier_factor=REPLICA_OUTLIER_FACTOR,
+                           eject_failures=REPLICA_EJECT_FAILURES, eject_seconds=REPLICA_EJECT_SECONDS)
+ADMISSION = AdmissionController(MAX_CONCURRENT_QUERIES, {'analytical': ANALYTICAL_MAX_CONCURRENT},
+                                {'interactive': INTERACTIVE_WEIGHT, 'analytical': 1.0},
+                                QUERY_QUEUE_LIMIT, ADMISSION_TIMEOUT_SECONDS)
+WORKER_SLOTS = WorkerSlots(WORKER_MAX_INFLIGHT, WORKER_RPC_TIMEOUT_SECONDS)
+MEMORY = memory.MemoryPool(MASTER_WORK_MEM_MB * 2 ** 20, QUERY_WORK_MEM_MB * 2 ** 20, QUERY_MEMORY_LIMIT_MB * 2 ** 20,
+                           QUERY_SPILL_LIMIT_MB * 2 ** 20, SPILL_DIR, SPILL_PARTITIONS)
+STATISTICS = Statistics()
+QUERY_FLIGHTS = SingleFlight('query')
+SUBQUERY_STREAMS = SharedStreams(COALESCE_MAX_BATCHES)
+
+def cache_stat(name):
+    return lambda: {('result',): RESULT_CACHE.stats()[name], ('plan',): PLAN_CACHE.stats()[name]}
+
+Gauge('dqps_master_cache_entries', "Entries in the result and plan caches.", cache_stat('entries'), ('cache',))
+Gauge('dqps_master_cache_hits_total', "Cache hits.", cache_stat('hits'), ('cache',), type='counter')
+Gauge('dqps_master_cache_misses_total', "Cache misses.", cache_stat('misses'), ('cache',), type='counter')
+Gauge('dqps_master_cache_evictions_total', "Cache entries evicted for space.", cache_stat('evictions'), ('cache',), type='counter')
+Gauge('dqps_master_result_cache_bytes', "Bytes held by the result cache.", lambda: RESULT_CACHE.stats()['bytes'])
+Gauge('dqps_master_result_cache_invalidations_total', "Result cache entries invalidated by writes.",
+      lambda: RESULT_CACHE.stats()['invalidations'], type='counter')
+Gauge('dqps_master_worker_channel_up', "1 when the channel to a worker is not failing.",
+      lambda: {(address,): int(state not in ('TRANSIENT_FAILURE', 'SHUTDOWN'))
+               for address, state in (ASYNC_CHANNELS if MASTER_MODE == 'async' else CHANNELS).health().items()},
+      ('node',))
+Gauge('dqps_master_ejected_workers', "Workers currently ejected from read selection.", lambda: len(REPLICAS.ejected()))
+Gauge('dqps_master_running_queries', "Admitted queries running, by class.", ADMISSION.running, ('class',))
+Gauge('dqps_master_queued_queries', "Queries waiting for admission, by class.", ADMISSION.queued, ('class',))
+Gauge('dqps_master_worker_inflight', "Sub-queries in flight per worker.", WORKER_SLOTS.in_flight, ('node',))
+Gauge('dqps_master_worker_queued', "Sub-queries waiting for a worker slot.", WORKER_SLOTS.queued, ('node',))
+Gauge('dqps_master_memory_bytes', "Bytes reserved by master operators.", MEMORY.used)
+Gauge('dqps_master_spill_bytes', "Bytes in the master's spill files.", MEMORY.spilled)
+
+def update_metadata(metadata):
+    """Replaces METADATA in place; cached plans and results may route to the old partitions."""
+    METADATA.clear()
+    METADATA.update(metadata)
+    REPLICAS.update(replica_groups(metadata))
+    PLAN_CACHE.clear()
+    RESULT_CACHE.clear()
+    STATISTICS.clear()
+
+def refresh_statistics():
+    """Collects the statistics of every table from the workers holding it."""
+    tables = {}
+    for name, meta in list(METADATA.items()):
+        for node in set(meta['nodes'].values()):
+            tables.setdefault(node, []).append(name)
+    moved = False
+    for node, names in tables.items():
+        rows = call_worker(node, 'CollectStatistics', query_pb2.StatisticsRequest(tables=names))
+        if is_error_result(rows):
+            print(f"Collecting statistics from {node} failed: {rows[0]['error']}")
+            continue
+        moved = STATISTICS.update(node, rows) or moved
+    if moved:
+        PLAN_CACHE.clear()
+    return moved
+
+def start_statistics_refresh():
+    if not STATISTICS_REFRESH_SECONDS:
+        return
+
+    def run():
+        while True:
+            try:
+                refresh_statistics()
+            except Exception as e:
+                print(f"Collecting statistics failed: {e}")
+            time.sleep(STATISTICS_REFRESH_SECONDS)
+
+    threading.Thread(target=run, name='statistics-refresh', daemon=True).start()
+
+def decode_partial_result(partial, span=None):
+    start = time.perf_counter()
+    if partial.HasField('columns'):
+        rows = columnar.decode_rows(partial.columns)
+    else:
+        data = json.loads(partial.result_json)
+        rows = data if isinstance(data, list) else [data]
+    if span is not None:
+        span.add('decode', (time.perf_counter() - start) * 1000)
+    return rows
+
+def worker_metadata():
+    """Metadata sent with every worker RPC: the auth token and the id of the query being run."""
+    return AUTH_METADATA + tracing.metadata()
+
+def is_error_result(rows):
+    return bool(rows) and 'error' in rows[0]
+
+def wait_for_slot(address, span):
+    """Takes one of `address`'s WORKER_MAX_INFLIGHT slots, recording any wait on the RPC's span."""
+    waited = WORKER_SLOTS.acquire(address)
+    if waited:
+        span.add('slot', waited * 1000)
+
+def call_worker(address, method, request):
+    """Runs a unary QueryService RPC and returns its rows; failures come back as an error row."""
+    span = tracing.rpc(address, method)
     try:
-        with grpc.insecure_channel(address) as channel:
-            stub = query_pb2_grpc.QueryServiceStub(channel)
-            print(f"Executing on {address}: \"{sql_query}\" with params {params_json}")
-            metadata = (('authorization', 'super-secret-token'),)
-            response = stub.ExecuteSubQuery(
-                query_pb2.SubQueryRequest(query_sql=sql_query, params_json=params_json),
-                metadata=metadata
-            )
-            
-            data = json.loads(response.result_json)
-            
-            if isinstance(data, list):
-                return data
-            else:
-                return [data]
+        wait_for_slot(address, span)
+        try:
+            stub = CHANNELS.get_stub(address)
+            response, call = getattr(stub, method).with_call(request, metadata=worker_metadata(),
+                                                             timeout=WORKER_RPC_TIMEOUT_SECONDS or None)
+        finally:
+            WORKER_SLOTS.release(address)
+        CHANNELS.record_success(address)
+        rows = decode_partial_result(response, span)
+        tracing.finish_rpc(span, call.trailing_metadata(), len(rows), is_error_result(rows))
+        return rows
                 
     except grpc.RpcError as e:
+        tracing.finish_rpc(span, error=True)
         print(f"WORKER ERROR on {address} (gRPC RpcError): {e}")
+        if e.code() in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED):
+            CHANNELS.record_failure(address)
         return [{"error": f"503 Service Unavailable: Data Node Partition Offline ({address})"}]
     except Exception as e:
+        tracing.finish_rpc(span, error=True)
         print(f"WORKER ERROR on {address}: {e}")
         return [{"error": str(e)}]
 
-class MasterServicer(query_pb2_grpc.MasterServiceServicer):
-    def ExecuteQuery(self, request, context):
-        sql = request.sql
-        print(f"\nReceived query from client: {sql}")
+def send_bulk_insert_to_worker(address, request):
+    print(f"Bulk inserting into {request.table} on {address}: {len(request.csv_data)} bytes")
+    return call_worker(address, 'BulkInsert', request)
+
+def summarize_inserts(results):
+    """Folds the per-batch INSERT results into one row, unless some batch failed."""
+    if any('error' in row for row in results):
+        return results
+    return [{"status": "success", "rows_affected": sum(row.get('rows_affected', 0) for row in results)}]
+
+def open_hedged_stream(address, request, span):
+    """Starts a hedged read of `address`'s partitions; returns (replica, call, first response) of the winner."""
+    candidates = REPLICAS.candidates(address, CHANNELS.is_healthy)
+    REPLICAS.start_read()
+    answers = queue.Queue()
+    calls = []
+
+    def start(candidate, reserved=False):
+        if not reserved:
+            wait_for_slot(candidate, span)
+        call = CHANNELS.get_stub(candidate).ExecuteSubQueryStream(
+            request, metadata=worker_metadata(), timeout=WORKER_RPC_TIMEOUT_SECONDS or None)
+        calls.append(call)
+        started = time.perf_counter()
+
+        def first():
+            try:
+                answer = next(call, None)
+            except grpc.RpcError as e:
+                answer = e
+            finally:
+                WORKER_SLOTS.release(candidate)
+            answers.put((candidate, call, answer, time.perf_counter() - started))
+        threading.Thread(target=first, daemon=True).start()
+
+    first_choice = candidates.pop(0)
+    start(first_choice)
+    pending, failure = 1, None
+    delay = REPLICAS.hedge_delay(first_choice) if candidates else None
+    while pending:
         try:
-            parsed = sqlglot.parse_one(sql)
-            plan = []
-            
-            if isinstance(parsed, exp.Select):
-                is_join = any(parsed.find_all(exp.Join))
-                is_agg = any(parsed.find_all(exp.AggFunc))
-                
-                if is_join:
-                    plan = self.plan_join_query(parsed)
-                elif is_agg:
-                    plan = self.plan_aggregate_query(parsed)
+            candidate, call, answer, seconds = answers.get(timeout=delay)
+        except queue.Empty:
+            delay = None
+            if candidates and WORKER_SLOTS.try_acquire(candidates[0]):
+                if REPLICAS.hedge(address):
+                    print(f"Hedging read of {address} on {candidates[0]}")
+                    span.set(hedged=True)
+                    start(candidates.pop(0), reserved=True)
+                    pending += 1
                 else:
-                    plan = self.plan_simple_query(parsed)
-            
-            elif isinstance(parsed, exp.Insert):
-                plan = self.plan_insert_query(parsed, sql)
-            
+                    WORKER_SLOTS.release(candidates[0])
+            continue
+        pending -= 1
+        if isinstance(answer, grpc.RpcError):
+            failure = answer
+            print(f"WORKER ERROR on {candidate} (gRPC RpcError): {answer.code()}")
+            REPLICAS.record_failure(candidate)
+            if answer.code() in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED):
+                CHANNELS.record_failure(candidate)
+            if candidates:
+                FAILOVERS.inc(node=address)
+                start(candidates.pop(0))
+                pending += 1
+            continue
+        REPLICAS.record_success(candidate, seconds)
+        if candidate != first_choice:
+            HEDGE_WINS.inc(node=candidate)
+        for other in calls:
+            if other is not call:
+                other.cancel()
+        return candidate, call, answer
+    raise Exception(f"503 Service Unavailable: Data Node Partition Offline ({address} and its replicas): {failure.code()}")
+
+def stream_query_from_worker(address, sql_query, params_json=None, batch_size=STREAM_BATCH_ROWS, read=False):
+    """Yields the rows of a sub-query as bounded batches while the worker streams them."""
+    responses = None
+    span = tracing.rpc(address, 'ExecuteSubQueryStream')
+    rows, error, trailing = 0, False, None
+    try:
+        print(f"Streaming from {address}: \"{sql_query}\" with params {params_json}")
+        request = query_pb2.SubQueryRequest(query_sql=sql_query, params_json=params_json,
+                                            batch_size=batch_size, format=WORKER_RESULT_FORMAT)
+        served_by, first = address, None
+        if read and REPLICAS.replicated(address):
+            served_by, responses, first = open_hedged_stream(address, request, span)
+            if served_by != address:
+                span.set(node=served_by, replica_of=address)
+        else:
+            wait_for_slot(address, span)
+            try:
+                responses = CHANNELS.get_stub(address).ExecuteSubQueryStream(
+                    request, metadata=worker_metadata(), timeout=WORKER_RPC_TIMEOUT_SECONDS or None)
+                first = next(responses, None)
+            finally:
+                WORKER_SLOTS.release(address)
+        for partial in itertools.chain([first] if first is not None else [], responses):
+            batch = decode_partial_result(partial, span)
+            rows += len(batch)
+            error = error or is_error_result(batch)
+            yield batch
+        CHANNELS.record_success(served_by)
+        trailing = responses.trailing_metadata()
+
+    except grpc.RpcError as e:
+        error = True
+        print(f"WORKER ERROR on {address} (gRPC RpcError): {e}")
+        if e.code() in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED):
+            CHANNELS.record_failure(span.attributes['node'])
+        yield [{"error": f"503 Service Unavailable: Data Node Partition Offline ({address})"}]
+    except Exception as e:
+        error = True
+        print(f"WORKER ERROR on {address}: {e}")
+        yield [{"error": str(e)}]
+    finally:
+        if responses is not None:
+            responses.cancel()
+        tracing.finish_rpc(span, trailing, rows, error)
+
+def shared_read_key(node, sql_query, params_json):
+    """The key identical sub-query streams share, including the write generation of every table."""
+    return node, sql_query, params_json, RESULT_CACHE.snapshot(tuple(METADATA))
+
+def open_worker_stream(node, sql_query, params_json=None, read=False):
+    """stream_query_from_worker, shared with the identical reads in flight."""
+    start = lambda: stream_query_from_worker(node, sql_query, params_json, read=read)
+    if not (read and COALESCE_READS):
+        return start()
+    return SUBQUERY_STREAMS.open(shared_read_key(node, sql_query, params_json), start)
+
+def query_for(sql_query, node):
+    """`sql_query` is either one SQL string for every node or a {node: sql} dict."""
+    return sql_query[node] if isinstance(sql_query, dict) else sql_query
+
+def gather_partition_batches(executor, nodes, sql_query, params_json=None, read=False):
+    """Fans a sub-query out to `nodes` and yields row batches in arrival order."""
+    batches = queue.Queue(maxsize=STREAM_QUEUE_BATCHES)
+    stop = threading.Event()
+    done = object()
+
+    def pump(node):
+        stream = open_worker_stream(node, query_for(sql_query, node), params_json, read=read)
+        try:
+            for batch in stream:
+                batches.put(batch)
+                if stop.is_set():
+                    break
+        finally:
+            stream.close()
+            batches.put(done)
+
+    pump = tracing.bind(pump)
+    for node in nodes:
+        executor.submit(pump, node)
+
+    remaining = len(nodes)
+    try:
+        while remaining:
+            item = batches.get()
+            if item is done:
+                remaining -= 1
             else:
-                plan = self.plan_simple_query(parsed)
-            
-            final_result = self.execute_plan(plan)
-            return query_pb2.QueryResponse(result_json=json.dumps(final_result, indent=2, default=str))
-        except sqlglot.errors.ParseError as e:
-            return query_pb2.QueryResponse(result_json="[]", error=True, error_message=f"SQL Parsing Error: {e}")
+                yield item
+    finally:
+        stop.set()
+        while remaining:
+            if batches.get() is done:
+                remaining -= 1
+
+def merge_partition_streams(nodes, sql_query, params_json, keys, limit=None, offset=None):
+    """Streams a sorted sub-query from every node and k-way merges the runs."""
+    stop = threading.Event()
+    done = object()
+    queues = [queue.Queue(maxsize=STREAM_QUEUE_BATCHES) for _ in nodes]
+    finished = [False] * len(nodes)
+
+    def pump(node, batches):
+        stream = open_worker_stream(node, query_for(sql_query, node), params_json, read=True)
+        try:
+            for batch in stream:
+                batches.put(batch)
+                if stop.is_set():
+                    break
+        finally:
+            stream.close()
+            batches.put(done)
+
+    def run(i):
+        while True:
+            batch = queues[i].get()
+            if batch is done:
+                finished[i] = True
+                return
+            if batch and 'error' in batch[0]:
+                raise Exception(f"Sorted read from {nodes[i]} failed: {batch[0]['error']}")
+            yield from batch
+
+    pump = tracing.bind(pump)
+    for node, batches in zip(nodes, queues):
+        threading.Thread(target=pump, args=(node, batches), daemon=True).start()
+
+    try:
+        return merge_sorted_runs([run(i) for i in range(len(nodes))], keys, limit, offset)
+    finally:
+        stop.set()
+        for i, batches in enumerate(queues):
+            while not finished[i]:
+                finished[i] = batches.get() is done
+
+def _remaining(deadline):
+    """Seconds left until an event-loop deadline, for per-RPC timeouts."""
+    if deadline is None:
+        return None
+    return max(deadline - asyncio.get_running_loop().time(), 0.001)
+
+def _rpc_timeout(deadline):
+    """WORKER_RPC_TIMEOUT_SECONDS, capped at the time left until the query's deadline."""
+    remaining = _remaining(deadline)
+    if not WORKER_RPC_TIMEOUT_SECONDS:
+        return remaining
+    return WORKER_RPC_TIMEOUT_SECONDS if remaining is None else min(remaining, WORKER_RPC_TIMEOUT_SECONDS)
+
+async def wait_for_slot_async(address, span):
+    waited = await WORKER_SLOTS.acquire_async(address)
+    if waited:
+        span.add('slot', waited * 1000)
+
+async def call_worker_async(address, method, request, deadline=None):
+    span = tracing.rpc(address, method)
+    try:
+        await wait_for_slot_async(address, span)
+        try:
+            stub = ASYNC_CHANNELS.get_stub(address)
+            call = getattr(stub, method)(request, metadata=worker_metadata(), timeout=_rpc_timeout(deadline))
+            response = await call
+        finally:
+            WORKER_SLOTS.release(address)
+        ASYNC_CHANNELS.record_success(address)
+        rows = decode_partial_result(response, span)
+        tracing.finish_rpc(span, await call.trailing_metadata(), len(rows), is_error_result(rows))
+        return rows
+
+    except grpc.RpcError as e:
+        tracing.finish_rpc(span, error=True)
+        print(f"WORKER ERROR on {address} (gRPC RpcError): {e}")
+        if e.code() in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED):
+            ASYNC_CHANNELS.record_failure(address)
+        return [{"error": f"503 Service Unavailable: Data Node Partition Offline ({address})"}]
+    except Exception as e:
+        tracing.finish_rpc(span, error=True)
+        print(f"WORKER ERROR on {address}: {e}")
+        return [{"error": str(e)}]
+
+async def send_bulk_insert_to_worker_async(address, request, deadline=None):
+    print(f"Bulk inserting into {request.table} on {address}: {len(request.csv_data)} bytes")
+    return await call_worker_async(address, 'BulkInsert', request, deadline)
+
+async def open_hedged_stream_async(address, request, span, deadline=None):
+    """Async counterpart of open_hedged_stream."""
+    candidates = REPLICAS.candidates(address, ASYNC_CHANNELS.is_healthy)
+    REPLICAS.start_read()
+    reads = {}
+
+    async def start(candidate, reserved=False):
+        if not reserved:
+            await wait_for_slot_async(candidate, span)
+        call = ASYNC_CHANNELS.get_stub(candidate).ExecuteSubQueryStream(
+            request, metadata=worker_metadata(), timeout=_rpc_timeout(deadline))
+        read = asyncio.ensure_future(call.read())
+        read.add_done_callback(lambda _: WORKER_SLOTS.release(candidate))
+        reads[read] = (candidate, call, time.perf_counter())
+
+    first_choice = candidates.pop(0)
+    await start(first_choice)
+    failure = None
+    delay = REPLICAS.hedge_delay(first_choice) if candidates else None
+    try:
+        while reads:
+            done, _ = await asyncio.wait(reads, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                delay = None
+                if candidates and WORKER_SLOTS.try_acquire(candidates[0]):
+                    if REPLICAS.hedge(address):
+                        print(f"Hedging read of {address} on {candidates[0]}")
+                        span.set(hedged=True)
+                        await start(candidates.pop(0), reserved=True)
+                    else:
+                        WORKER_SLOTS.release(candidates[0])
+                continue
+            for task in done:
+                candidate, call, started = reads.pop(task)
+                try:
+                    answer = task.result()
+                except grpc.RpcError as e:
+                    failure = e
+                    print(f"WORKER ERROR on {candidate} (gRPC RpcError): {e.code()}")
+                    REPLICAS.record_failure(candidate)
+                    if e.code() in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED):
+                        ASYNC_CHANNELS.record_failure(candidate)
+                    if candidates:
+                        FAILOVERS.inc(node=address)
+                        await start(candidates.pop(0))
+                    continue
+                REPLICAS.record_success(candidate, time.perf_counter() - started)
+                if candidate != first_choice:
+                    HEDGE_WINS.inc(node=candidate)
+                return candidate, call, None if answer is grpc.aio.EOF else answer
+        raise Exception(f"503 Service Unavailable: Data Node Partition Offline ({address} and its replicas): {failure.code()}")
+    finally:
+        for task, (_, call, _) in reads.items():
+            task.cancel()
+            call.cancel()
+
+async def stream_query_from_worker_async(address, sql_query, params_json=None, batch_size=STREAM_BATCH_ROWS,
+                                         deadline=None, read=False):
+    """Async counterpart of stream_query_from_worker; closing the generator cancels the RPC."""
+    call = None
+    span = tracing.rpc(address, 'ExecuteSubQueryStream')
+    rows, error, trailing = 0, False, None
+    try:
+        print(f"Streaming from {address}: \"{sql_query}\" with params {params_json}")
+        request = query_pb2.SubQueryRequest(query_sql=sql_query, params_json=params_json,
+                                            batch_size=batch_size, format=WORKER_RESULT_FORMAT)
+        served_by, partial = address, None
+        if read and REPLICAS.replicated(address):
+            served_by, call, partial = await open_hedged_stream_async(address, request, span, deadline)
+            if served_by != address:
+                span.set(node=served_by, replica_of=address)
+            if partial is None:
+                partial = grpc.aio.EOF
+        else:
+            await wait_for_slot_async(address, span)
+            try:
+                call = ASYNC_CHANNELS.get_stub(address).ExecuteSubQueryStream(
+                    request, metadata=worker_metadata(), timeout=_rpc_timeout(deadline))
+                partial = await call.read()
+            finally:
+                WORKER_SLOTS.release(address)
+        while True:
+            if partial is None:
+                partial = await call.read()
+            if partial is grpc.aio.EOF:
+                break
+            batch = decode_partial_result(partial, span)
+            partial = None
+            rows += len(batch)
+            error = error or is_error_result(batch)
+            yield batch
+        ASYNC_CHANNELS.record_success(served_by)
+        trailing = await call.trailing_metadata()
+
+    except grpc.RpcError as e:
+        error = True
+        print(f"WORKER ERROR on {address} (gRPC RpcError): {e}")
+        if e.code() in (grpc.StatusCode.UNAVAILABLE, grpc.StatusCode.DEADLINE_EXCEEDED):
+            ASYNC_CHANNELS.record_failure(span.attributes['node'])
+        yield [{"error": f"503 Service Unavailable: Data Node Partition Offline ({address})"}]
+    except Exception as e:
+        error = True
+        print(f"WORKER ERROR on {address}: {e}")
+        yield [{"error": str(e)}]
+    finally:
+        if call is not None:
+            call.cancel()
+        tracing.finish_rpc(span, trailing, rows, error)
+
+def open_worker_stream_async(node, sql_query, params_json=None, deadline=None, read=False):
+    """stream_query_from_worker_async, shared with the identical reads in flight."""
+    if not (read and COALESCE_READS):
+        return stream_query_from_worker_async(node, sql_query, params_json, deadline=deadline, read=read)
+    return SUBQUERY_STREAMS.open_async(shared_read_key(node, sql_query, params_json),
+                                       lambda: stream_query_from_worker_async(node, sql_query, params_json, read=True))
+
+async def fan_out_async(nodes, sql_query, params_json, consume, deadline=None, read=False):
+    """Streams `sql_query` from every node concurrently and hands each batch to consume(node, batch)."""
+    tasks = []
+
+    async def pump(node):
+        stream = open_worker_stream_async(node, query_for(sql_query, node), params_json, deadline=deadline, read=read)
+        try:
+            async for batch in stream:
+                if consume(node, batch) is False:
+                    for task in tasks:
+                        if task is not asyncio.current_task():
+                            task.cancel()
+                    return
+        finally:
+            await stream.aclose()
+
+    try:
+        async with asyncio.TaskGroup() as group:
+            tasks.extend(group.create_task(pump(node)) for node in nodes)
+    except ExceptionGroup as errors:
+        raise errors.exceptions[0]
+
+def fan_out_step(nodes, sql_query, sort=None, read=True):
+    """The step that runs a complete statement on `nodes`."""
+    if sort is None:
+        return {'type': 'broadcast', 'nodes': nodes, 'query': sql_query, 'params': None, 'read': read}
+    if sort.keys:
+        return {'type': 'merge_sorted', 'nodes': nodes, 'query': sql_query, 'params': None, 'sort': sort}
+    return {'type': 'broadcast', 'nodes': nodes, 'query': sql_query, 'params': None, 'read': read,
+            'limit': sort.limit, 'offset': sort.offset}
+
+def semi_join_query(step, context_data, params_json):
+    """The query and parameters of a fetch_for_join step, key-filtered by its semi-join when one applies."""
+    semi_join = step.get('semi_join')
+    reduced = semi_join.bind(context_data) if semi_join else None
+    if reduced is None:
+        return step['query'], step.get('params') or params_json
+    print(f"Reducing '{step['table']}' to the join keys of '{semi_join.reducer}'")
+    return reduced
+
+def ship_join_step(step, context_data):
+    """Turns a planned ship_join into its fan-out step, or None when the master has to join."""
+    ship = step['ship']
+    shipped = {node: context_data[key] for node, key in step['targets'].items()}
+    max_rows = step['max_rows']
+    if max_rows is not None and any(len(rows) > max_rows for rows in shipped.values()):
+        print(f"Shipped side '{ship.shipped.qualifier}' exceeds {max_rows} rows, joining on master")
+        return None
+    if ship.outer and not all(shipped.values()):
+        # An outer join against nothing still has to produce the preserved rows.
+        return None
+    queries = {node: ship.query(rows) for node, rows in shipped.items() if rows}
+    print(f"Shipping '{ship.shipped.qualifier}' to {list(queries)} for a worker-side join")
+    return fan_out_step(list(queries), queries, ship.sort)
+
+def describe_step(step):
+    """The title and detail lines of a plan step in EXPLAIN output."""
+    step_type = step['type']
+    title, details, nodes = step_type, [], step.get('nodes') or []
+    if step_type == 'bulk_insert':
+        title = f"bulk_insert into {step['table']} ({len(step['batches'])} batches)"
+        nodes = sorted({node for node, _ in step['batches']})
+    elif step_type == 'fetch_for_join':
+        title = f"fetch_for_join {step['table']}"
+        if step.get('estimated_rows') is not None:
+            details.append(f"estimated rows: {step['estimated_rows']:.0f}")
+        if step.get('semi_join'):
+            details.append(f"semi-join: keys of {step['semi_join'].reducer}")
+    elif step_type == 'ship_join':
+        title = f"ship_join of {step['ship'].shipped.qualifier}"
+        nodes = sorted(step['targets'])
+        if step['max_rows'] is not None:
+            details.append(f"falls back to the master join above {step['max_rows']} rows")
+    elif step_type == 'master_hash_join':
+        title = f"master_hash_join of {', '.join(step['join'].join_order())}"
+    elif step_type == 'master_project' and step['join'].aggregation is not None:
+        aggregation = step['join'].aggregation
+        details.append(f"hash aggregate: {len(aggregation.group_exprs)} group key(s), {len(aggregation.partials)} partial(s)")
+    if nodes:
+        details.append(f"nodes: {', '.join(nodes)}")
+    query = step.get('query')
+    if isinstance(query, dict):
+        details.extend(f"query on {node}: {sql}" for node, sql in query.items())
+    elif query:
+        details.append(f"query: {query}")
+    if step.get('sort') is not None:
+        details.append(f"k-way merge of {len(step['sort'].keys)} sort key(s), limit {step['sort'].limit}, offset {step['sort'].offset or 0}")
+    elif step.get('limit') is not None or step.get('offset'):
+        details.append(f"limit {step.get('limit')}, offset {step.get('offset') or 0}")
+    return title, details
+
+def explain_plan(plan, params_json=None, indent=0):
+    """EXPLAIN lines for a plan that is not run."""
+    pad = '  ' * indent
+    lines = [f"{pad}params: {params_json}"] if params_json and not indent else []
+    for step in plan:
+        title, details = describe_step(step)
+        lines.append(pad + title)
+        lines.extend(f"{pad}    {detail}" for detail in details)
+        if step['type'] == 'ship_join':
+            lines.append(f"{pad}    fallback:")
+            lines.extend(explain_plan(step['fallback'], indent=indent + 3))
+    return lines
+
+def step_rows(step, final_result, context_data):
+    """Rows a finished step produced, for EXPLAIN ANALYZE."""
+    if step['type'] == 'fetch_for_join':
+        return len(context_data.get(step['table'], ()))
+    if step['type'] == 'map_aggregate':
+        return len(context_data.get('aggs', ()))
+    if step['type'] == 'master_hash_join' and not isinstance(final_result, Batch):
+        # A partitioned join produces its rows as master_project consumes them.
+        return None
+    if step['type'] == 'bulk_insert':
+        return sum(row.get('rows_affected', 0) for row in final_result)
+    return len(final_result)
+
+def query_id_for(context):
+    """The client's x-query-id, or a new id, and sends it back in the trailing metadata."""
+    metadata = {key: value for key, value in context.invocation_metadata() or ()} if context is not None else {}
+    query_id = metadata.get(tracing.QUERY_ID_HEADER) or uuid.uuid4().hex[:16]
+    if context is not None:
+        context.set_trailing_metadata(((tracing.QUERY_ID_HEADER, query_id),))
+    return query_id
+
+def admission_for(context, template):
+    """The scheduling class, client and cost of a query."""
+    metadata = {key: value for key, value in context.invocation_metadata() or ()} if context is not None else {}
+    query_class = metadata.get(QUERY_CLASS_HEADER)
+    if query_class not in QUERY_CLASSES:
+        query_class = template['class']
+    client = metadata.get(CLIENT_ID_HEADER) or (context.peer().rsplit(':', 1)[0] if context is not None else '')
+    tracing.annotate(query_class=query_class)
+    return query_class, client, template['cost']
+
+class MasterServicer(query_pb2_grpc.MasterServiceServicer):
+    def ExecuteQuery(self, request, context):
+        with tracing.query(query_id_for(context), request.sql, SLOW_QUERY_MS, describe_step):
+            try:
+                response, query = self.begin_query(request)
+                if response is not None:
+                    return response
+                if query['flight_key'] is None:
+                    return self.run_query(request, context, query)
+                response, shared = QUERY_FLIGHTS.do(query['flight_key'], lambda: self.run_query(request, context, query))
+                if shared:
+                    tracing.annotate(coalesced=True)
+                return response
+            except Exception as e:
+                return self.error_response(e)
+
+    def run_query(self, request, context, query):
+        final_result = []
+        try:
+            if query['explain'] != 'plan':
+                with ADMISSION.admitted(*admission_for(context, query['template'])) as waited:
+                    tracing.annotate(queued_ms=waited * 1000)
+                    final_result = self.execute_plan(query['template']['plan'], query['params_json'])
+        finally:
+            self.end_query(query)
+        return self.finish_query(request, query, final_result)
+
+    def BulkLoad(self, request_iterator, context):
+        """Routes a stream of CSV/NDJSON rows to their shards."""
+        session = BulkLoadSession(METADATA, BULK_BATCH_ROWS)
+        in_flight = deque()
+        try:
+            with futures.ThreadPoolExecutor(max_workers=BULK_LOAD_INFLIGHT) as executor:
+                def send(batches):
+                    for node, request in batches:
+                        if len(in_flight) >= BULK_LOAD_INFLIGHT:
+                            done_node, future = in_flight.popleft()
+                            session.record(done_node, future.result())
+                        in_flight.append((node, executor.submit(send_bulk_insert_to_worker, node, request)))
+
+                for message in request_iterator:
+                    send(session.feed(message))
+                send(session.finish())
+                while in_flight:
+                    node, future = in_flight.popleft()
+                    session.record(node, future.result())
+            print(f"Bulk load into {session.table} finished: {session.rows_loaded} rows")
+            return query_pb2.BulkLoadResponse(rows_loaded=session.rows_loaded)
         except Exception as e:
-            print(f"FATAL ERROR in ExecuteQuery: {e}")
-            return query_pb2.QueryResponse(result_json="[]", error=True, error_message=str(e))
+            print(f"FATAL ERROR in BulkLoad: {e}")
+            return query_pb2.BulkLoadResponse(rows_loaded=session.rows_loaded, error=True, error_message=str(e))
+        finally:
+            if session.table:
+                RESULT_CACHE.invalidate(session.table)
+
+    def begin_query(self, request):
+        """Returns (cached response, None) when the result cache can answer, else (None, query)."""
+        sql = request.sql
+        print(f"\nReceived query {tracing.current().query_id} from client: {sql}")
+        # EXPLAIN only plans the statement; EXPLAIN ANALYZE runs it and reports the trace instead of the rows.
+        explain = EXPLAIN_PATTERN.match(sql)
+        if explain:
+            sql = sql[explain.end():]
+        mode = ('analyze' if explain.group(1) else 'plan') if explain else None
+        raw_key = (sql, request.format)
+        if RESULT_CACHE.enabled and mode is None:
+            cached = RESULT_CACHE.lookup(raw_key)
+            if cached is not None:
+                tracing.annotate(cached=True)
+                return cached, None
+
+        with tracing.span('plan', 'plan'):
+            template, params = self.prepare(sql)
+        params_json = json.dumps(params, sort_keys=True) if params else None
+        query = {'template': template, 'params_json': params_json, 'raw_key': raw_key, 'cache_key': None,
+                 'explain': mode, 'flight_key': None}
+        # Queries started after a write through the master finished do not join one started before it.
+        if COALESCE_READS and template['cacheable'] and mode is None:
+            query['flight_key'] = (template['key'], params_json, request.format,
+                                   RESULT_CACHE.snapshot(template['tables']))
+        if RESULT_CACHE.enabled and template['cacheable'] and mode is None:
+            query['cache_key'] = (template['key'], params_json, request.format)
+            cached = RESULT_CACHE.get(query['cache_key'], alias=raw_key)
+            if cached is not None:
+                tracing.annotate(cached=True)
+                return cached, None
+            query['snapshot'] = RESULT_CACHE.snapshot(template['tables'])
+        return None, query
+
+    def end_query(self, query):
+        """Runs after the plan, even when it failed: writes invalidate the cached reads of their tables."""
+        if not query['template']['select'] and query['explain'] != 'plan':
+            for table in query['template']['tables']:
+                RESULT_CACHE.invalidate(table)
+
+    def finish_query(self, request, query, final_result):
+        if query['explain'] == 'plan':
+            final_result = [{"QUERY PLAN": line} for line in explain_plan(query['template']['plan'], query['params_json'])]
+        elif query['explain'] == 'analyze':
+            final_result = [{"QUERY PLAN": line} for line in tracing.explain(tracing.current(), describe_step)]
+        if request.format == query_pb2.COLUMNAR:
+            response = query_pb2.QueryResponse(columns=columnar.encode_dicts(final_result))
+        else:
+            response = query_pb2.QueryResponse(result_json=json.dumps(final_result, default=str))
+        # Results that include an unreachable partition's error row are not cached.
+        if query['cache_key'] is not None and not any('error' in row for row in final_result):
+            RESULT_CACHE.put(query['cache_key'], response, response.ByteSize(), query['template']['tables'],
+                             query['snapshot'], alias=query['raw_key'])
+        return response
+
+    def error_response(self, e):
+        tracing.annotate(error=True, rejected=isinstance(e, Overloaded))
+        if isinstance(e, sqlglot.errors.ParseError):
+            return query_pb2.QueryResponse(result_json="[]", error=True, error_message=f"SQL Parsing Error: {e}")
+        print(f"FATAL ERROR in ExecuteQuery: {e}")
+        return query_pb2.QueryResponse(result_json="[]", error=True, error_message=str(e))
+
+    def prepare(self, sql):
+        """Returns the plan template for `sql` and the bind parameters to run it with."""
+        shape = None
+        if PLAN_CACHE.enabled:
+            shape = Shape(sql)
+            cached = PLAN_CACHE.lookup(shape)
+            tracing.annotate(plan_cache='hit' if cached is not None else 'miss')
+            if cached is not None:
+                return cached
+
+        parsed = sqlglot.parse_one(sql, read=DIALECT)
+        tables = sorted(set(extract_tables(parsed)))
+        is_select = isinstance(parsed, exp.Select)
+        positions = []
+        if shape is not None and is_select:
+            partition_keys = {METADATA[table]['partition_key'] for table in tables if table in METADATA}
+            positions = parameterize(parsed, shape, partition_keys)
+
+        plan = self.plan_query(parsed, sql)
+        if positions:
+            for step in plan:
+                if 'query' in step:
+                    step['query'] = escape_percent(step['query'])
+
+        template = {'plan': plan, 'tables': tables, 'select': is_select, 'cacheable': is_cacheable(parsed),
+                    'key': parsed.sql(dialect=DIALECT), 'class': classify(plan), 'cost': plan_cost(plan)}
+        if shape is not None and is_select:
+            PLAN_CACHE.store(shape, positions, template)
+        return template, {f"p{i}": shape.values[i] for i in positions}
+
+    def plan_query(self, parsed, sql):
+        if isinstance(parsed, exp.Select):
+            if any(parsed.find_all(exp.Join)):
+                return self.plan_join_query(parsed)
+            if is_aggregate_query(parsed) or is_distinct_query(parsed):
+                return self.plan_aggregate_query(parsed)
+            return self.plan_simple_query(parsed)
+        if isinstance(parsed, exp.Insert):
+            return self.plan_insert_query(parsed, sql)
+        return self.plan_simple_query(parsed)
 
     def plan_simple_query(self, parsed):
         tables = extract_tables(parsed)
         if not tables: raise Exception("No table found.")
         table_meta = METADATA.get(tables[0])
         if not table_meta: raise Exception(f"Table '{tables[0]}' not in METADATA.")
-        target_nodes = list(table_meta['nodes'].values())
-        return [{'type': 'broadcast', 'nodes': target_nodes, 'query': parsed.sql(), 'params': None}]
+        target_nodes = target_nodes_for(parsed, tables[0])
+        return self.plan_fan_out(parsed, target_nodes, table_meta['columns'])
+
+    def plan_fan_out(self, parsed, nodes, columns):
+        """Runs a complete statement on every node in `nodes` and concatenates or merges the rows."""
+        if isinstance(parsed, exp.Select) and len(nodes) > 1 and (parsed.args.get('order') or parsed.args.get('limit')):
+            # Each shard returns its own sorted top LIMIT + OFFSET rows and the master merges them.
+            sort = DistributedSort(parsed, columns)
+            return [fan_out_step(nodes, sort.worker_query.sql(dialect=DIALECT), sort)]
+        return [fan_out_step(nodes, parsed.sql(dialect=DIALECT), read=isinstance(parsed, exp.Select))]
 
     def plan_aggregate_query(self, parsed):
         tables = extract_tables(parsed)
         if not tables: raise Exception("No table found.")
         table_meta = METADATA.get(tables[0])
-        target_nodes = list(table_meta['nodes'].values())
+        if not table_meta: raise Exception(f"Table '{tables[0]}' not in METADATA.")
+        if not is_aggregate_query(parsed):
+            parsed = group_distinct(parsed, table_meta['columns'])
+        return self.plan_two_phase_aggregate(AggregationPlan(parsed), target_nodes_for(parsed, tables[0]))
+
+    def plan_two_phase_aggregate(self, aggregation, nodes):
         return [
-            {'type': 'map_aggregate', 'nodes': target_nodes, 'query': parsed.sql(), 'params': None},
-            {'type': 'reduce_aggregate'}
+            {'type': 'map_aggregate', 'nodes': nodes, 'query': aggregation.worker_query.sql(dialect=DIALECT),
+             'params': None, 'aggregation': aggregation},
+            {'type': 'reduce_aggregate', 'aggregation': aggregation}
         ]
 
     def plan_join_query(self, parsed):
-        tables = extract_tables(parsed)
+        join_plan = JoinPlan(parsed, METADATA)
+        # Rows each source is estimated to return, None for sources without statistics.
+        estimates = {}
+        for source in join_plan.sources:
+            partitions = prune_partitions(source.meta, source.where(), {source.qualifier})
+            estimates[source.qualifier] = STATISTICS.estimate_rows(source, partitions)
+        order = STATISTICS.join_order(join_plan, estimates)
+        if order:
+            join_plan.reorder(order)
+        return self.plan_worker_join(join_plan, estimates) or self.plan_master_join(join_plan, estimates=estimates)
+
+    def plan_worker_join(self, join_plan, estimates=None):
+        """
+        Pushes a two-table join down to the workers, partition-wise or by broadcasting
+        the smaller side, or returns None when the master has to join.
+        """
+        parsed = join_plan.parsed
+        if len(join_plan.sources) != 2 or parsed.args.get('distinct') or parsed.args.get('with') \
+                or any(parsed.find_all(exp.Subquery)):
+            return None
+        how = join_plan.joins[0]['how']
+        left, right = join_plan.sources
+        partitions = {source.qualifier: prune_partitions(source.meta, source.where(), {source.qualifier})
+                      for source in join_plan.sources}
+
+        if how != 'FULL' and join_plan.joins_on_partition_key() and same_partitioning(left.meta, right.meta):
+            # The preserved side of an outer join anchors it, since its partitions all have to be visited.
+            anchor, shipped = (right, left) if how == 'RIGHT' else (left, right)
+            live = [p for p in partitions[anchor.qualifier]
+                    if how != 'INNER' or p in partitions[shipped.qualifier]]
+            groups = {}
+            for partition, node in anchor.meta['nodes'].items():
+                groups.setdefault(node, []).append(partition)
+            nodes = nodes_for_partitions(anchor.meta, live)
+            if all(shipped.meta['nodes'][p] == node for node in nodes for p in groups[node]):
+                print(f"Co-located join of {left.qualifier} and {right.qualifier} on {nodes}")
+                if join_plan.aggregation is not None:
+                    # Each worker joins its own partitions, so it can also compute the partial aggregates.
+                    return self.plan_two_phase_aggregate(join_plan.aggregation, nodes)
+                columns = [column for source in join_plan.sources for column in source.meta['columns']]
+                return self.plan_fan_out(parsed, nodes, columns)
+            if join_plan.aggregation is not None:
+                return None
+
+            ship = ShippedJoin(join_plan, shipped, DIALECT)
+            plan, targets = [], {}
+            for node in nodes:
+                key = f"{shipped.qualifier}@{node}"
+                wanted = [p for p in groups[node] if p in partitions[shipped.qualifier]]
+                plan.append({'type': 'fetch_for_join', 'table': key, 'nodes': nodes_for_partitions(shipped.meta, wanted),
+                             'query': ship.fetch_query, 'params': None})
+                targets[node] = key
+            plan.append({'type': 'ship_join', 'ship': ship, 'targets': targets, 'max_rows': None,
+                         'fallback': self.plan_master_join(join_plan)})
+            return plan
+
+        candidates = {'INNER': [right, left], 'LEFT': [right], 'RIGHT': [left]}.get(how)
+        # Shipped joins return joined rows; the master aggregates its own join's rows instead.
+        if not candidates or join_plan.aggregation is not None:
+            return None
+        estimates = estimates or {}
+        if estimates.get(left.qualifier) is not None and estimates.get(right.qualifier) is not None:
+            shipped = min(candidates, key=lambda source: estimates[source.qualifier])
+            anchor = left if shipped is right else right
+            anchors = len(nodes_for_partitions(anchor.meta, partitions[anchor.qualifier]))
+            joined = STATISTICS.join_rows(join_plan, estimates, [left.qualifier], right.qualifier)
+            if how != 'INNER':
+                joined = max(joined, estimates[anchor.qualifier])
+            broadcast = broadcast_cost(estimates[shipped.qualifier], anchors, joined)
+            pull = pull_cost(estimates[left.qualifier] + estimates[right.qualifier], joined)
+            if estimates[shipped.qualifier] > BROADCAST_JOIN_ROWS or pull < broadcast:
+                print(f"Joining {left.qualifier} and {right.qualifier} on master (cost {pull:.0f} vs. broadcast {broadcast:.0f})")
+                return None
+        else:
+            # A side with pushed-down filters is the more likely one to be small.
+            shipped = max(candidates, key=lambda source: bool(source.filters))
+            anchor = left if shipped is right else right
+        ship = ShippedJoin(join_plan, shipped, DIALECT)
+        return [
+            {'type': 'fetch_for_join', 'table': shipped.qualifier,
+             'nodes': nodes_for_partitions(shipped.meta, partitions[shipped.qualifier]),
+             'query': ship.fetch_query, 'params': None, 'estimated_rows': estimates.get(shipped.qualifier)},
+            {'type': 'ship_join', 'ship': ship, 'max_rows': BROADCAST_JOIN_ROWS,
+             'targets': {node: shipped.qualifier for node in nodes_for_partitions(anchor.meta, partitions[anchor.qualifier])},
+             'fallback': self.plan_master_join(join_plan, fetched={shipped.qualifier}, estimates=estimates)}
+        ]
+
+    def plan_master_join(self, join_plan, fetched=(), estimates=None):
+        """Fetches every source (except those already `fetched`) and joins them on the master."""
+        estimates = estimates or {}
         plan = []
-        for table in tables:
-            table_meta = METADATA.get(table)
-            if not table_meta: raise Exception(f"Table '{table}' not in METADATA.")
-            nodes = list(table_meta['nodes'].values())
+        for source, reducer in join_plan.semi_joins(fetched, estimates):
+            if source.qualifier in fetched:
+                continue
+            partitions = prune_partitions(source.meta, source.where(), {source.qualifier})
             plan.append({
                 'type': 'fetch_for_join',
-                'table': table,
-                'nodes': nodes,
-                'query': f"SELECT * FROM {table};",
-                'params': None
+                'table': source.qualifier,
+                'nodes': nodes_for_partitions(source.meta, partitions),
+                'query': source.fetch_query().sql(dialect=DIALECT),
+                'params': None,
+                'semi_join': SemiJoin(source, reducer[2], reducer[0], reducer[1], DIALECT, SEMI_JOIN_MAX_KEYS) if reducer else None,
+                'estimated_rows': estimates.get(source.qualifier)
             })
-        plan.append({'type': 'master_hash_join', 'tables': tables})
+        plan.append({
+            'type': 'master_hash_join',
+            'tables': [source.qualifier for source in join_plan.sources],
+            'join': join_plan
+        })
+        plan.append({'type': 'master_project', 'join': join_plan})
         return plan
 
     def plan_insert_query(self, parsed, sql):
@@ -129,15 +1175,12 @@ class MasterServicer(query_pb2_grpc.MasterServiceServicer):
         if table_name not in METADATA:
              raise Exception(f"Table '{table_name}' unknown.")
 
-        partition_key = METADATA[table_name]['partition_key']
-        
         try:
             table_exp = parsed.args.get('this')
             if not table_exp or not table_exp.this:
                 raise Exception("Table not found in AST.")
             
-            columns = []
-            if 'expressions' in table_exp.args:
+            if isinstance(table_exp, exp.Schema) and table_exp.expressions:
                 columns = [col.name for col in table_exp.expressions]
             else:
                 raise Exception("Column list is required for routing.")
@@ -145,127 +1188,281 @@ class MasterServicer(query_pb2_grpc.MasterServiceServicer):
             values_clause = parsed.expression
             if not values_clause or not isinstance(values_clause, exp.Values):
                 raise Exception("VALUES clause not found.")
-            
-            tup = values_clause.expressions[0]
-            clean_values = []
-            for val_exp in tup.expressions:
-                if isinstance(val_exp, exp.Literal):
-                    clean_values.append(val_exp.this)
-                else:
-                    clean_values.append(str(val_exp))
-                    
-            if len(columns) != len(clean_values):
-                 raise Exception(f"Column count ({len(columns)}) does not match value count ({len(clean_values)}).")
-            
-            col_val_map = dict(zip(columns, clean_values))
-            
-            if partition_key not in col_val_map:
-                 raise Exception(f"Partition key '{partition_key}' must be provided in INSERT.")
-            
-            partition_value = col_val_map[partition_key]
-            
-            target_node = None
-            nodes_map = METADATA[table_name]['nodes']
-            
-            if table_name == 'sales':
-                try:
-                    sale_date = datetime.strptime(str(partition_value), '%Y-%m-%d')
-                    if sale_date.month <= 6:
-                        target_node = nodes_map['H1']
-                    else:
-                        target_node = nodes_map['H2']
-                except ValueError:
-                     raise Exception(f"Invalid date format for partition key: {partition_value}. Use YYYY-MM-DD.")
-            else:
-                if partition_value in nodes_map:
-                    target_node = nodes_map[partition_value]
-            
-            if not target_node:
-                raise Exception(f"Could not route INSERT for {partition_key}='{partition_value}'. Available nodes: {list(nodes_map.keys())}")
-                
-            placeholders = ', '.join(['%s'] * len(clean_values))
-            col_str = ', '.join(columns)
-            param_query = f"INSERT INTO {table_name} ({col_str}) VALUES ({placeholders})"
-            
-            return [{'type': 'direct_insert', 'node': target_node, 'query': param_query, 'params': json.dumps(clean_values)}]
+            if parsed.args.get('returning') or parsed.args.get('conflict'):
+                raise Exception("RETURNING and ON CONFLICT are not supported in distributed INSERTs.")
+
+            # Every tuple is routed to its shard, and each shard gets one batch per BULK_BATCH_ROWS rows.
+            loader = BulkLoader(table_name, METADATA[table_name], columns, BULK_BATCH_ROWS)
+            batches = []
+            for tup in values_clause.expressions:
+                batch = loader.add(literal_row(tup))
+                if batch:
+                    batches.append(batch)
+            batches.extend(loader.flush())
+            return [{'type': 'bulk_insert', 'table': table_name, 'batches': batches}]
 
         except Exception as e:
              raise Exception(f"Error planning INSERT: {e}")
 
-    def execute_plan(self, plan):
-        context_data = {}
+    def execute_plan(self, plan, params_json=None, context_data=None):
+        if context_data is None:
+            with MEMORY.query():
+                return self.execute_plan(plan, params_json, {})
         final_result = []
 
         with futures.ThreadPoolExecutor() as executor:
             for step in plan:
                 step_type = step['type']
+                with tracing.span(step_type, step=step) as span:
+                    if step_type == 'broadcast':
+                        limit, offset = step.get('limit'), step.get('offset') or 0
+                        for batch in gather_partition_batches(executor, step['nodes'], step['query'],
+                                                              step.get('params') or params_json, step.get('read', False)):
+                            final_result.extend(batch)
+                            if limit is not None and len(final_result) >= limit + offset:
+                                break
+                        if limit is not None or offset:
+                            final_result = apply_limit(final_result, limit, offset)
+
+                    elif step_type == 'merge_sorted':
+                        sort = step['sort']
+                        rows = merge_partition_streams(step['nodes'], step['query'], step.get('params') or params_json,
+                                                       sort.keys, sort.limit, sort.offset)
+                        final_result.extend(sort.strip(rows))
                 
-                if step_type == 'broadcast':
-                    tasks = {executor.submit(send_query_to_worker, node, step['query'], step.get('params')): node for node in step['nodes']}
-                    for future in futures.as_completed(tasks):
-                        final_result.extend(future.result())
+                    elif step_type == 'bulk_insert':
+                        print(f"Routing INSERT into {step['table']} as {len(step['batches'])} batch(es)")
+                        results = executor.map(tracing.bind(lambda batch: send_bulk_insert_to_worker(*batch)), step['batches'])
+                        final_result.extend(summarize_inserts([row for result in results for row in result]))
+
+                    elif step_type == 'fetch_for_join':
+                        table_name = step['table']
+                        context_data[table_name] = memory.RowBuffer(memory.current())
+                        query, params = semi_join_query(step, context_data, params_json)
+                        for batch in gather_partition_batches(executor, step['nodes'], query, params, read=True):
+                            if batch and 'error' in batch[0]:
+                                raise Exception(f"Fetching '{table_name}' for join failed: {batch[0]['error']}")
+                            context_data[table_name].extend(batch)
+
+                    elif step_type == 'ship_join':
+                        fan_out = ship_join_step(step, context_data)
+                        if fan_out is None:
+                            final_result = self.execute_plan(step['fallback'], params_json, context_data)
+                        elif fan_out['nodes']:
+                            final_result = self.execute_plan([fan_out], params_json, context_data)
+
+                    elif step_type == 'master_hash_join':
+                        print("Performing hash join on master node...")
+                        final_result = step['join'].join([context_data[table] for table in step['tables']], memory.current())
+
+                    elif step_type == 'master_project':
+                        final_result = step['join'].project(final_result, memory.current())
+
+                    elif step_type == 'map_aggregate':
+                        aggregation = step['aggregation']
+                        groups = aggregation.new_state()
+                        merging = 0.0
+                        for batch in gather_partition_batches(executor, step['nodes'], step['query'],
+                                                              step.get('params') or params_json, read=True):
+                            started = time.perf_counter()
+                            aggregation.merge(groups, batch)
+                            merging += time.perf_counter() - started
+                        context_data['aggs'] = groups
+                        tracing.annotate(merge_ms=round(merging * 1000, 3))
                 
-                elif step_type == 'direct_insert':
-                    node = step['node']
-                    print(f"Routing INSERT to {node}")
-                    res = send_query_to_worker(node, step['query'], step.get('params'))
-                    
-                    if isinstance(res, list):
-                        final_result.extend(res)
-                    else:
-                         final_result.append(res)
+                    elif step_type == 'reduce_aggregate':
+                        final_result = step['aggregation'].finalize(context_data.get('aggs', {}))
+
+                    if span is not None:
+                        span.set(rows=step_rows(step, final_result, context_data))
+        return final_result
+
+class AsyncMasterServicer(MasterServicer):
+    """MasterServicer for grpc.aio, running the sub-queries of a step as tasks on the event loop."""
+    async def ExecuteQuery(self, request, context):
+        with tracing.query(query_id_for(context), request.sql, SLOW_QUERY_MS, describe_step):
+            try:
+                response, query = self.begin_query(request)
+                if response is not None:
+                    return response
+                timeout = QUERY_TIMEOUT_SECONDS or None
+                remaining = context.time_remaining() if context is not None else None
+                if remaining is not None:
+                    timeout = min(timeout, remaining) if timeout else remaining
+                deadline = asyncio.get_running_loop().time() + timeout if timeout else None
+                if query['flight_key'] is None:
+                    return await self.run_query_async(request, context, query, timeout, deadline)
+                # A query sharing another one's execution still answers by its own deadline.
+                try:
+                    async with asyncio.timeout_at(deadline):
+                        response, shared = await QUERY_FLIGHTS.do_async(
+                            query['flight_key'], lambda: self.run_query_async(request, context, query, timeout, deadline))
+                except TimeoutError:
+                    raise Exception(f"Query exceeded its deadline of {timeout:g}s.")
+                if shared:
+                    tracing.annotate(coalesced=True)
+                return response
+            except Exception as e:
+                return self.error_response(e)
+
+    async def run_query_async(self, request, context, query, timeout, deadline):
+        final_result = []
+        try:
+            async with asyncio.timeout_at(deadline):
+                if query['explain'] != 'plan':
+                    async with ADMISSION.admitted_async(*admission_for(context, query['template'])) as waited:
+                        tracing.annotate(queued_ms=waited * 1000)
+                        final_result = await self.execute_plan_async(query['template']['plan'],
+                                                                     query['params_json'], deadline)
+        except TimeoutError:
+            raise Exception(f"Query exceeded its deadline of {timeout:g}s.")
+        finally:
+            self.end_query(query)
+        return self.finish_query(request, query, final_result)
+
+    async def BulkLoad(self, request_iterator, context):
+        session = BulkLoadSession(METADATA, BULK_BATCH_ROWS)
+        in_flight = deque()
+
+        async def send(batches):
+            for node, request in batches:
+                if len(in_flight) >= BULK_LOAD_INFLIGHT:
+                    done_node, task = in_flight.popleft()
+                    session.record(done_node, await task)
+                in_flight.append((node, asyncio.create_task(send_bulk_insert_to_worker_async(node, request))))
+
+        try:
+            async for message in request_iterator:
+                await send(session.feed(message))
+            await send(session.finish())
+            while in_flight:
+                node, task = in_flight.popleft()
+                session.record(node, await task)
+            print(f"Bulk load into {session.table} finished: {session.rows_loaded} rows")
+            return query_pb2.BulkLoadResponse(rows_loaded=session.rows_loaded)
+        except Exception as e:
+            print(f"FATAL ERROR in BulkLoad: {e}")
+            return query_pb2.BulkLoadResponse(rows_loaded=session.rows_loaded, error=True, error_message=str(e))
+        finally:
+            # Batches already sent are allowed to finish; their rows are committed either way.
+            await asyncio.gather(*[task for _, task in in_flight], return_exceptions=True)
+            if session.table:
+                RESULT_CACHE.invalidate(session.table)
+
+    async def execute_plan_async(self, plan, params_json=None, deadline=None, context_data=None):
+        if context_data is None:
+            with MEMORY.query():
+                return await self.execute_plan_async(plan, params_json, deadline, {})
+        final_result = []
+
+        for step in plan:
+            step_type = step['type']
+            with tracing.span(step_type, step=step) as span:
+                params = step.get('params') or params_json
+
+                if step_type == 'broadcast':
+                    limit, offset = step.get('limit'), step.get('offset') or 0
+
+                    def take(node, batch):
+                        final_result.extend(batch)
+                        return limit is None or len(final_result) < limit + offset
+
+                    await fan_out_async(step['nodes'], step['query'], params, take, deadline, step.get('read', False))
+                    if limit is not None or offset:
+                        final_result = apply_limit(final_result, limit, offset)
+
+                elif step_type == 'merge_sorted':
+                    # Shards already return at most LIMIT + OFFSET sorted rows, so each run is buffered whole.
+                    sort = step['sort']
+                    runs = {node: [] for node in step['nodes']}
+
+                    def collect(node, batch):
+                        if batch and 'error' in batch[0]:
+                            raise Exception(f"Sorted read from {node} failed: {batch[0]['error']}")
+                        runs[node].extend(batch)
+
+                    await fan_out_async(step['nodes'], step['query'], params, collect, deadline, read=True)
+                    rows = merge_sorted_runs(list(runs.values()), sort.keys, sort.limit, sort.offset)
+                    final_result.extend(sort.strip(rows))
+
+                elif step_type == 'bulk_insert':
+                    print(f"Routing INSERT into {step['table']} as {len(step['batches'])} batch(es)")
+                    results = await asyncio.gather(*[send_bulk_insert_to_worker_async(node, request, deadline)
+                                                     for node, request in step['batches']])
+                    final_result.extend(summarize_inserts([row for result in results for row in result]))
 
                 elif step_type == 'fetch_for_join':
                     table_name = step['table']
-                    tasks = {executor.submit(send_query_to_worker, node, step['query'], step.get('params')): node for node in step['nodes']}
-                    context_data[table_name] = []
-                    for future in futures.as_completed(tasks):
-                        context_data[table_name].extend(future.result())
+                    rows = context_data[table_name] = memory.RowBuffer(memory.current())
+                    query, params = semi_join_query(step, context_data, params)
+
+                    def fetch(node, batch, table_name=table_name, rows=rows):
+                        if batch and 'error' in batch[0]:
+                            raise Exception(f"Fetching '{table_name}' for join failed: {batch[0]['error']}")
+                        rows.extend(batch)
+
+                    await fan_out_async(step['nodes'], query, params, fetch, deadline, read=True)
+
+                elif step_type == 'ship_join':
+                    fan_out = ship_join_step(step, context_data)
+                    if fan_out is None:
+                        final_result = await self.execute_plan_async(step['fallback'], params_json, deadline, context_data)
+                    elif fan_out['nodes']:
+                        final_result = await self.execute_plan_async([fan_out], params_json, deadline, context_data)
 
                 elif step_type == 'master_hash_join':
                     print("Performing hash join on master node...")
-                    tables = step['tables']
-                    if len(tables) < 2 or tables[0] not in context_data: continue
-                    joined_results = context_data[tables[0]]
-                    for i in range(1, len(tables)):
-                        next_table = tables[i]
-                        if next_table not in context_data: continue
-                        
-                        current_keys = set(joined_results[0].keys()) if joined_results else set()
-                        next_keys = set(context_data[next_table][0].keys()) if context_data[next_table] else set()
-                        join_key = list(current_keys.intersection(next_keys))
-                        if not join_key: continue
-                        join_key = join_key[0]
-
-                        hash_map = {row[join_key]: row for row in context_data[next_table]}
-                        new_joined = []
-                        for row in joined_results:
-                            val = row.get(join_key)
-                            if val in hash_map:
-                                new_joined.append({**row, **hash_map[val]})
-                        joined_results = new_joined
-                    final_result = joined_results
+                    final_result = step['join'].join([context_data[table] for table in step['tables']], memory.current())
+
+                elif step_type == 'master_project':
+                    final_result = step['join'].project(final_result, memory.current())
 
                 elif step_type == 'map_aggregate':
-                    tasks = [executor.submit(send_query_to_worker, node, step['query'], step.get('params')) for node in step['nodes']]
-                    intermediate = []
-                    for future in futures.as_completed(tasks):
-                        res = future.result()
-                        if res and isinstance(res, list) and res[0] and 'error' not in res[0]:
-                             val = next(iter(res[0].values()))
-                             if val is not None:
-                                intermediate.append(int(val))
-                    context_data['aggs'] = intermediate
-                
+                    aggregation = step['aggregation']
+                    groups = aggregation.new_state()
+                    merging = [0.0]
+
+                    def merge(node, batch):
+                        started = time.perf_counter()
+                        aggregation.merge(groups, batch)
+                        merging[0] += time.perf_counter() - started
+
+                    await fan_out_async(step['nodes'], step['query'], params, merge, deadline, read=True)
+                    context_data['aggs'] = groups
+                    tracing.annotate(merge_ms=round(merging[0] * 1000, 3))
+
                 elif step_type == 'reduce_aggregate':
-                    total = sum(context_data.get('aggs', [0]))
-                    final_result = [{'final_aggregate': total}]
+                    final_result = step['aggregation'].finalize(context_data.get('aggs', {}))
+
+                if span is not None:
+                    span.set(rows=step_rows(step, final_result, context_data))
         return final_result
 
+async def serve_async():
+    server = grpc.aio.server()
+    query_pb2_grpc.add_MasterServiceServicer_to_server(AsyncMasterServicer(), server)
+    server.add_insecure_port('[::]:50050')
+    ASYNC_CHANNELS.connect(address for meta in METADATA.values() for address in meta['nodes'].values())
+    print("Master node server (asyncio) started on port 50050. Listening for client...")
+    await server.start()
+    try:
+        await server.wait_for_termination()
+    finally:
+        await ASYNC_CHANNELS.aclose()
+
 def serve():
-    server = grpc.server(futures.ThreadPoolExecutor(max_workers=10))
+    if METRICS_PORT:
+        serve_metrics(METRICS_PORT)
+        print(f"Master metrics served on port {METRICS_PORT} at /metrics")
+    start_statistics_refresh()
+    if MASTER_MODE == 'async':
+        asyncio.run(serve_async())
+        return
+
+    server = grpc.server(futures.ThreadPoolExecutor(max_workers=MASTER_THREADS), maximum_concurrent_rpcs=MASTER_THREADS)
     query_pb2_grpc.add_MasterServiceServicer_to_server(MasterServicer(), server)
     server.add_insecure_port('[::]:50050')
+    CHANNELS.connect(address for meta in METADATA.values() for address in meta['nodes'].values())
     print("Master node server started on port 50050. Listening for client...")
     server.start()
     server.wait_for_termination()
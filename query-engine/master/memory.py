@@ -0,0 +1,265 @@
+"""
+Memory budgets for the master-side operators: rows past a query's work memory
+spill to disk, and a query fails past its memory or spill limit.
+"""
+import contextvars
+import mmap
+import pickle
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+
+import tracing
+from protos.metrics import Counter
+
+# Rows written to a partition's spill file at a time.
+PARTITION_CHUNK_ROWS = 1000
+
+SPILLED_BYTES = Counter('dqps_master_spilled_bytes_total', "Bytes written to spill files by master operators.")
+SPILLS = Counter('dqps_master_spills_total', "Row buffers moved to disk, by operator.", ('operator',))
+LIMIT_ERRORS = Counter('dqps_master_memory_limit_errors_total', "Queries failed for exceeding a memory or spill limit.",
+                       ('limit',))
+
+_CURRENT = contextvars.ContextVar('dqps_query_memory', default=None)
+
+def current():
+    """The QueryMemory of the running query, or None outside of one."""
+    return _CURRENT.get()
+
+def _size(value):
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(_size(item) for item in value.values())
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(_size(item) for item in value)
+    return sys.getsizeof(value)
+
+def estimate_bytes(rows):
+    """The memory `rows` take, extrapolated from the first one."""
+    return _size(rows[0]) * len(rows) if rows else 0
+
+def _megabytes(nbytes):
+    return f"{nbytes / 2 ** 20:g} MB"
+
+class MemoryPool:
+    """The memory budget shared by all queries, and the work_mem, memory and spill limits of each."""
+    def __init__(self, limit, work_mem, memory_limit, spill_limit, directory=None, partitions=32):
+        self.limit = limit
+        self.work_mem = work_mem
+        self.memory_limit = memory_limit
+        self.spill_limit = spill_limit
+        self.directory = directory or None
+        self.partitions = partitions
+        self._lock = threading.Lock()
+        self._used = 0
+        self._spilled = 0
+
+    def try_reserve(self, nbytes):
+        with self._lock:
+            if self._used + nbytes > self.limit:
+                return False
+            self._used += nbytes
+            return True
+
+    def reserve(self, nbytes):
+        """Reserves `nbytes` even past the limit, which makes the other queries spill."""
+        with self._lock:
+            self._used += nbytes
+
+    def release(self, nbytes):
+        with self._lock:
+            self._used -= nbytes
+
+    def add_spilled(self, nbytes):
+        with self._lock:
+            self._spilled += nbytes
+
+    def used(self):
+        with self._lock:
+            return self._used
+
+    def spilled(self):
+        with self._lock:
+            return self._spilled
+
+    @contextmanager
+    def query(self):
+        """The memory of one query, current inside the block; everything it holds is freed on exit."""
+        if _CURRENT.get() is not None:
+            yield _CURRENT.get()
+            return
+        query_memory = QueryMemory(self)
+        token = _CURRENT.set(query_memory)
+        try:
+            yield query_memory
+        finally:
+            _CURRENT.reset(token)
+            query_memory.close()
+
+class QueryMemory:
+    """The memory reserved and the spill files written by one query."""
+    def __init__(self, pool):
+        self.pool = pool
+        self.partitions = pool.partitions
+        self.reserved = 0
+        self.peak = 0
+        self.spilled = 0        # bytes in the query's spill files now
+        self.spilled_total = 0
+        self._files = []
+        self._lock = threading.Lock()
+
+    def _reserved(self, nbytes):
+        self.reserved += nbytes
+        self.peak = max(self.peak, self.reserved)
+
+    def reserve(self, nbytes):
+        """Reserves `nbytes`; False when the query should spill instead."""
+        with self._lock:
+            if self.reserved + nbytes > self.pool.work_mem or not self.pool.try_reserve(nbytes):
+                return False
+            self._reserved(nbytes)
+            return True
+
+    def hold(self, nbytes):
+        """Reserves `nbytes` that cannot be spilled, failing the query past its memory limit."""
+        with self._lock:
+            if self.reserved + nbytes > self.pool.memory_limit:
+                LIMIT_ERRORS.inc(limit='memory')
+                raise Exception(f"Query exceeded its memory limit of {_megabytes(self.pool.memory_limit)}.")
+            self.pool.reserve(nbytes)
+            self._reserved(nbytes)
+
+    def release(self, nbytes):
+        with self._lock:
+            self.reserved -= nbytes
+        self.pool.release(nbytes)
+
+    def spill_file(self):
+        spill_file = SpillFile(self)
+        with self._lock:
+            self._files.append(spill_file)
+        return spill_file
+
+    def _spill(self, nbytes):
+        with self._lock:
+            if self.spilled + nbytes > self.pool.spill_limit:
+                LIMIT_ERRORS.inc(limit='spill')
+                raise Exception(f"Query exceeded its spill limit of {_megabytes(self.pool.spill_limit)}.")
+            self.spilled += nbytes
+            self.spilled_total += nbytes
+        self.pool.add_spilled(nbytes)
+        SPILLED_BYTES.inc(nbytes)
+
+    def _unspill(self, nbytes):
+        with self._lock:
+            self.spilled -= nbytes
+        self.pool.add_spilled(-nbytes)
+
+    def close(self):
+        with self._lock:
+            files, self._files = self._files, []
+            reserved, self.reserved = self.reserved, 0
+        for spill_file in files:
+            spill_file.close()
+        self.pool.release(reserved)
+        if self.spilled_total:
+            tracing.annotate(memory_peak=self.peak, spilled=self.spilled_total)
+        elif self.peak:
+            tracing.annotate(memory_peak=self.peak)
+
+class SpillFile:
+    """Chunks of rows pickled into an anonymous temporary file, and read back through mmap."""
+    def __init__(self, memory):
+        self.memory = memory
+        self.file = tempfile.TemporaryFile(prefix='dqps-spill-', dir=memory.pool.directory)
+        self.size = 0
+        self._chunks = []       # (offset, length) of every chunk
+
+    def write(self, rows):
+        if not rows:
+            return
+        data = pickle.dumps(rows, pickle.HIGHEST_PROTOCOL)
+        self.memory._spill(len(data))
+        self.file.write(data)
+        self._chunks.append((self.size, len(data)))
+        self.size += len(data)
+
+    def chunks(self):
+        """The written chunks, in order, each a list of rows."""
+        if not self.size:
+            return
+        self.file.flush()
+        with mmap.mmap(self.file.fileno(), self.size, access=mmap.ACCESS_READ) as view:
+            for offset, length in self._chunks:
+                yield pickle.loads(view[offset:offset + length])
+
+    def close(self):
+        if not self.file.closed:
+            self.file.close()
+            self.memory._unspill(self.size)
+
+class RowBuffer:
+    """Rows held for a master operator, in memory while the query's budget allows and then in a spill file."""
+    def __init__(self, memory, operator='join'):
+        self.memory = memory
+        self.operator = operator
+        self.rows = []
+        self.file = None
+        self.count = 0
+        self._reserved = 0
+
+    @property
+    def spilled(self):
+        return self.file is not None
+
+    def extend(self, rows):
+        if not rows:
+            return
+        self.count += len(rows)
+        if self.file is None:
+            nbytes = estimate_bytes(rows)
+            if self.memory.reserve(nbytes):
+                self._reserved += nbytes
+                self.rows.extend(rows)
+                return
+            SPILLS.inc(operator=self.operator)
+            self.file = self.memory.spill_file()
+            self.file.write(self.rows)
+            self.rows = []
+            self.memory.release(self._reserved)
+            self._reserved = 0
+        self.file.write(rows)
+
+    def chunks(self):
+        """The rows as lists of rows."""
+        if self.file is not None:
+            return self.file.chunks()
+        return iter([self.rows] if self.rows else [])
+
+    def tolist(self):
+        return self.rows if self.file is None else list(self)
+
+    def __iter__(self):
+        return (row for chunk in self.chunks() for row in chunk)
+
+    def __len__(self):
+        return self.count
+
+def partition(chunks, keys, memory, count=None):
+    """Spreads the rows of `chunks` over `count` spill files by the hash of their `keys`; NULL keys go to the first."""
+    count = count or memory.partitions
+    if not keys:
+        count = 1
+    files = [memory.spill_file() for _ in range(count)]
+    pending = [[] for _ in range(count)]
+    for rows in chunks:
+        for row in rows:
+            key = tuple(row.get(name) for name in keys)
+            target = 0 if None in key else hash(key) % count
+            pending[target].append(row)
+            if len(pending[target]) >= PARTITION_CHUNK_ROWS:
+                files[target].write(pending[target])
+                pending[target] = []
+    for spill_file, rows in zip(files, pending):
+        spill_file.write(rows)
+    return files
@@ -0,0 +1,42 @@
+"""
+Row operators that run on the master over lists of row dicts.
+"""
+import sqlglot.expressions as exp
+
+from expressions import compile_expression, default_resolve
+
+def order_keys(order, resolve=default_resolve, rewrite=None):
+    """Turns an exp.Order into a list of (evaluate, desc, nulls_first) sort keys."""
+    keys = []
+    for ordered in (order.expressions if order else []):
+        node = rewrite(ordered.this) if rewrite else ordered.this
+        keys.append((compile_expression(node, resolve), bool(ordered.args.get('desc')),
+                     bool(ordered.args.get('nulls_first'))))
+    return keys
+
+def sort_rows(rows, keys):
+    """Sorts rows in place by SQL sort keys."""
+    for evaluate, desc, nulls_first in reversed(keys):
+        nulls_high = desc == nulls_first
+
+        def sort_key(row, evaluate=evaluate, nulls_high=nulls_high):
+            value = evaluate(row)
+            return ((value is None) == nulls_high, value)
+
+        rows.sort(key=sort_key, reverse=desc)
+    return rows
+
+def literal_int(node):
+    if node is None:
+        return None
+    if isinstance(node, (exp.Limit, exp.Offset)):
+        node = node.expression
+    if isinstance(node, exp.Literal) and not node.is_string:
+        return int(node.this)
+    raise Exception(f"LIMIT/OFFSET must be an integer literal, got {node.sql()}")
+
+def apply_limit(rows, limit=None, offset=None):
+    start = offset or 0
+    if limit is None:
+        return rows[start:] if start else rows
+    return rows[start:start + limit]
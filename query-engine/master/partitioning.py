@@ -0,0 +1,262 @@
+"""
+Partition routing and pruning for the tables described in METADATA, which is
+loaded from a JSON config file giving each table a list, range, hash or
+consistent_hash scheme.
+"""
+import bisect
+import hashlib
+import json
+import sqlglot.expressions as exp
+from datetime import datetime
+from functools import lru_cache
+
+ALL = None  # "every partition" in pruning results
+DEFAULT_VNODES = 64
+
+def coerce_key(table_meta, value):
+    key_type = table_meta.get('key_type')
+    if key_type == 'date':
+        return datetime.strptime(str(value), '%Y-%m-%d').date()
+    if key_type == 'int':
+        return int(value)
+    return str(value)
+
+def stable_hash(value):
+    """A 64-bit hash that, unlike hash(), is the same in every process."""
+    return int.from_bytes(hashlib.blake2b(str(value).encode(), digest_size=8).digest(), 'big')
+
+@lru_cache(maxsize=None)
+def _hash_ring(partitions, vnodes):
+    points = sorted((stable_hash(f"{name}#{i}"), name) for name in partitions for i in range(vnodes))
+    return [point for point, _ in points], [name for _, name in points]
+
+class ListScheme:
+    def route(self, table_meta, value):
+        value = str(value)
+        return value if value in table_meta['nodes'] else None
+
+    def same(self, meta_a, meta_b):
+        return set(meta_a['nodes']) == set(meta_b['nodes'])
+
+class RangeScheme:
+    def route(self, table_meta, value):
+        key = coerce_key(table_meta, value)
+        for name, (lower, upper) in table_meta['ranges'].items():
+            if coerce_key(table_meta, lower) <= key < coerce_key(table_meta, upper):
+                return name
+        return None
+
+    def same(self, meta_a, meta_b):
+        return (set(meta_a['nodes']) == set(meta_b['nodes']) and meta_a.get('key_type') == meta_b.get('key_type')
+                and meta_a['ranges'] == meta_b['ranges'])
+
+class HashScheme:
+    def route(self, table_meta, value):
+        partitions = list(table_meta['nodes'])
+        return partitions[stable_hash(coerce_key(table_meta, value)) % len(partitions)]
+
+    def same(self, meta_a, meta_b):
+        # The partition a key lands in depends on the order of the partitions.
+        return list(meta_a['nodes']) == list(meta_b['nodes']) and meta_a.get('key_type') == meta_b.get('key_type')
+
+class ConsistentHashScheme:
+    def route(self, table_meta, value):
+        points, names = _hash_ring(tuple(table_meta['nodes']), table_meta.get('vnodes', DEFAULT_VNODES))
+        return names[bisect.bisect(points, stable_hash(coerce_key(table_meta, value))) % len(points)]
+
+    def same(self, meta_a, meta_b):
+        return (set(meta_a['nodes']) == set(meta_b['nodes']) and meta_a.get('key_type') == meta_b.get('key_type')
+                and meta_a.get('vnodes', DEFAULT_VNODES) == meta_b.get('vnodes', DEFAULT_VNODES))
+
+# partition_type -> scheme; a new scheme only needs route() and same().
+SCHEMES = {
+    'list': ListScheme(),
+    'range': RangeScheme(),
+    'hash': HashScheme(),
+    'consistent_hash': ConsistentHashScheme(),
+}
+
+def load_metadata(path):
+    """Reads and validates the table/partition config at `path`."""
+    with open(path) as f:
+        metadata = json.load(f)
+    for table, table_meta in metadata.items():
+        for field in ('partition_key', 'columns', 'nodes'):
+            if field not in table_meta:
+                raise Exception(f"Table '{table}' in {path} has no '{field}'.")
+        if not table_meta['nodes']:
+            raise Exception(f"Table '{table}' in {path} has no partitions.")
+        kind = table_meta.get('partition_type')
+        if kind is not None and kind not in SCHEMES:
+            raise Exception(f"Table '{table}' has unknown partition_type '{kind}'; expected one of {list(SCHEMES)}.")
+        if kind == 'range' and set(table_meta.get('ranges', {})) != set(table_meta['nodes']):
+            raise Exception(f"Table '{table}' needs a range for every partition.")
+        if set(table_meta.get('column_types', {})) - set(table_meta['columns']):
+            raise Exception(f"Table '{table}' has column_types for unknown columns.")
+        replicas = table_meta.get('replicas', {})
+        if set(replicas) - set(table_meta['nodes']):
+            raise Exception(f"Table '{table}' has replicas for unknown partitions {sorted(set(replicas) - set(table_meta['nodes']))}.")
+        if not all(isinstance(addresses, list) for addresses in replicas.values()):
+            raise Exception(f"Table '{table}' must list each partition's replicas as an array of addresses.")
+    replica_groups(metadata)
+    return metadata
+
+def replica_groups(metadata):
+    """{primary address: [primary, replica, ...]} for every worker."""
+    groups = {}
+    for table, table_meta in metadata.items():
+        replicas = table_meta.get('replicas', {})
+        for partition, address in table_meta['nodes'].items():
+            group = [address] + [replica for replica in replicas.get(partition, []) if replica != address]
+            if groups.setdefault(address, group) != group:
+                raise Exception(f"Partition '{partition}' of '{table}' lists other replicas for {address} "
+                                f"than the worker's other partitions ({groups[address][1:]}).")
+    return groups
+
+def route_partition(table_meta, value):
+    """Returns the name of the partition that holds `value`, or None."""
+    scheme = SCHEMES.get(table_meta.get('partition_type'))
+    return scheme.route(table_meta, value) if scheme else None
+
+def partitions_in_range(table_meta, low=None, high=None, high_inclusive=True):
+    """Partitions whose key range can overlap [low, high]."""
+    if table_meta.get('partition_type') != 'range':
+        return ALL
+    matches = set()
+    for name, (lower, upper) in table_meta['ranges'].items():
+        lower, upper = coerce_key(table_meta, lower), coerce_key(table_meta, upper)
+        if low is not None and upper <= low:
+            continue
+        if high is not None and (lower > high or (lower == high and not high_inclusive)):
+            continue
+        matches.add(name)
+    return matches
+
+def _literal_value(node):
+    while isinstance(node, (exp.Cast, exp.Paren)):
+        node = node.this
+    if isinstance(node, exp.Neg) and isinstance(node.this, exp.Literal):
+        return f"-{node.this.this}"
+    if isinstance(node, exp.Literal):
+        return node.this
+    raise ValueError(f"Not a literal: {node}")
+
+def _is_key(node, partition_key, qualifiers):
+    return (isinstance(node, exp.Column) and node.name == partition_key
+            and (not node.table or node.table in qualifiers))
+
+def _intersect(a, b):
+    if a is ALL:
+        return b
+    if b is ALL:
+        return a
+    return a & b
+
+def _union(a, b):
+    if a is ALL or b is ALL:
+        return ALL
+    return a | b
+
+def _key_bound(node, partition_key, qualifiers):
+    """Returns (op, value) for a comparison of the partition key with a literal, or None."""
+    flipped = {exp.GT: exp.LT, exp.GTE: exp.LTE, exp.LT: exp.GT, exp.LTE: exp.GTE, exp.EQ: exp.EQ}
+    if type(node) not in flipped:
+        return None
+    op = type(node)
+    left, right = node.this, node.expression
+    if _is_key(right, partition_key, qualifiers):
+        left, right, op = right, left, flipped[op]
+    if not _is_key(left, partition_key, qualifiers):
+        return None
+    try:
+        return op, _literal_value(right)
+    except ValueError:
+        return None
+
+def _prune(node, table_meta, qualifiers):
+    partition_key = table_meta['partition_key']
+
+    if isinstance(node, exp.Paren):
+        return _prune(node.this, table_meta, qualifiers)
+
+    if isinstance(node, exp.Or):
+        return _union(_prune(node.this, table_meta, qualifiers),
+                      _prune(node.expression, table_meta, qualifiers))
+
+    if isinstance(node, exp.And):
+        # Range bounds on the key are merged across the conjunction so that
+        # `key >= a AND key < b` prunes like a single BETWEEN.
+        result = ALL
+        low = high = None
+        high_inclusive = True
+        for conjunct in node.flatten():
+            bound = _key_bound(conjunct, partition_key, qualifiers)
+            if bound and bound[0] is not exp.EQ:
+                op, value = bound
+                try:
+                    value = coerce_key(table_meta, value)
+                except ValueError:
+                    continue
+                if op in (exp.GT, exp.GTE):
+                    low = value if low is None else max(low, value)
+                elif high is None or value < high or (value == high and op is exp.LT):
+                    high, high_inclusive = value, op is exp.LTE
+            else:
+                result = _intersect(result, _prune(conjunct, table_meta, qualifiers))
+        if low is not None or high is not None:
+            result = _intersect(result, partitions_in_range(table_meta, low, high, high_inclusive))
+        return result
+
+    try:
+        bound = _key_bound(node, partition_key, qualifiers)
+        if bound:
+            op, value = bound
+            if op is exp.EQ:
+                name = route_partition(table_meta, value)
+                return {name} if name else set()
+            value = coerce_key(table_meta, value)
+            if op in (exp.GT, exp.GTE):
+                return partitions_in_range(table_meta, low=value)
+            return partitions_in_range(table_meta, high=value, high_inclusive=op is exp.LTE)
+
+        if isinstance(node, exp.In) and _is_key(node.this, partition_key, qualifiers) and not node.args.get('query'):
+            names = set()
+            for value in node.expressions:
+                name = route_partition(table_meta, _literal_value(value))
+                if name:
+                    names.add(name)
+            return names
+
+        if isinstance(node, exp.Between) and _is_key(node.this, partition_key, qualifiers):
+            low = coerce_key(table_meta, _literal_value(node.args['low']))
+            high = coerce_key(table_meta, _literal_value(node.args['high']))
+            return partitions_in_range(table_meta, low, high)
+    except ValueError:
+        return ALL
+
+    return ALL
+
+def prune_partitions(table_meta, where, qualifiers=()):
+    """Returns the names of the partitions of a table that can hold rows matching `where`, in METADATA order."""
+    names = list(table_meta['nodes'])
+    if where is None or 'partition_type' not in table_meta or table_meta.get('prunable') is False:
+        return names
+    if isinstance(where, exp.Where):
+        where = where.this
+    matches = _prune(where, table_meta, set(qualifiers))
+    if matches is ALL:
+        return names
+    return [name for name in names if name in matches]
+
+def nodes_for_partitions(table_meta, partitions):
+    """Distinct worker addresses serving `partitions`, in order."""
+    return list(dict.fromkeys(table_meta['nodes'][name] for name in partitions))
+
+def same_partitioning(meta_a, meta_b):
+    """True when equal keys of two tables always land in partitions with the same name."""
+    kind = meta_a.get('partition_type')
+    if kind not in SCHEMES or kind != meta_b.get('partition_type'):
+        return False
+    if meta_a.get('prunable') is False or meta_b.get('prunable') is False:
+        return False
+    return SCHEMES[kind].same(meta_a, meta_b)
@@ -0,0 +1,129 @@
+"""
+Plan cache for SELECTs that differ only in their literals: WHERE literals are
+bound as %(pN)s parameters, and the plan is cached by the query's masked text.
+"""
+import re
+import threading
+import sqlglot.expressions as exp
+from collections import OrderedDict
+
+LITERAL_PATTERN = re.compile(
+    r'"(?:[^"]|"")*"'                                   # quoted identifier, never a literal
+    r"|(?<![\w&])'(?:[^']|'')*'"                        # plain string (not E'..', U&'..', B'..')
+    r"|(?<![\w.$])\d+(?:\.\d+)?(?:[eE][+-]?\d+)?(?![\w.])"
+)
+
+class Shape:
+    """The masked text of a query and the literals that were masked out."""
+    __slots__ = ('text', 'starts', 'tokens', 'values')
+
+    def __init__(self, sql):
+        parts, starts, tokens, values = [], [], [], []
+        last = 0
+        for match in LITERAL_PATTERN.finditer(sql):
+            token = match.group()
+            if token[0] == '"':
+                continue
+            parts.append(sql[last:match.start()])
+            parts.append('?')
+            last = match.end()
+            starts.append(match.start())
+            tokens.append(token)
+            if token[0] == "'":
+                values.append(token[1:-1].replace("''", "'"))
+            elif token.isdigit():
+                values.append(int(token))
+            else:
+                values.append(float(token))
+        parts.append(sql[last:])
+        self.text = ''.join(parts)
+        self.starts = starts
+        self.tokens = tokens
+        self.values = values
+
+def _references_key(predicate, partition_keys):
+    return any(column.name in partition_keys for column in predicate.find_all(exp.Column))
+
+def parameterize(parsed, shape, partition_keys):
+    """Replaces the bindable WHERE literals of a SELECT with %(pN)s; returns the indexes that became parameters."""
+    where = parsed.args.get('where')
+    if where is None or not isinstance(parsed, exp.Select) or parsed.args.get('joins'):
+        return []
+    index_at = {start: i for i, start in enumerate(shape.starts)}
+    positions = []
+    for literal in list(where.find_all(exp.Literal)):
+        start = (literal.meta or {}).get('start')
+        if start is None or start not in index_at:
+            continue
+        if literal.find_ancestor(exp.Subquery, exp.Interval, exp.Select) is not parsed:
+            continue
+        predicate = literal.find_ancestor(exp.Predicate)
+        if predicate is None or _references_key(predicate, partition_keys):
+            continue
+        i = index_at[start]
+        literal.replace(exp.Placeholder(this=f"p{i}"))
+        positions.append(i)
+    return sorted(positions)
+
+def escape_percent(sql, names=r'p\d+'):
+    """Doubles the '%' signs that are not bind parameters (named by the `names` pattern), as psycopg2 requires when binding."""
+    return re.sub(rf'%(?!\((?:{names})\)s)', '%%', sql)
+
+class PlanCache:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._shapes = {}           # masked text -> [literal indexes bound as parameters, cached entries]
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.capacity > 0
+
+    def _key(self, shape, positions):
+        bound = set(positions)
+        return (shape.text, tuple(token for i, token in enumerate(shape.tokens) if i not in bound))
+
+    def lookup(self, shape):
+        """Returns (template, params) for a cached shape, or None."""
+        with self._lock:
+            known = self._shapes.get(shape.text)
+            template = None
+            if known is not None:
+                positions = known[0]
+                key = self._key(shape, positions)
+                template = self._entries.get(key)
+            if template is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        return template, {f"p{i}": shape.values[i] for i in positions}
+
+    def store(self, shape, positions, template):
+        key = self._key(shape, positions)
+        with self._lock:
+            if key in self._entries:
+                self._entries[key] = template
+                return
+            known = self._shapes.setdefault(shape.text, [positions, 0])
+            known[1] += 1
+            self._entries[key] = template
+            while len(self._entries) > self.capacity:
+                (text, _), _ = self._entries.popitem(last=False)
+                self.evictions += 1
+                known = self._shapes[text]
+                known[1] -= 1
+                if not known[1]:
+                    del self._shapes[text]
+
+    def clear(self):
+        with self._lock:
+            self._shapes.clear()
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'capacity': self.capacity,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
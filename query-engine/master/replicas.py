@@ -0,0 +1,131 @@
+"""
+Replica selection for reads: candidates ordered by health and recent latency,
+outlier ejection, and the delay and budget of hedged reads.
+"""
+import threading
+import time
+from collections import deque
+
+from protos.metrics import Counter
+
+HEDGES = Counter('dqps_master_hedged_reads_total', "Reads also sent to a replica after the hedge delay.", ('node',))
+HEDGE_WINS = Counter('dqps_master_hedge_wins_total', "Hedged reads answered first by the replica.", ('node',))
+FAILOVERS = Counter('dqps_master_read_failovers_total', "Reads retried on a replica after a failed RPC.", ('node',))
+
+class ReplicaSelector:
+    def __init__(self, groups=None, hedge_percentile=0.95, default_hedge_delay=0.1, min_hedge_delay=0.002,
+                 hedge_budget=0.1, window=200, min_samples=20, outlier_factor=3.0, eject_failures=3, eject_seconds=10.0):
+        self.hedge_percentile = hedge_percentile
+        self.default_hedge_delay = default_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.hedge_budget = hedge_budget
+        self.window = window
+        self.min_samples = min_samples
+        self.outlier_factor = outlier_factor
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        self._lock = threading.Lock()
+        self._groups = {}
+        self._latencies = {}
+        self._ewma = {}
+        self._failures = {}
+        self._ejected_until = {}
+        self._tokens = 1.0
+        self.update(groups or {})
+
+    def update(self, groups):
+        """Replaces the replica groups: {primary address: [primary, replica, ...]}."""
+        with self._lock:
+            self._groups = {primary: list(group) for primary, group in groups.items()}
+
+    def replicated(self, address):
+        with self._lock:
+            return len(self._groups.get(address, ())) > 1
+
+    def _is_ejected(self, address, now):
+        return self._ejected_until.get(address, 0) > now
+
+    def ejected(self):
+        now = time.monotonic()
+        with self._lock:
+            return sorted(address for address, until in self._ejected_until.items() if until > now)
+
+    def candidates(self, address, is_healthy=None):
+        """The workers that can serve a read of `address`'s partitions, healthiest and fastest first."""
+        now = time.monotonic()
+        with self._lock:
+            group = self._groups.get(address) or [address]
+            if len(group) == 1:
+                return list(group)
+            ranked = sorted(enumerate(group), key=lambda item: (
+                self._is_ejected(item[1], now) or (is_healthy is not None and not is_healthy(item[1])),
+                self._ewma.get(item[1], float('inf')),
+                item[0]))
+        return [address for _, address in ranked]
+
+    def hedge_delay(self, address):
+        """Seconds to wait for `address` to answer before hedging, or None when the budget is spent."""
+        with self._lock:
+            if self._tokens < 1:
+                return None
+            samples = sorted(self._latencies.get(address, ()))
+        if len(samples) < self.min_samples:
+            return self.default_hedge_delay
+        rank = min(int(len(samples) * self.hedge_percentile), len(samples) - 1)
+        return max(samples[rank], self.min_hedge_delay)
+
+    def start_read(self):
+        """Called once per replicated read; every read earns a fraction of a hedge."""
+        with self._lock:
+            self._tokens = min(self._tokens + self.hedge_budget, 10.0)
+
+    def hedge(self, address):
+        """Spends a hedge on a read of `address`; False when the budget is exhausted."""
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+        HEDGES.inc(node=address)
+        return True
+
+    def record_success(self, address, seconds):
+        now = time.monotonic()
+        with self._lock:
+            samples = self._latencies.get(address)
+            if samples is None:
+                samples = self._latencies[address] = deque(maxlen=self.window)
+            samples.append(seconds)
+            previous = self._ewma.get(address)
+            self._ewma[address] = seconds if previous is None else previous * 0.9 + seconds * 0.1
+            self._failures[address] = 0
+            self._eject_outliers(address, now)
+
+    def record_failure(self, address):
+        with self._lock:
+            self._failures[address] = self._failures.get(address, 0) + 1
+            if self._failures[address] >= self.eject_failures:
+                self._eject(address, time.monotonic(), f"{self._failures[address]} consecutive failures")
+
+    def _eject(self, address, now, reason):
+        if not self._is_ejected(address, now):
+            print(f"Ejecting {address} from reads for {self.eject_seconds:g}s: {reason}")
+        self._ejected_until[address] = now + self.eject_seconds
+        # It starts over on probation when it comes back.
+        self._latencies.pop(address, None)
+        self._ewma.pop(address, None)
+        self._failures[address] = 0
+
+    def _eject_outliers(self, address, now):
+        """Ejects `address` when its latency is far above the rest of its replica group."""
+        for group in self._groups.values():
+            if address not in group or len(group) < 2:
+                continue
+            peers = [self._ewma[peer] for peer in group
+                     if peer != address and peer in self._ewma and not self._is_ejected(peer, now)
+                     and len(self._latencies.get(peer, ())) >= self.min_samples]
+            if not peers or len(self._latencies.get(address, ())) < self.min_samples:
+                continue
+            baseline = sorted(peers)[len(peers) // 2]
+            if self._ewma[address] > self.outlier_factor * baseline:
+                self._eject(address, now, f"latency {self._ewma[address] * 1000:.1f} ms vs {baseline * 1000:.1f} ms for its peers")
+            return
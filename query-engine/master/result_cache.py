@@ -0,0 +1,135 @@
+"""
+Master-side LRU cache of SELECT responses, indexed by the tables they read so
+that a write through the master evicts the entries it makes stale.
+"""
+import threading
+import time
+import sqlglot.expressions as exp
+from collections import OrderedDict
+
+# Results that depend on when or how often they are evaluated are never cached.
+VOLATILE_FUNCTIONS = (exp.Rand, exp.CurrentDate, exp.CurrentTime, exp.CurrentTimestamp)
+
+def is_cacheable(parsed):
+    return isinstance(parsed, exp.Select) and not any(parsed.find_all(*VOLATILE_FUNCTIONS))
+
+class _Entry:
+    __slots__ = ('value', 'size', 'tables', 'expires', 'aliases')
+
+    def __init__(self, value, size, tables, expires):
+        self.value = value
+        self.size = size
+        self.tables = tables
+        self.expires = expires
+        self.aliases = set()
+
+class ResultCache:
+    def __init__(self, max_bytes, ttl=None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl or None
+        self._entries = OrderedDict()
+        self._aliases = {}          # raw request text -> normalized key
+        self._by_table = {}         # table -> keys of the entries that read it
+        self._generations = {}
+        self._epoch = 0             # bumped by clear(), which fences every table
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = self.invalidations = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def lookup(self, raw_key):
+        """Fast path on the exact request text, before the SQL is parsed. Misses are not counted."""
+        with self._lock:
+            key = self._aliases.get(raw_key)
+            return self._hit(key) if key is not None else None
+
+    def get(self, key, alias=None):
+        """Looks up a normalized key and remembers `alias` as another spelling of it."""
+        with self._lock:
+            value = self._hit(key)
+            if value is None:
+                self.misses += 1
+            elif alias is not None and alias not in self._aliases:
+                self._aliases[alias] = key
+                self._entries[key].aliases.add(alias)
+            return value
+
+    def _hit(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry.expires is not None and entry.expires <= time.monotonic():
+            self._remove(key)
+            self.evictions += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.value
+
+    def snapshot(self, tables):
+        """Generations of `tables`, taken before the query runs and passed back to put()."""
+        with self._lock:
+            return self._snapshot(tables)
+
+    def _snapshot(self, tables):
+        return (self._epoch,) + tuple(self._generations.get(table, 0) for table in tables)
+
+    def put(self, key, value, size, tables, snapshot, alias=None):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if snapshot != self._snapshot(tables):
+                return
+            if key in self._entries:
+                self._remove(key)
+            expires = time.monotonic() + self.ttl if self.ttl else None
+            entry = _Entry(value, size, frozenset(tables), expires)
+            self._entries[key] = entry
+            self.bytes += size
+            for table in entry.tables:
+                self._by_table.setdefault(table, set()).add(key)
+            if alias is not None:
+                self._aliases[alias] = key
+                entry.aliases.add(alias)
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, table):
+        """Drops every entry that read `table` and fences off results already in flight."""
+        with self._lock:
+            self._generations[table] = self._generations.get(table, 0) + 1
+            for key in self._by_table.pop(table, set()):
+                if key in self._entries:
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        """Drops every entry and fences off the results of every table already in flight."""
+        with self._lock:
+            self._epoch += 1
+            self._entries.clear()
+            self._aliases.clear()
+            self._by_table.clear()
+            self.bytes = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= entry.size
+        for alias in entry.aliases:
+            self._aliases.pop(alias, None)
+        for table in entry.tables:
+            keys = self._by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_table[table]
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'invalidations': self.invalidations}
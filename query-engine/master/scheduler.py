@@ -0,0 +1,321 @@
+"""
+Admission control of queries on the master, in weighted-fair order per query
+class and client, and a cap on the sub-queries in flight per worker.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from protos.metrics import Counter, Histogram
+
+QUERY_CLASS_HEADER = 'x-query-class'
+CLIENT_ID_HEADER = 'x-client-id'
+QUERY_CLASSES = ('interactive', 'analytical')
+# Lower runs first when sub-queries wait for a worker slot; work outside a query (bulk loads) goes last.
+PRIORITIES = {'interactive': 0, 'analytical': 1, None: 2}
+ANALYTICAL_STEPS = ('fetch_for_join', 'ship_join', 'master_hash_join', 'map_aggregate')
+
+ADMITTED = Counter('dqps_master_admitted_queries_total', "Queries admitted to run, by class.", ('class',))
+REJECTED = Counter('dqps_master_rejected_queries_total', "Queries rejected by admission control.", ('class', 'reason'))
+ADMISSION_SECONDS = Histogram('dqps_master_admission_wait_seconds', "Time queries waited to be admitted.", ('class',))
+SLOT_SECONDS = Histogram('dqps_master_worker_slot_wait_seconds', "Time sub-queries waited for a worker slot.", ('node',))
+
+_QUERY_CLASS = contextvars.ContextVar('dqps_query_class', default=None)
+
+def classify(plan):
+    """The class of a plan: analytical when it joins or aggregates."""
+    for step in plan:
+        if step['type'] in ANALYTICAL_STEPS or classify(step.get('fallback') or ()) == 'analytical':
+            return 'analytical'
+    return 'interactive'
+
+def plan_cost(plan):
+    """The number of worker RPCs a plan makes, as its share of the fair queue."""
+    cost = 0
+    for step in plan:
+        cost += len(step.get('nodes') or step.get('targets') or step.get('batches') or ())
+    return max(cost, 1)
+
+def current_class():
+    return _QUERY_CLASS.get()
+
+class Overloaded(Exception):
+    pass
+
+class _Waiter:
+    """A queued acquisition, woken by the releasing thread or event loop through `wake`."""
+    __slots__ = ('key', 'query_class', 'granted', 'wake')
+
+    def __init__(self, key, query_class=None):
+        self.key = key
+        self.query_class = query_class
+        self.granted = False
+        self.wake = None
+
+    def __lt__(self, other):
+        return self.key < other.key
+
+def _block(waiter, timeout):
+    """Waits in this thread until `waiter` is granted; False on timeout."""
+    event = threading.Event()
+    waiter.wake = event.set
+    if waiter.granted:
+        return True
+    return event.wait(timeout)
+
+async def _block_async(waiter, timeout):
+    loop = asyncio.get_running_loop()
+    future = loop.create_future()
+
+    def resolve():
+        if not future.done():
+            future.set_result(True)
+    waiter.wake = lambda: loop.call_soon_threadsafe(resolve)
+    if waiter.granted:
+        return True
+    try:
+        return await asyncio.wait_for(future, timeout)
+    except TimeoutError:
+        return False
+
+class AdmissionController:
+    def __init__(self, max_running=16, class_limits=None, weights=None, max_queued=64, queue_timeout=10.0):
+        self.max_running = max_running
+        self.class_limits = dict(class_limits or {})
+        self.weights = dict(weights or {})
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout or None
+        self._lock = threading.Lock()
+        self._running = {query_class: 0 for query_class in QUERY_CLASSES}
+        self._queue = []
+        self._finish = {}
+        self._virtual_time = 0.0
+        self._order = itertools.count()
+
+    @property
+    def enabled(self):
+        return self.max_running > 0
+
+    def _has_slot(self, query_class):
+        limit = self.class_limits.get(query_class)
+        return sum(self._running.values()) < self.max_running and (not limit or self._running[query_class] < limit)
+
+    def _tag(self, query_class, client, cost):
+        """The start tag of a query in its flow; the flow's next query starts after this one's cost."""
+        flow = (query_class, client)
+        start = max(self._virtual_time, self._finish.get(flow, 0.0))
+        self._finish[flow] = start + cost / self.weights.get(query_class, 1.0)
+        if len(self._finish) > 4096:
+            self._finish = {flow: finish for flow, finish in self._finish.items() if finish > self._virtual_time}
+        return start
+
+    def _enqueue(self, query_class, client, cost):
+        """Admits the query now (None), queues it (its waiter), or rejects it."""
+        with self._lock:
+            start = self._tag(query_class, client, cost)
+            if self._has_slot(query_class):
+                self._running[query_class] += 1
+                self._virtual_time = max(self._virtual_time, start)
+                return None
+            if len(self._queue) >= self.max_queued:
+                REJECTED.inc(**{'class': query_class, 'reason': 'queue_full'})
+                raise Overloaded(f"429 Too Many Requests: the master's query queue is full ({len(self._queue)} queued)")
+            waiter = _Waiter((start, next(self._order)), query_class)
+            self._queue.append(waiter)
+            return waiter
+
+    def _dispatch(self):
+        """Grants freed slots to the queued queries with the lowest start tags whose class has room."""
+        woken = []
+        while self._queue:
+            eligible = [waiter for waiter in self._queue if self._has_slot(waiter.query_class)]
+            if not eligible:
+                break
+            waiter = min(eligible)
+            self._queue.remove(waiter)
+            self._running[waiter.query_class] += 1
+            self._virtual_time = max(self._virtual_time, waiter.key[0])
+            waiter.granted = True
+            woken.append(waiter)
+        return woken
+
+    def _abandon(self, waiter):
+        """Takes a waiter that gave up out of the queue; True when it was granted a slot meanwhile."""
+        with self._lock:
+            if waiter.granted:
+                return True
+            self._queue.remove(waiter)
+            return False
+
+    def _timed_out(self, query_class):
+        REJECTED.inc(**{'class': query_class, 'reason': 'timeout'})
+        return Overloaded(f"503 Service Unavailable: query was not admitted within {self.queue_timeout:g}s")
+
+    def release(self, query_class):
+        with self._lock:
+            self._running[query_class] -= 1
+            woken = self._dispatch()
+        for waiter in woken:
+            if waiter.wake is not None:
+                waiter.wake()
+
+    def acquire(self, query_class, client, cost=1):
+        """Blocks until the query may run; returns the seconds it waited."""
+        started = time.perf_counter()
+        waiter = self._enqueue(query_class, client, cost)
+        if waiter is not None and not _block(waiter, self.queue_timeout) and not self._abandon(waiter):
+            raise self._timed_out(query_class)
+        return self._admitted(query_class, started)
+
+    async def acquire_async(self, query_class, client, cost=1):
+        started = time.perf_counter()
+        waiter = self._enqueue(query_class, client, cost)
+        if waiter is not None:
+            try:
+                granted = await _block_async(waiter, self.queue_timeout)
+            except BaseException:
+                if self._abandon(waiter):
+                    self.release(query_class)
+                raise
+            if not granted and not self._abandon(waiter):
+                raise self._timed_out(query_class)
+        return self._admitted(query_class, started)
+
+    def _admitted(self, query_class, started):
+        waited = time.perf_counter() - started
+        ADMITTED.inc(**{'class': query_class})
+        ADMISSION_SECONDS.observe(waited, **{'class': query_class})
+        return waited
+
+    @contextmanager
+    def admitted(self, query_class, client, cost=1):
+        """Runs the block as an admitted query of `query_class`; yields the seconds it was queued."""
+        waited = self.acquire(query_class, client, cost) if self.enabled else 0.0
+        token = _QUERY_CLASS.set(query_class)
+        try:
+            yield waited
+        finally:
+            _QUERY_CLASS.reset(token)
+            if self.enabled:
+                self.release(query_class)
+
+    @asynccontextmanager
+    async def admitted_async(self, query_class, client, cost=1):
+        waited = await self.acquire_async(query_class, client, cost) if self.enabled else 0.0
+        token = _QUERY_CLASS.set(query_class)
+        try:
+            yield waited
+        finally:
+            _QUERY_CLASS.reset(token)
+            if self.enabled:
+                self.release(query_class)
+
+    def running(self):
+        with self._lock:
+            return {(query_class,): count for query_class, count in self._running.items()}
+
+    def queued(self):
+        with self._lock:
+            depth = {(query_class,): 0 for query_class in QUERY_CLASSES}
+            for waiter in self._queue:
+                depth[waiter.query_class,] += 1
+            return depth
+
+class WorkerSlots:
+    """At most `limit` sub-queries in flight per worker, each until the worker starts answering."""
+    def __init__(self, limit=10, timeout=None):
+        self.limit = limit
+        self.timeout = timeout or None
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._waiting = {}
+        self._order = itertools.count()
+
+    def _enqueue(self, address):
+        """Takes a slot now (None) or queues for one (the waiter)."""
+        with self._lock:
+            if self._in_flight.get(address, 0) < self.limit:
+                self._in_flight[address] = self._in_flight.get(address, 0) + 1
+                return None
+            waiter = _Waiter((PRIORITIES[current_class()], next(self._order)))
+            heapq.heappush(self._waiting.setdefault(address, []), waiter)
+            return waiter
+
+    def _abandon(self, address, waiter):
+        with self._lock:
+            if waiter.granted:
+                return True
+            waiting = self._waiting[address]
+            waiting.remove(waiter)
+            heapq.heapify(waiting)
+            return False
+
+    def _timed_out(self, address):
+        return Exception(f"503 Service Unavailable: {address} stayed at {self.limit} sub-queries in flight "
+                         f"for {self.timeout:g}s")
+
+    def try_acquire(self, address):
+        """Takes a slot only if one is free right away, for optional work such as hedged reads."""
+        if self.limit <= 0:
+            return True
+        with self._lock:
+            if self._in_flight.get(address, 0) >= self.limit:
+                return False
+            self._in_flight[address] = self._in_flight.get(address, 0) + 1
+            return True
+
+    def acquire(self, address):
+        """Blocks until `address` has a free slot; returns the seconds waited (0 when one was free)."""
+        if self.limit <= 0:
+            return 0.0
+        started = time.perf_counter()
+        waiter = self._enqueue(address)
+        if waiter is not None and not _block(waiter, self.timeout) and not self._abandon(address, waiter):
+            raise self._timed_out(address)
+        waited = time.perf_counter() - started if waiter is not None else 0.0
+        SLOT_SECONDS.observe(waited, node=address)
+        return waited
+
+    async def acquire_async(self, address):
+        if self.limit <= 0:
+            return 0.0
+        started = time.perf_counter()
+        waiter = self._enqueue(address)
+        if waiter is not None:
+            try:
+                granted = await _block_async(waiter, self.timeout)
+            except BaseException:
+                if self._abandon(address, waiter):
+                    self.release(address)
+                raise
+            if not granted and not self._abandon(address, waiter):
+                raise self._timed_out(address)
+        waited = time.perf_counter() - started if waiter is not None else 0.0
+        SLOT_SECONDS.observe(waited, node=address)
+        return waited
+
+    def release(self, address):
+        if self.limit <= 0:
+            return
+        with self._lock:
+            waiting = self._waiting.get(address)
+            if not waiting:
+                self._in_flight[address] -= 1
+                return
+            # The slot passes straight to the next waiter.
+            waiter = heapq.heappop(waiting)
+            waiter.granted = True
+        if waiter.wake is not None:
+            waiter.wake()
+
+    def in_flight(self):
+        with self._lock:
+            return {(address,): count for address, count in self._in_flight.items()}
+
+    def queued(self):
+        with self._lock:
+            return {(address,): len(waiting) for address, waiting in self._waiting.items()}
@@ -0,0 +1,240 @@
+"""
+Coalescing of identical concurrent reads: queries share one execution, and
+sub-queries to a worker share one stream of at most `max_batches` held batches.
+"""
+import asyncio
+import threading
+
+from protos.metrics import Counter
+
+COALESCED = Counter('dqps_master_coalesced_total', "Queries and sub-queries that shared an identical one in flight.",
+                    ('level',))
+
+class _Call:
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """Concurrent calls with the same key share the first one's result, or its exception."""
+    def __init__(self, level='query'):
+        self.level = level
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._tasks = {}            # asyncio tasks, on the event loop's thread only
+
+    def do(self, key, fn):
+        """fn() once for every concurrent call with `key`; returns (result, True when it was shared)."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            COALESCED.inc(level=self.level)
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    async def do_async(self, key, fn):
+        """do() for a coroutine function, run as a task of its own so that a cancelled caller leaves it running."""
+        task = self._tasks.get(key)
+        shared = task is not None
+        if shared:
+            COALESCED.inc(level=self.level)
+        else:
+            task = self._tasks[key] = asyncio.ensure_future(fn())
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        return await asyncio.shield(task), shared
+
+_END = object()
+
+async def _next(source):
+    try:
+        return await source.__anext__()
+    except StopAsyncIteration:
+        return _END
+
+class _Stream:
+    """The batches of one shared worker stream that some reader has not passed yet."""
+    def __init__(self, source, room):
+        self.source = source
+        self.room = room            # threading.Condition or asyncio.Event, woken when batches are dropped
+        self.batches = []
+        self.base = 0               # number of the first held batch
+        self.positions = {}         # reader -> number of its next batch
+        self.readers = 0
+        self.done = False
+        self.error = None
+        self.pull = threading.Lock()
+        self.pending = None         # asyncio task pulling the next batch
+
+    def take(self, reader):
+        """The reader's next batch if it is held, else None; raises the source's error at its end."""
+        position = self.positions[reader]
+        if position >= self.base + len(self.batches):
+            if self.error is not None:
+                raise self.error
+            return None
+        batch = self.batches[position - self.base]
+        self.positions[reader] = position + 1
+        self.drop()
+        return batch
+
+    def drop(self):
+        """Drops the batches every reader has passed and wakes the readers waiting for room."""
+        if not self.positions:
+            return
+        passed = min(self.positions.values()) - self.base
+        if passed:
+            del self.batches[:passed]
+            self.base += passed
+            if isinstance(self.room, asyncio.Event):
+                self.room.set()
+            else:
+                self.room.notify_all()
+
+    def behind(self, reader):
+        return self.positions[reader] < self.base + len(self.batches)
+
+class SharedStreams:
+    """Identical concurrent sub-queries share one stream; open() returns a generator of its batches for one reader."""
+    def __init__(self, max_batches):
+        self.max_batches = max_batches
+        self._lock = threading.Lock()
+        self._streams = {}          # key -> _Stream that can still be joined
+
+    def _joinable(self, stream):
+        # Once its first batch is dropped, or too many are held, a new reader could not get every batch.
+        return stream is not None and not stream.done and stream.base == 0 and len(stream.batches) < self.max_batches
+
+    def _full(self, stream, reader):
+        """True when `reader` would have to pull while the slowest reader holds max_batches batches."""
+        return not stream.done and not stream.behind(reader) and len(stream.batches) >= self.max_batches
+
+    def _join(self, key, start, room):
+        with self._lock:
+            stream = self._streams.get(key)
+            if not self._joinable(stream):
+                stream = self._streams[key] = _Stream(start(), room())
+            else:
+                COALESCED.inc(level='subquery')
+            reader = object()
+            stream.positions[reader] = 0
+            stream.readers += 1
+            return stream, reader
+
+    def _unlist(self, key, stream):
+        if self._streams.get(key) is stream:
+            del self._streams[key]
+
+    def _pulled(self, key, stream, batch):
+        if batch is _END:
+            stream.done = True
+            self._unlist(key, stream)
+            return
+        stream.batches.append(batch)
+        if not self._joinable(stream):
+            self._unlist(key, stream)
+
+    def _failed(self, key, stream, error):
+        stream.done, stream.error = True, error
+        self._unlist(key, stream)
+
+    def _leave(self, key, stream, reader):
+        """Removes a reader; True when it was the last one and the source has to be closed."""
+        del stream.positions[reader]
+        stream.readers -= 1
+        stream.drop()
+        if stream.readers == 0:
+            self._unlist(key, stream)
+        return stream.readers == 0 and not stream.done
+
+    def open(self, key, start):
+        stream, reader = self._join(key, start, lambda: threading.Condition(self._lock))
+        return self._read(key, stream, reader)
+
+    def _read(self, key, stream, reader):
+        try:
+            while True:
+                with self._lock:
+                    while self._full(stream, reader):
+                        stream.room.wait()
+                    batch = stream.take(reader)
+                    if batch is None and stream.done:
+                        return
+                if batch is not None:
+                    yield batch
+                    continue
+                with stream.pull:
+                    with self._lock:
+                        if stream.done or stream.behind(reader) or self._full(stream, reader):
+                            continue
+                    try:
+                        batch = next(stream.source, _END)
+                    except Exception as e:
+                        with self._lock:
+                            self._failed(key, stream, e)
+                        raise
+                    with self._lock:
+                        self._pulled(key, stream, batch)
+        finally:
+            with self._lock:
+                close = self._leave(key, stream, reader)
+            if close:
+                with stream.pull:
+                    stream.source.close()
+
+    def open_async(self, key, start):
+        stream, reader = self._join(key, start, asyncio.Event)
+        return self._read_async(key, stream, reader)
+
+    async def _read_async(self, key, stream, reader):
+        # Readers share the event loop's thread. The next batch is pulled by a task of its own, so
+        # that a reader cancelled while waiting for it does not cancel the stream for the others.
+        try:
+            while True:
+                while self._full(stream, reader):
+                    stream.room.clear()
+                    await stream.room.wait()
+                batch = stream.take(reader)
+                if batch is None and stream.done:
+                    return
+                if batch is not None:
+                    yield batch
+                    continue
+                pending = stream.pending
+                if pending is None:
+                    pending = stream.pending = asyncio.ensure_future(_next(stream.source))
+                try:
+                    batch = await asyncio.shield(pending)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as e:
+                    if stream.pending is pending:
+                        stream.pending = None
+                        self._failed(key, stream, e)
+                    raise
+                if stream.pending is pending:
+                    stream.pending = None
+                    self._pulled(key, stream, batch)
+        finally:
+            if self._leave(key, stream, reader):
+                if stream.pending is not None:
+                    stream.pending.cancel()
+                    await asyncio.gather(stream.pending, return_exceptions=True)
+                await stream.source.aclose()
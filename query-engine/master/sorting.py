@@ -0,0 +1,85 @@
+"""
+Distributed ORDER BY / LIMIT: every worker returns its rows sorted and cut to
+LIMIT + OFFSET rows, and the master k-way merges them.
+"""
+import heapq
+import sqlglot.expressions as exp
+from itertools import islice
+
+from operators import literal_int
+
+class SortKey:
+    """Orders rows by several SQL sort keys with per-key direction and NULL placement."""
+    __slots__ = ('values', 'directions')
+
+    def __init__(self, values, directions):
+        self.values = values
+        self.directions = directions
+
+    def __lt__(self, other):
+        for a, b, (desc, nulls_first) in zip(self.values, other.values, self.directions):
+            if a == b:
+                continue
+            if a is None:
+                return nulls_first
+            if b is None:
+                return not nulls_first
+            return a > b if desc else a < b
+        return False
+
+def sort_key_function(keys):
+    """Builds a row -> SortKey function from (evaluate, desc, nulls_first) keys."""
+    getters = [evaluate for evaluate, _, _ in keys]
+    directions = [(desc, nulls_first) for _, desc, nulls_first in keys]
+    return lambda row: SortKey([get(row) for get in getters], directions)
+
+def merge_sorted_runs(runs, keys, limit=None, offset=None):
+    """K-way merges row iterators sorted by `keys` and returns rows[offset:offset + limit] of the result."""
+    merged = heapq.merge(*runs, key=sort_key_function(keys))
+    start = offset or 0
+    return list(islice(merged, start, None if limit is None else start + limit))
+
+class DistributedSort:
+    """The per-shard query of a single-table SELECT with ORDER BY and/or LIMIT, and the merge of its results."""
+    def __init__(self, parsed, columns=()):
+        # Ordinals count the columns a * expands to, which come from the table's metadata.
+        items = []
+        for item in parsed.expressions:
+            if isinstance(item, exp.Star):
+                items.extend(exp.column(column) for column in columns)
+            else:
+                items.append(item)
+        aliases = {item.alias: item.this for item in items if isinstance(item, exp.Alias)}
+        self.limit = literal_int(parsed.args.get('limit'))
+        self.offset = literal_int(parsed.args.get('offset'))
+        self.hidden = []
+        self.keys = []
+
+        worker = parsed.copy()
+        order = parsed.args.get('order')
+        worker_order = []
+        for i, ordered in enumerate(order.expressions if order else []):
+            node = ordered.this
+            if isinstance(node, exp.Literal) and not node.is_string:
+                node = items[int(node.this) - 1]
+                node = node.this if isinstance(node, exp.Alias) else node
+            elif isinstance(node, exp.Column) and not node.table and node.name in aliases:
+                node = aliases[node.name]
+            name = f"_sort{i}"
+            desc, nulls_first = bool(ordered.args.get('desc')), bool(ordered.args.get('nulls_first'))
+            self.hidden.append(name)
+            self.keys.append((lambda row, name=name: row.get(name), desc, nulls_first))
+            worker.append('expressions', exp.alias_(node.copy(), name))
+            worker_order.append(exp.Ordered(this=exp.column(name), desc=desc, nulls_first=nulls_first))
+
+        worker.set('order', exp.Order(expressions=worker_order) if worker_order else None)
+        worker.set('offset', None)
+        if self.limit is not None:
+            worker.set('limit', exp.Limit(expression=exp.Literal.number(self.limit + (self.offset or 0))))
+        self.worker_query = worker
+
+    def strip(self, rows):
+        hidden = self.hidden
+        if not hidden:
+            return rows
+        return [{key: value for key, value in row.items() if key not in hidden} for row in rows]
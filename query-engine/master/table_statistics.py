@@ -0,0 +1,232 @@
+"""
+Table statistics reported by the workers, and the row estimates the planner
+uses to order joins and choose between broadcasting and pulling them.
+"""
+import bisect
+import threading
+import sqlglot.expressions as exp
+
+from partitioning import nodes_for_partitions
+
+# Selectivities assumed for predicates the statistics cannot answer (PostgreSQL's defaults).
+DEFAULT_EQ_SELECTIVITY = 0.005
+DEFAULT_RANGE_SELECTIVITY = 1 / 3
+# A row shipped to a worker inlined in its SQL costs this many fetched rows: it is rendered, sent and parsed as text.
+SHIPPED_ROW_COST = 2.0
+# Hashing, probing and materializing a joined row on the master costs about as much as fetching one.
+MASTER_JOIN_ROW_COST = 1.0
+# Cached plans are re-planned when a table's row count moves by more than this factor.
+REPLAN_FACTOR = 2.0
+
+_UNKNOWN = object()
+
+def _literal(node):
+    """The value of a literal operand (numbers as floats), or _UNKNOWN for anything else, such as a bind parameter."""
+    while isinstance(node, (exp.Cast, exp.Paren)):
+        node = node.this
+    if isinstance(node, exp.Neg):
+        value = _literal(node.this)
+        return -value if isinstance(value, float) else _UNKNOWN
+    if isinstance(node, exp.Literal):
+        return node.this if node.is_string else float(node.this)
+    return _UNKNOWN
+
+def _comparable(text, like):
+    """A statistics value (reported as text) as the type of `like`, or None when it does not convert."""
+    if isinstance(like, float):
+        try:
+            return float(text)
+        except ValueError:
+            return None
+    return text
+
+def _column(node, stats, qualifier):
+    if isinstance(node, exp.Column) and node.table in ('', qualifier):
+        return stats['columns'].get(node.name)
+    return None
+
+def _equal(column, value):
+    """The fraction of rows whose value equals `value` (an unknown one when _UNKNOWN)."""
+    mcv, mcf = column.get('mcv') or [], column.get('mcf') or []
+    if value is _UNKNOWN:
+        return (1 - column['null_frac']) / max(column['ndv'], 1)
+    for common, frequency in zip(mcv, mcf):
+        if _comparable(common, value) == value:
+            return frequency
+    rest = max(1 - column['null_frac'] - sum(mcf), 0.0)
+    return rest / max(column['ndv'] - len(mcv), 1)
+
+def _below(column, value, inclusive):
+    """The fraction of rows whose value is below (or equal to) `value`, or None when the statistics cannot tell."""
+    if value is _UNKNOWN:
+        return None
+    mcv, mcf = column.get('mcv') or [], column.get('mcf') or []
+    histogram = column.get('histogram') or []
+    if not mcv and len(histogram) < 2:
+        return None
+    common = 0.0
+    for text, frequency in zip(mcv, mcf):
+        other = _comparable(text, value)
+        if other is None:
+            return None
+        if other < value or (inclusive and other == value):
+            common += frequency
+    bounds = [_comparable(text, value) for text in histogram]
+    if len(bounds) < 2 or None in bounds:
+        return common
+    position = (bisect.bisect_right if inclusive else bisect.bisect_left)(bounds, value)
+    if position == 0:
+        fraction = 0.0
+    elif position == len(bounds):
+        fraction = 1.0
+    else:
+        low, high = bounds[position - 1], bounds[position]
+        within = (value - low) / (high - low) if isinstance(value, float) and high > low else 0.5
+        fraction = (position - 1 + within) / (len(bounds) - 1)
+    return common + fraction * max(1 - column['null_frac'] - sum(mcf), 0.0)
+
+def selectivity(node, stats, qualifier):
+    """The estimated fraction of a table's rows (with worker statistics `stats`) that satisfy `node`."""
+    if isinstance(node, (exp.Where, exp.Paren)):
+        return selectivity(node.this, stats, qualifier)
+    if isinstance(node, exp.And):
+        return selectivity(node.this, stats, qualifier) * selectivity(node.expression, stats, qualifier)
+    if isinstance(node, exp.Or):
+        a, b = selectivity(node.this, stats, qualifier), selectivity(node.expression, stats, qualifier)
+        return a + b - a * b
+    if isinstance(node, exp.Not):
+        return 1 - selectivity(node.this, stats, qualifier)
+
+    if isinstance(node, exp.Is) and isinstance(node.expression, exp.Null):
+        column = _column(node.this, stats, qualifier)
+        return column['null_frac'] if column else DEFAULT_EQ_SELECTIVITY
+    if isinstance(node, exp.In) and not node.args.get('query'):
+        column = _column(node.this, stats, qualifier)
+        if column is None:
+            return min(DEFAULT_EQ_SELECTIVITY * len(node.expressions), 1.0)
+        return min(sum(_equal(column, _literal(value)) for value in node.expressions), 1.0)
+    if isinstance(node, exp.Between):
+        column = _column(node.this, stats, qualifier)
+        high = _below(column, _literal(node.args['high']), True) if column else None
+        low = _below(column, _literal(node.args['low']), False) if column else None
+        return max(high - low, 0.0) if high is not None and low is not None else DEFAULT_RANGE_SELECTIVITY ** 2
+
+    flipped = {exp.EQ: exp.EQ, exp.NEQ: exp.NEQ, exp.GT: exp.LT, exp.GTE: exp.LTE, exp.LT: exp.GT, exp.LTE: exp.GTE}
+    kind = type(node)
+    if kind not in flipped:
+        return DEFAULT_RANGE_SELECTIVITY
+    left, right = node.this, node.expression
+    if _column(left, stats, qualifier) is None and _column(right, stats, qualifier) is not None:
+        left, right, kind = right, left, flipped[kind]
+    column = _column(left, stats, qualifier)
+    if isinstance(right, exp.Column) or column is None:
+        return {exp.EQ: DEFAULT_EQ_SELECTIVITY, exp.NEQ: 1 - DEFAULT_EQ_SELECTIVITY}.get(kind, DEFAULT_RANGE_SELECTIVITY)
+    value = _literal(right)
+    if kind is exp.EQ:
+        return _equal(column, value)
+    if kind is exp.NEQ:
+        return max(1 - column['null_frac'] - _equal(column, value), 0.0)
+    below = _below(column, value, kind in (exp.LTE, exp.GT))
+    if below is None:
+        return DEFAULT_RANGE_SELECTIVITY
+    return below if kind in (exp.LT, exp.LTE) else max(1 - column['null_frac'] - below, 0.0)
+
+def broadcast_cost(shipped_rows, anchors, joined_rows):
+    """Rows moved to fetch one side, ship it to `anchors` workers and return the joined rows."""
+    return shipped_rows + shipped_rows * anchors * SHIPPED_ROW_COST + joined_rows
+
+def pull_cost(fetched_rows, joined_rows):
+    """Rows moved to fetch every side of a join to the master, plus the master's work joining them."""
+    return fetched_rows + joined_rows * MASTER_JOIN_ROW_COST
+
+class Statistics:
+    """The statistics each worker last reported for its tables, and the estimates derived from them."""
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = {}   # (worker address, table) -> statistics
+
+    def update(self, node, tables):
+        """Stores a worker's statistics; True when a table appeared or its row count moved past REPLAN_FACTOR."""
+        moved = False
+        with self._lock:
+            for stats in tables:
+                old = self._tables.get((node, stats['table']))
+                rows = max(stats['rows'], 1)
+                if old is None or not 1 / REPLAN_FACTOR <= rows / max(old['rows'], 1) <= REPLAN_FACTOR:
+                    moved = True
+                self._tables[(node, stats['table'])] = stats
+        return moved
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+
+    def _shards(self, meta, table, partitions):
+        """(statistics, share of its rows) of every worker holding `partitions` of a table, or None."""
+        held = {}
+        for partition, node in meta['nodes'].items():
+            held.setdefault(node, []).append(partition)
+        shards = []
+        with self._lock:
+            for node in nodes_for_partitions(meta, partitions):
+                stats = self._tables.get((node, table))
+                if stats is None:
+                    return None
+                shards.append((stats, sum(partition in partitions for partition in held[node]) / len(held[node])))
+        return shards
+
+    def estimate_rows(self, source, partitions):
+        """The rows a JoinSource's fetch of `partitions` returns after its pushed-down filters, or None."""
+        shards = self._shards(source.meta, source.table, partitions)
+        if shards is None:
+            return None
+        where = source.where()
+        return sum(stats['rows'] * share * (selectivity(where, stats, source.qualifier) if where is not None else 1.0)
+                   for stats, share in shards)
+
+    def distinct_values(self, source, column, rows):
+        """The distinct values of a source's column among `rows` of its rows (all distinct when unknown)."""
+        shards = self._shards(source.meta, source.table, list(source.meta['nodes']))
+        counts = [stats['columns'][column]['ndv'] for stats, _ in shards or () if column in stats['columns']]
+        if not counts:
+            return max(rows, 1)
+        # Partitions hold disjoint sets of partition keys, but may all hold any value of another column.
+        ndv = sum(counts) if column == source.meta['partition_key'] else max(counts)
+        return max(min(ndv, rows), 1)
+
+    def join_rows(self, join_plan, estimates, joined, qualifier, rows=None):
+        """The rows produced by joining the source `qualifier` to the sources `joined`."""
+        sources = {source.qualifier: source for source in join_plan.sources}
+        if rows is None:
+            rows = 1.0
+            for other in joined:
+                rows *= estimates[other]
+        result = rows * estimates[qualifier]
+        for join in join_plan.joins:
+            for l_table, l_name, r_table, r_name in join['pairs']:
+                if {l_table, r_table} <= set(joined) | {qualifier} and qualifier in (l_table, r_table) \
+                        and (l_table in joined or r_table in joined):
+                    result /= max(self.distinct_values(sources[l_table], l_name, estimates[l_table]),
+                                  self.distinct_values(sources[r_table], r_name, estimates[r_table]))
+        return result
+
+    def join_order(self, join_plan, estimates):
+        """FROM-clause positions of the sources of an inner join in a greedy join order, or None."""
+        if len(join_plan.sources) < 3 or not join_plan.is_inner() or None in estimates.values():
+            return None
+        pairs = [pair for join in join_plan.joins for pair in join['pairs']]
+        remaining = [source.qualifier for source in join_plan.sources]
+        first = min(remaining, key=lambda qualifier: estimates[qualifier])
+        order, rows = [first], estimates[first]
+        remaining.remove(first)
+        while remaining:
+            def cost(qualifier):
+                connected = any(qualifier in (l_table, r_table) and ({l_table, r_table} - {qualifier}) <= set(order)
+                                for l_table, _, r_table, _ in pairs)
+                return not connected, self.join_rows(join_plan, estimates, order, qualifier, rows)
+            best = min(remaining, key=cost)
+            rows = cost(best)[1]
+            order.append(best)
+            remaining.remove(best)
+        positions = {source.qualifier: i for i, source in enumerate(join_plan.sources)}
+        return [positions[qualifier] for qualifier in order]
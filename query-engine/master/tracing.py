@@ -0,0 +1,195 @@
+"""
+Per-query traces on the master: spans for planning, plan steps and worker RPCs,
+which feed the metrics and EXPLAIN ANALYZE. Functions run on threads need bind().
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from protos.metrics import Counter, Histogram
+
+QUERY_ID_HEADER = 'x-query-id'
+# Stages a worker reports in its trailing metadata, in milliseconds.
+WORKER_STAGES = (('queue', 'x-pool-wait-ms'), ('db', 'x-db-ms'), ('encode', 'x-encode-ms'))
+# Every stage of an RPC: waiting for a worker slot on the master, then the worker's, network and decoding.
+STAGES = ('slot', 'queue', 'db', 'encode', 'network', 'decode')
+STATEMENTS = ('select', 'insert', 'update', 'delete', 'explain')
+
+QUERIES = Counter('dqps_master_queries_total', "Queries received, by statement and outcome.", ('statement', 'status'))
+QUERY_SECONDS = Histogram('dqps_master_query_seconds', "End-to-end query latency on the master.", ('statement',))
+STEP_SECONDS = Histogram('dqps_master_step_seconds', "Time spent planning and in each type of plan step.", ('step',))
+RPC_SECONDS = Histogram('dqps_master_worker_rpc_seconds', "Worker RPC latency seen by the master.", ('node', 'method'))
+RPC_ERRORS = Counter('dqps_master_worker_rpc_errors_total', "Worker RPCs that failed or returned an error row.", ('node', 'method'))
+RPC_ROWS = Counter('dqps_master_worker_rows_total', "Rows received from each worker.", ('node',))
+STAGE_SECONDS = Histogram('dqps_master_worker_stage_seconds',
+                          "Worker RPC time by stage: slot, queue, db, encode, network and decode.", ('node', 'stage'))
+
+_CURRENT = contextvars.ContextVar('dqps_span', default=None)
+
+class Span:
+    def __init__(self, name, kind, query_id=None, **attributes):
+        self.name = name
+        self.kind = kind
+        self.query_id = query_id
+        self.attributes = attributes
+        self.children = []
+        self.start = time.perf_counter()
+        self.end = None
+        self._lock = threading.Lock()
+
+    def child(self, name, kind, **attributes):
+        span = Span(name, kind, self.query_id, **attributes)
+        with self._lock:
+            self.children.append(span)
+        return span
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, name, amount):
+        with self._lock:
+            self.attributes[name] = self.attributes.get(name, 0) + amount
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.perf_counter()
+
+    @property
+    def duration_ms(self):
+        return ((self.end or time.perf_counter()) - self.start) * 1000
+
+def current():
+    return _CURRENT.get()
+
+def annotate(**attributes):
+    """Sets attributes on the current span, if there is one."""
+    span = _CURRENT.get()
+    if span is not None:
+        span.set(**attributes)
+
+def metadata():
+    """gRPC metadata carrying the current query id to the workers."""
+    span = _CURRENT.get()
+    return ((QUERY_ID_HEADER, span.query_id),) if span is not None and span.query_id else ()
+
+def bind(fn):
+    """Wraps `fn` to run in the caller's context (and so under the current span) in whichever thread calls it."""
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        # A context can only be entered by one thread at a time, so every call runs in its own copy.
+        return context.copy().run(fn, *args, **kwargs)
+    return run
+
+def statement_of(sql):
+    words = sql.split(None, 1)
+    statement = words[0].lower() if words else ''
+    return statement if statement in STATEMENTS else 'other'
+
+@contextmanager
+def query(query_id, sql, slow_ms=0, describe=None):
+    """The root span of a query; queries slower than `slow_ms` (when set) print their trace."""
+    root = Span('query', 'query', query_id, sql=sql)
+    token = _CURRENT.set(root)
+    try:
+        yield root
+    finally:
+        _CURRENT.reset(token)
+        root.finish()
+        statement = statement_of(sql)
+        status = next((outcome for outcome in ('rejected', 'error', 'cached', 'coalesced') if root.attributes.get(outcome)), 'ok')
+        QUERIES.inc(statement=statement, status=status)
+        QUERY_SECONDS.observe(root.duration_ms / 1000, statement=statement)
+        if slow_ms and root.duration_ms >= slow_ms:
+            print(f"Slow query {query_id} ({root.duration_ms:.1f} ms): {sql}\n" + '\n'.join(explain(root, describe)))
+
+@contextmanager
+def span(name, kind='step', **attributes):
+    """A child span of the current span that is current inside the block; yields None when not tracing."""
+    parent = _CURRENT.get()
+    span = parent.child(name, kind, **attributes) if parent is not None else None
+    token = _CURRENT.set(span) if span is not None else None
+    start = time.perf_counter()
+    try:
+        yield span
+    finally:
+        if span is not None:
+            _CURRENT.reset(token)
+            span.finish()
+        STEP_SECONDS.observe(time.perf_counter() - start, step=name)
+
+def rpc(node, method):
+    """Starts the span of a worker RPC under the current span."""
+    parent = _CURRENT.get()
+    if parent is None:
+        return Span(method, 'rpc', node=node, method=method)
+    return parent.child(method, 'rpc', node=node, method=method)
+
+def finish_rpc(span, trailing=None, rows=0, error=False):
+    """Ends an RPC span with the stage timings from the worker's trailing metadata."""
+    span.finish()
+    node, method = span.attributes['node'], span.attributes['method']
+    reported = {key: value for key, value in trailing or ()}
+    stages = {}
+    for stage, header in WORKER_STAGES:
+        try:
+            stages[stage] = float(reported[header])
+        except (KeyError, ValueError):
+            pass
+    if stages:
+        master_side = span.attributes.get('slot', 0) + span.attributes.get('decode', 0)
+        stages['network'] = max(span.duration_ms - sum(stages.values()) - master_side, 0.0)
+    span.set(rows=rows, error=error, **stages)
+
+    RPC_SECONDS.observe(span.duration_ms / 1000, node=node, method=method)
+    RPC_ROWS.inc(rows, node=node)
+    if error:
+        RPC_ERRORS.inc(node=node, method=method)
+    for stage in STAGES:
+        if stage in span.attributes:
+            STAGE_SECONDS.observe(span.attributes[stage] / 1000, node=node, stage=stage)
+
+def _render(span, describe, indent):
+    pad = '  ' * indent
+    attributes = span.attributes
+    if span.kind == 'rpc':
+        stages = ' '.join(f"{stage}={attributes[stage]:.3f}" for stage in STAGES if stage in attributes)
+        line = f"{pad}-> {attributes['method']} on {attributes['node']}  (time={span.duration_ms:.3f} ms rows={attributes.get('rows', 0)}"
+        line += f" {stages})" if stages else ")"
+        if attributes.get('replica_of'):
+            line += f"  replica of {attributes['replica_of']}"
+        if attributes.get('hedged'):
+            line += "  hedged"
+        return [line + ("  FAILED" if attributes.get('error') else "")]
+
+    step = attributes.get('step')
+    title, details = describe(step) if describe and step is not None else (span.name, [])
+    extra = ''.join(f" {name}={attributes[name]}" for name in ('rows', 'merge_ms') if attributes.get(name) is not None)
+    lines = [f"{pad}{title}  (actual time={span.duration_ms:.3f} ms{extra})"]
+    lines.extend(f"{pad}    {detail}" for detail in details)
+    for child in span.children:
+        lines.extend(_render(child, describe, indent + 1))
+    return lines
+
+def explain(root, describe=None):
+    """EXPLAIN ANALYZE lines for a query's trace; `describe(step)` returns a step's title and detail lines."""
+    lines = []
+    planning = execution = 0.0
+    for child in list(root.children):
+        if child.kind == 'plan':
+            planning += child.duration_ms
+            continue
+        execution += child.duration_ms
+        lines.extend(_render(child, describe, 0))
+    plan = next((child for child in root.children if child.kind == 'plan'), None)
+    cache = f" (plan cache {plan.attributes['plan_cache']})" if plan is not None and 'plan_cache' in plan.attributes else ''
+    lines.append(f"Planning Time: {planning:.3f} ms{cache}")
+    if 'query_class' in root.attributes:
+        lines.append(f"Admission: {root.attributes['query_class']}, queued {root.attributes.get('queued_ms', 0):.3f} ms")
+    if 'memory_peak' in root.attributes:
+        spilled = f", spilled {root.attributes['spilled'] / 1024:.0f} kB" if root.attributes.get('spilled') else ''
+        lines.append(f"Memory: peak {root.attributes['memory_peak'] / 1024:.0f} kB{spilled}")
+    lines.append(f"Execution Time: {execution:.3f} ms")
+    lines.append(f"Query Id: {root.query_id}")
+    return lines
@@ -0,0 +1,517 @@
+"""
+Vectorized execution of the master-side operators over Batches of NumPy column
+vectors, falling back to compile_expression where there is no vectorized form.
+"""
+import numpy as np
+import sqlglot.expressions as exp
+from decimal import Decimal
+
+from expressions import ARITHMETIC, COMPARISONS, coerce_pair, compile_expression, parse_number
+
+NUMERIC = 'iuf'
+INT64 = np.iinfo(np.int64)
+# Integer results whose float estimate exceeds this may not fit in int64, and are computed exactly instead.
+INT64_SAFE = 2.0 ** 62
+
+NUMPY_ARITHMETIC = {exp.Add: np.add, exp.Sub: np.subtract, exp.Mul: np.multiply}
+NUMPY_COMPARISONS = {
+    exp.EQ: np.equal, exp.NEQ: np.not_equal, exp.GT: np.greater,
+    exp.GTE: np.greater_equal, exp.LT: np.less, exp.LTE: np.less_equal,
+}
+
+class Vector:
+    """A column of values (a 0-d array for a constant) and a mask of its NULLs, or None."""
+    __slots__ = ('values', 'nulls')
+
+    def __init__(self, values, nulls=None):
+        self.values = values
+        self.nulls = nulls
+
+    @classmethod
+    def from_values(cls, values):
+        """A vector of Python values, with the narrowest dtype that holds them exactly."""
+        nulls = np.fromiter((value is None for value in values), bool, len(values))
+        has_nulls = bool(nulls.any())
+        kinds = set(map(type, values))
+        kinds.discard(type(None))
+        dtype = None
+        if kinds == {bool}:
+            dtype = bool
+        elif kinds and kinds <= {int, float}:
+            dtype = np.int64 if kinds == {int} else np.float64
+        if dtype is not None:
+            try:
+                return cls(np.array([0 if value is None else value for value in values] if has_nulls else values, dtype),
+                           nulls if has_nulls else None)
+            except OverflowError:
+                pass
+        array = np.empty(len(values), dtype=object)
+        array[:] = values
+        return cls(array, nulls if has_nulls else None)
+
+    @classmethod
+    def constant(cls, value):
+        if value is None:
+            return cls(np.empty((), dtype=object), np.array(True))
+        if type(value) in (bool, float) or (type(value) is int and INT64.min <= value <= INT64.max):
+            return cls(np.array(value))
+        array = np.empty((), dtype=object)
+        array[()] = value
+        return cls(array)
+
+    @property
+    def is_constant(self):
+        return self.values.ndim == 0
+
+    def scalar(self):
+        return None if self.nulls is not None and self.nulls.all() else self.values.item()
+
+    def expand(self, length):
+        """The vector with a constant repeated `length` times."""
+        if not self.is_constant:
+            return self
+        if self.nulls is not None and self.nulls:
+            return Vector(np.empty(length, dtype=object), np.ones(length, bool))
+        return Vector(np.full(length, self.values.item(), dtype=self.values.dtype))
+
+    def take(self, indices, missing=None):
+        """The values at `indices`; positions where `missing` is set become NULL."""
+        if missing is None or not missing.any():
+            return Vector(self.values[indices], None if self.nulls is None else self.nulls[indices])
+        if not len(self.values):
+            return Vector(np.empty(len(indices), dtype=self.values.dtype), np.ones(len(indices), bool))
+        indices = np.where(missing, 0, indices)
+        nulls = missing if self.nulls is None else self.nulls[indices] | missing
+        return Vector(self.values[indices], nulls)
+
+    def tolist(self):
+        values = self.values.tolist()
+        if self.nulls is not None:
+            for i in np.flatnonzero(self.nulls).tolist():
+                values[i] = None
+        return values
+
+class Batch:
+    """Equally long named column vectors: the rows flowing between the master's operators."""
+    def __init__(self, columns, length):
+        self.columns = columns
+        self.length = length
+        self._rows = None
+
+    @classmethod
+    def from_rows(cls, rows, names):
+        return cls({name: Vector.from_values([row.get(name) for row in rows]) for name in names}, len(rows))
+
+    def __len__(self):
+        return self.length
+
+    def column(self, name):
+        vector = self.columns.get(name)
+        if vector is None:
+            return Vector(np.empty(self.length, dtype=object), np.ones(self.length, bool))
+        return vector
+
+    def rows(self):
+        """The batch as row dicts, for expressions that have no vectorized form."""
+        if self._rows is None:
+            self._rows = to_rows(list(self.columns.items()), self.length)
+        return self._rows
+
+    def take(self, indices, missing=None):
+        return Batch({name: vector.take(indices, missing) for name, vector in self.columns.items()}, len(indices))
+
+    def filter(self, mask):
+        return self.take(np.flatnonzero(mask))
+
+    def combine(self, other):
+        """The columns of both batches side by side."""
+        return Batch({**self.columns, **other.columns}, self.length)
+
+def to_rows(columns, length):
+    """Row dicts from (name, vector) pairs."""
+    names = [name for name, _ in columns]
+    values = [vector.expand(length).tolist() for _, vector in columns]
+    return [dict(zip(names, row)) for row in zip(*values)] if names else [{} for _ in range(length)]
+
+def truth(vector, length):
+    """A bool mask of the rows where `vector` is true (not false or NULL)."""
+    values = vector.values if vector.values.dtype == bool else vector.values.astype(bool)
+    if vector.nulls is not None:
+        values = values & ~vector.nulls
+    return np.broadcast_to(values, (length,))
+
+def _either_null(a, b):
+    if a.nulls is None:
+        return b.nulls
+    if b.nulls is None:
+        return a.nulls
+    return a.nulls | b.nulls
+
+def _result(values, nulls):
+    """A vector of `values` whose NULL mask (possibly that of a NULL constant) is brought to their shape."""
+    if nulls is not None and nulls.shape != values.shape:
+        nulls = np.broadcast_to(nulls, values.shape).copy()
+    return Vector(values, nulls)
+
+def _apply(fn, a, b):
+    if a is None or b is None:
+        return None
+    return fn(*coerce_pair(a, b))
+
+def _pairwise(fn, numpy_op, a, b, nulls):
+    """Applies a binary operator with an object operand to the non-NULL positions, coercing like the row evaluator."""
+    x, y = np.broadcast_arrays(a.values.astype(object, copy=False), b.values.astype(object, copy=False))
+    live = None if nulls is None else np.flatnonzero(~np.broadcast_to(nulls, x.shape))
+    xs, ys = (x, y) if live is None else (x[live], y[live])
+    values = None
+    if len(xs) and numpy_op is not None:
+        first, second = coerce_pair(xs[0], ys[0])
+        if (first is xs[0] or a.is_constant) and (second is ys[0] or b.is_constant):
+            if first is not xs[0]:
+                xs = np.broadcast_to(np.array(first, dtype=object), xs.shape)
+            if second is not ys[0]:
+                ys = np.broadcast_to(np.array(second, dtype=object), ys.shape)
+            try:
+                values = numpy_op(xs, ys)
+            except TypeError:
+                values = None
+    if values is None:
+        values = [fn(*coerce_pair(p, q)) for p, q in zip(xs.tolist(), ys.tolist())]
+    out = np.empty(x.shape, dtype=object)
+    if live is None:
+        out[:] = values
+    else:
+        out[live] = values
+    return _result(out, nulls)
+
+def _may_overflow(op, x, y):
+    """True when the int64 result of op(x, y) might wrap around."""
+    if x.dtype.kind not in 'iu' or y.dtype.kind not in 'iu':
+        return False
+    estimate = op(x.astype(np.float64), y.astype(np.float64))
+    return bool(estimate.size) and bool(np.abs(estimate).max() > INT64_SAFE)
+
+def _arithmetic(kind, a, b):
+    if a.is_constant and b.is_constant:
+        return Vector.constant(_apply(ARITHMETIC[kind], a.scalar(), b.scalar()))
+    nulls = _either_null(a, b)
+    x, y = a.values, b.values
+    if x.dtype.kind not in NUMERIC or y.dtype.kind not in NUMERIC:
+        return _pairwise(ARITHMETIC[kind], NUMPY_ARITHMETIC.get(kind), a, b, nulls)
+    if kind not in (exp.Div, exp.Mod):
+        if _may_overflow(NUMPY_ARITHMETIC[kind], x, y):
+            # Python ints, like the row evaluator.
+            return _pairwise(ARITHMETIC[kind], None, a, b, nulls)
+        return _result(NUMPY_ARITHMETIC[kind](x, y), nulls)
+    zero = y == 0
+    if nulls is not None:
+        zero = zero & ~nulls
+    if zero.any():
+        raise ZeroDivisionError("division by zero")
+    y = np.where(y == 0, 1, y)
+    if x.dtype.kind in 'iu' and y.dtype.kind in 'iu':
+        if (x == INT64.min).any():
+            return _pairwise(ARITHMETIC[kind], None, a, b, nulls)
+        # Integer division and modulo truncate toward zero, as in Postgres.
+        if kind is exp.Div:
+            result, negative = np.abs(x) // np.abs(y), (x < 0) != (y < 0)
+        else:
+            result, negative = np.abs(x) % np.abs(y), x < 0
+        return _result(np.where(negative, -result, result), nulls)
+    return _result(x / y if kind is exp.Div else np.mod(x, y), nulls)
+
+def _compare(kind, a, b):
+    if a.is_constant and b.is_constant:
+        return Vector.constant(_apply(COMPARISONS[kind], a.scalar(), b.scalar()))
+    nulls = _either_null(a, b)
+    if a.values.dtype.kind in 'b' + NUMERIC and b.values.dtype.kind in 'b' + NUMERIC:
+        return _result(NUMPY_COMPARISONS[kind](a.values, b.values), nulls)
+    result = _pairwise(COMPARISONS[kind], NUMPY_COMPARISONS[kind], a, b, nulls)
+    return Vector(result.values.astype(bool), result.nulls)
+
+def _negate(a):
+    if a.values.dtype.kind in NUMERIC and not (a.values.dtype.kind == 'i' and (a.values == INT64.min).any()):
+        return Vector(-a.values, a.nulls)
+    if a.is_constant:
+        value = a.scalar()
+        return Vector.constant(None if value is None else -value)
+    out = np.empty(a.values.shape, dtype=object)
+    live = slice(None) if a.nulls is None else ~a.nulls
+    out[live] = -a.values[live].astype(object)
+    return Vector(out, a.nulls)
+
+def _logic(vector):
+    """(true mask, NULL mask) of a boolean vector."""
+    nulls = vector.nulls if vector.nulls is not None else np.False_
+    values = vector.values if vector.values.dtype == bool else vector.values.astype(bool)
+    return values & ~nulls, nulls
+
+def _and(a, b):
+    (a_true, a_null), (b_true, b_null) = _logic(a), _logic(b)
+    false = (~a_true & ~a_null) | (~b_true & ~b_null)
+    nulls = ~false & (a_null | b_null)
+    return Vector(a_true & b_true, nulls if nulls.any() else None)
+
+def _or(a, b):
+    (a_true, a_null), (b_true, b_null) = _logic(a), _logic(b)
+    true = a_true | b_true
+    nulls = ~true & (a_null | b_null)
+    return Vector(true, nulls if nulls.any() else None)
+
+def _not(a):
+    true, nulls = _logic(a)
+    return Vector(~true, a.nulls)
+
+def _is_null(a):
+    return Vector(np.zeros(a.values.shape, bool) if a.nulls is None else a.nulls.copy())
+
+def compile_vector(node, resolve):
+    """Compiles a sqlglot expression into a function of a Batch that returns a Vector."""
+    def build(node):
+        if isinstance(node, (exp.Paren, exp.Alias)):
+            return build(node.this)
+
+        if isinstance(node, exp.Column):
+            name = resolve(node)
+            return lambda batch: batch.column(name)
+
+        if isinstance(node, (exp.Literal, exp.Null, exp.Boolean)):
+            if isinstance(node, exp.Literal):
+                value = Vector.constant(node.this if node.is_string else parse_number(node.this))
+            else:
+                value = Vector.constant(node.this if isinstance(node, exp.Boolean) else None)
+            return lambda batch: value
+
+        if isinstance(node, exp.Neg):
+            operand = build(node.this)
+            return lambda batch: _negate(operand(batch))
+
+        kind = type(node)
+        if kind in ARITHMETIC or kind in COMPARISONS:
+            op = _arithmetic if kind in ARITHMETIC else _compare
+            left, right = build(node.this), build(node.expression)
+            return lambda batch: op(kind, left(batch), right(batch))
+
+        if isinstance(node, (exp.And, exp.Or)):
+            op = _and if isinstance(node, exp.And) else _or
+            left, right = build(node.this), build(node.expression)
+            return lambda batch: op(left(batch), right(batch))
+
+        if isinstance(node, exp.Not):
+            operand = build(node.this)
+            return lambda batch: _not(operand(batch))
+
+        if isinstance(node, exp.Is) and isinstance(node.expression, exp.Null):
+            operand = build(node.this)
+            return lambda batch: _is_null(operand(batch))
+
+        if isinstance(node, exp.In) and not node.args.get('query') and node.expressions:
+            # x IN (a, b) is x = a OR x = b, NULLs included.
+            operand, options = build(node.this), [build(option) for option in node.expressions]
+            def in_(batch):
+                value = operand(batch)
+                result = _compare(exp.EQ, value, options[0](batch))
+                for option in options[1:]:
+                    result = _or(result, _compare(exp.EQ, value, option(batch)))
+                return result
+            return in_
+
+        if isinstance(node, exp.Between):
+            operand, low, high = build(node.this), build(node.args['low']), build(node.args['high'])
+            def between(batch):
+                value = operand(batch)
+                return _and(_compare(exp.GTE, value, low(batch)), _compare(exp.LTE, value, high(batch)))
+            return between
+
+        evaluate = compile_expression(node, resolve)
+        return lambda batch: Vector.from_values([evaluate(row) for row in batch.rows()])
+
+    return build(node)
+
+def compile_predicate_vector(node, resolve):
+    """Like compile_vector, but the result is the mask of the rows where the predicate holds."""
+    evaluate = compile_vector(node, resolve)
+    return lambda batch: truth(evaluate(batch), len(batch))
+
+def _cross(left_length, right_length):
+    return np.repeat(np.arange(left_length), right_length), np.tile(np.arange(right_length), left_length)
+
+def _match_sorted(probe, build):
+    """Equal-key pairs of two numeric key columns: binary search of the probe keys in the sorted build keys."""
+    probe_rows = np.arange(len(probe.values)) if probe.nulls is None else np.flatnonzero(~probe.nulls)
+    build_rows = np.arange(len(build.values)) if build.nulls is None else np.flatnonzero(~build.nulls)
+    build_rows = build_rows[np.argsort(build.values[build_rows], kind='stable')]
+    keys, wanted = build.values[build_rows], probe.values[probe_rows]
+    start = np.searchsorted(keys, wanted, 'left')
+    counts = np.searchsorted(keys, wanted, 'right') - start
+    probe_rows = np.repeat(probe_rows, counts)
+    offsets = np.arange(len(probe_rows)) - np.repeat(np.cumsum(counts) - counts, counts)
+    return probe_rows, build_rows[np.repeat(start, counts) + offsets]
+
+def _match_hashed(probe, build):
+    """Equal-key pairs of composite or non-numeric keys, through a hash table on the build side."""
+    table = {}
+    for j, key in enumerate(zip(*[vector.tolist() for vector in build])):
+        if None not in key:
+            table.setdefault(key, []).append(j)
+    probe_rows, build_rows = [], []
+    for i, key in enumerate(zip(*[vector.tolist() for vector in probe])):
+        matches = table.get(key)
+        if matches:
+            probe_rows.extend([i] * len(matches))
+            build_rows.extend(matches)
+    return np.array(probe_rows, dtype=np.int64), np.array(build_rows, dtype=np.int64)
+
+def _match(left, right, left_length, right_length):
+    """(left rows, right rows) index arrays of the row pairs whose keys are all equal and not NULL."""
+    if not left:
+        return _cross(left_length, right_length)
+    if len(left) == 1 and left[0].values.dtype.kind in NUMERIC and right[0].values.dtype.kind in NUMERIC:
+        return _match_sorted(left[0], right[0])
+    # The hash table goes on the smaller side.
+    if right_length <= left_length:
+        return _match_hashed(left, right)
+    right_rows, left_rows = _match_hashed(right, left)
+    return left_rows, right_rows
+
+def _unmatched(rows, length):
+    matched = np.zeros(length, bool)
+    matched[rows] = True
+    return np.flatnonzero(~matched)
+
+def hash_join(left, right, left_keys, right_keys, how='INNER', condition=None):
+    """Joins the Batches `left` and `right` on `left_keys` = `right_keys` and the row mask `condition`."""
+    left_rows, right_rows = _match([left.column(key) for key in left_keys], [right.column(key) for key in right_keys],
+                                   len(left), len(right))
+    if condition is not None and len(left_rows):
+        keep = condition(left.take(left_rows).combine(right.take(right_rows)))
+        left_rows, right_rows = left_rows[keep], right_rows[keep]
+    if how in ('LEFT', 'FULL'):
+        unmatched = _unmatched(left_rows, len(left))
+        left_rows = np.concatenate([left_rows, unmatched])
+        right_rows = np.concatenate([right_rows, np.full(len(unmatched), -1)])
+    if how in ('RIGHT', 'FULL'):
+        unmatched = _unmatched(right_rows[right_rows >= 0], len(right))
+        left_rows = np.concatenate([left_rows, np.full(len(unmatched), -1)])
+        right_rows = np.concatenate([right_rows, unmatched])
+    return left.take(left_rows, left_rows < 0).combine(right.take(right_rows, right_rows < 0))
+
+def factorize(vectors, length):
+    """Numbers the distinct key tuples of the rows: returns the code of every row and the first row of every code."""
+    if len(vectors) == 1 and vectors[0].nulls is None and vectors[0].values.dtype.kind in 'b' + NUMERIC:
+        _, first, codes = np.unique(vectors[0].values, return_index=True, return_inverse=True)
+        return codes.reshape(-1), first
+    table = {}
+    keys = zip(*[vector.tolist() for vector in vectors]) if vectors else [()] * length
+    codes = np.fromiter((table.setdefault(key, len(table)) for key in keys), np.int64, length)
+    return codes, np.unique(codes, return_index=True)[1]
+
+def distinct_rows(vectors, length):
+    """The first row of every distinct combination of `vectors`, in input order."""
+    _, first = factorize([vector.expand(length) for vector in vectors], length)
+    return np.sort(first)
+
+def _ranks(vector):
+    """Numbers that sort like the vector's non-NULL values."""
+    values = vector.values
+    if values.dtype.kind in NUMERIC:
+        return values if vector.nulls is None else np.where(vector.nulls, 0, values)
+    if values.dtype == bool:
+        return values.astype(np.int8)
+    ranks = np.zeros(len(values), dtype=np.float64)
+    live = slice(None) if vector.nulls is None else ~vector.nulls
+    values = values[live]
+    ranks[live] = _decimal_ranks(values) if len(values) and set(map(type, values)) == {Decimal} else \
+        np.unique(values, return_inverse=True)[1].reshape(-1)
+    return ranks
+
+def _decimal_ranks(values):
+    """Decimals as floats, which sort much faster, unless that merges distinct values."""
+    floats = values.astype(np.float64)
+    order = np.argsort(floats, kind='stable')
+    ties = np.flatnonzero(floats[order[1:]] == floats[order[:-1]])
+    if any(values[order[i]] != values[order[i + 1]] for i in ties.tolist()):
+        return np.unique(values, return_inverse=True)[1].reshape(-1)
+    return floats
+
+def sort_indices(batch, keys):
+    """The row order of `batch` by (evaluate, desc, nulls_first) sort keys."""
+    length = len(batch)
+    columns = []
+    # np.lexsort sorts by its last key first, and within a key NULL placement comes before the value.
+    for evaluate, desc, nulls_first in reversed(keys):
+        vector = evaluate(batch).expand(length)
+        ranks = _ranks(vector)
+        nulls = vector.nulls if vector.nulls is not None else np.zeros(length, bool)
+        columns.append(-ranks if desc else ranks)
+        columns.append(~nulls if nulls_first else nulls)
+    return np.lexsort(columns) if columns else np.arange(length)
+
+def compile_aggregate(group_exprs, partials, resolve):
+    """Computes the partial aggregates of an AggregationPlan over a Batch as {group key tuple: [partial, ...]}."""
+    keys = [compile_vector(node, resolve) for node in group_exprs]
+    aggregates = [_compile_partial(node, resolve) for _, node, _ in partials]
+
+    def aggregate(batch):
+        length = len(batch)
+        if not length:
+            return {}
+        vectors = [evaluate(batch).expand(length) for evaluate in keys]
+        codes, first = factorize(vectors, length)
+        columns = [vector.take(first).tolist() for vector in vectors]
+        values = [partial(batch, codes, len(first)) for partial in aggregates]
+        return {key: [partial[group] for partial in values]
+                for group, key in enumerate(zip(*columns) if columns else [()])}
+    return aggregate
+
+def _compile_partial(node, resolve):
+    """One COUNT, SUM, MIN or MAX partial (with an optional FILTER) as a function of (batch, codes, groups)."""
+    condition = None
+    if isinstance(node, exp.Filter):
+        where = node.expression
+        node, condition = node.this, compile_predicate_vector(where.this if isinstance(where, exp.Where) else where, resolve)
+    kind = type(node)
+    if kind not in (exp.Count, exp.Sum, exp.Min, exp.Max):
+        raise Exception(f"Aggregate function not supported on joined rows: {node.sql()}")
+    argument = None if isinstance(node.this, exp.Star) else compile_vector(node.this, resolve)
+
+    def partial(batch, codes, groups):
+        live = condition(batch) if condition else None
+        if argument is not None:
+            vector = argument(batch).expand(len(batch))
+            if vector.nulls is not None:
+                live = ~vector.nulls if live is None else live & ~vector.nulls
+        rows = codes if live is None else codes[live]
+        counts = np.bincount(rows, minlength=groups)
+        if kind is exp.Count:
+            return counts.tolist()
+        values = vector.values if live is None else vector.values[live]
+        if values.dtype.kind in NUMERIC:
+            if kind is exp.Sum:
+                if values.dtype.kind == 'f':
+                    result = np.bincount(rows, weights=values, minlength=groups)
+                elif len(values) and np.abs(values.astype(np.float64)).sum() > INT64_SAFE:
+                    # The int64 sum might wrap around: add Python ints instead.
+                    result = np.zeros(groups, dtype=object)
+                    np.add.at(result, rows, values.astype(object))
+                else:
+                    result = np.zeros(groups, dtype=values.dtype)
+                    np.add.at(result, rows, values)
+            else:
+                result = np.full(groups, values.max() if kind is exp.Min else values.min(), dtype=values.dtype) \
+                    if len(values) else np.zeros(groups, dtype=values.dtype)
+                (np.minimum if kind is exp.Min else np.maximum).at(result, rows, values)
+            result = result.tolist()
+        elif kind is exp.Sum:
+            result = np.zeros(groups, dtype=object)
+            np.add.at(result, rows, values)
+            result = result.tolist()
+        else:
+            result = [None] * groups
+            smaller = kind is exp.Min
+            for group, value in zip(rows.tolist(), values.tolist()):
+                current = result[group]
+                if current is None or (value < current if smaller else value > current):
+                    result[group] = value
+        return [value if count else None for value, count in zip(result, counts.tolist())]
+    return partial
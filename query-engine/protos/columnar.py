@@ -0,0 +1,124 @@
+"""Encoding and decoding of query results as `ColumnBatch` messages, shared by the master and the workers."""
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
+
+from protos import query_pb2
+
+EPOCH_DATE = date(1970, 1, 1)
+EPOCH = datetime(1970, 1, 1)
+EPOCH_UTC = datetime(1970, 1, 1, tzinfo=timezone.utc)
+ONE_MICROSECOND = timedelta(microseconds=1)
+INT64_MIN, INT64_MAX = -(1 << 63), (1 << 63) - 1
+
+def _column_type(values):
+    kind = None
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            current = query_pb2.BOOL
+        elif isinstance(value, int):
+            current = query_pb2.INT64 if INT64_MIN <= value <= INT64_MAX else query_pb2.STRING
+        elif isinstance(value, float):
+            current = query_pb2.FLOAT64
+        elif isinstance(value, Decimal):
+            current = query_pb2.DECIMAL if value.is_finite() else query_pb2.STRING
+        elif isinstance(value, datetime):
+            current = query_pb2.TIMESTAMP if value.tzinfo is None else query_pb2.TIMESTAMPTZ
+        elif isinstance(value, date):
+            current = query_pb2.DATE
+        else:
+            current = query_pb2.STRING
+        if kind is None:
+            kind = current
+        elif {kind, current} == {query_pb2.INT64, query_pb2.FLOAT64}:
+            # Integral values among floats (e.g. SQLite's numeric affinity) widen instead of turning into text.
+            kind = query_pb2.FLOAT64
+        elif kind != current:
+            return query_pb2.STRING
+    return query_pb2.STRING if kind is None else kind
+
+def _unscaled(value, scale):
+    sign, digits, exponent = value.as_tuple()
+    unscaled = int(''.join(map(str, digits)) or '0') * 10 ** (exponent + scale)
+    return -unscaled if sign else unscaled
+
+def _encode_column(column, values):
+    kind = _column_type(values)
+
+    if kind == query_pb2.DECIMAL:
+        scale = max(0, max(-v.as_tuple().exponent for v in values if v is not None))
+        ints = [0 if v is None else _unscaled(v, scale) for v in values]
+        if all(INT64_MIN <= i <= INT64_MAX for i in ints):
+            column.scale = scale
+            column.ints.extend(ints)
+        else:
+            kind = query_pb2.STRING
+
+    column.type = kind
+    if kind == query_pb2.INT64:
+        column.ints.extend([0 if v is None else v for v in values])
+    elif kind == query_pb2.FLOAT64:
+        column.doubles.extend([0.0 if v is None else v for v in values])
+    elif kind == query_pb2.BOOL:
+        column.bools.extend([False if v is None else v for v in values])
+    elif kind == query_pb2.DATE:
+        column.ints.extend([0 if v is None else (v - EPOCH_DATE).days for v in values])
+    elif kind == query_pb2.TIMESTAMP:
+        column.ints.extend([0 if v is None else (v - EPOCH) // ONE_MICROSECOND for v in values])
+    elif kind == query_pb2.TIMESTAMPTZ:
+        column.ints.extend([0 if v is None else (v - EPOCH_UTC) // ONE_MICROSECOND for v in values])
+    elif kind == query_pb2.STRING:
+        column.strings.extend(['' if v is None else str(v) for v in values])
+
+    if any(v is None for v in values):
+        column.nulls.extend([v is None for v in values])
+
+def encode_rows(colnames, rows):
+    """Encodes a sequence of row tuples into a ColumnBatch."""
+    batch = query_pb2.ColumnBatch(num_rows=len(rows))
+    columns = list(zip(*rows)) if rows else [()] * len(colnames)
+    for name, values in zip(colnames, columns):
+        _encode_column(batch.columns.add(name=name), values)
+    return batch
+
+def encode_dicts(rows):
+    """Encodes a list of row dicts; columns appear in first-seen order."""
+    colnames = list(dict.fromkeys(name for row in rows for name in row))
+    return encode_rows(colnames, [tuple(row.get(name) for name in colnames) for row in rows])
+
+def decode_column(column, num_rows):
+    """Returns the values of one column as a list of Python objects."""
+    kind = column.type
+    if kind == query_pb2.INT64:
+        values = list(column.ints)
+    elif kind == query_pb2.FLOAT64:
+        values = list(column.doubles)
+    elif kind == query_pb2.DECIMAL:
+        values = [Decimal(v).scaleb(-column.scale) for v in column.ints]
+    elif kind == query_pb2.BOOL:
+        values = list(column.bools)
+    elif kind == query_pb2.DATE:
+        values = [EPOCH_DATE + timedelta(days=v) for v in column.ints]
+    elif kind == query_pb2.TIMESTAMP:
+        values = [EPOCH + v * ONE_MICROSECOND for v in column.ints]
+    elif kind == query_pb2.TIMESTAMPTZ:
+        values = [EPOCH_UTC + v * ONE_MICROSECOND for v in column.ints]
+    else:
+        values = list(column.strings)
+
+    if not values:
+        values = [None] * num_rows
+    if column.nulls:
+        values = [None if is_null else v for v, is_null in zip(values, column.nulls)]
+    return values
+
+def decode_columns(batch):
+    """Returns {column name: list of values} for a ColumnBatch."""
+    return {column.name: decode_column(column, batch.num_rows) for column in batch.columns}
+
+def decode_rows(batch):
+    """Returns the rows of a ColumnBatch as a list of dicts."""
+    names = [column.name for column in batch.columns]
+    columns = [decode_column(column, batch.num_rows) for column in batch.columns]
+    return [dict(zip(names, row)) for row in zip(*columns)] if columns else [{} for _ in range(batch.num_rows)]
@@ -24,23 +24,41 @@ _sym_db = _symbol_database.Default()
 
 
 
-DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0bquery.proto\x12\x05query\"\x1b\n\x0cQueryRequest\x12\x0b\n\x03sql\x18\x01 \x01(\t\"J\n\rQueryResponse\x12\x13\n\x0bresult_json\x18\x01 \x01(\t\x12\r\n\x05\x65rror\x18\x02 \x01(\x08\x12\x15\n\rerror_message\x18\x03 \x01(\t\"9\n\x0fSubQueryRequest\x12\x11\n\tquery_sql\x18\x01 \x01(\t\x12\x13\n\x0bparams_json\x18\x02 \x01(\t\"$\n\rPartialResult\x12\x13\n\x0bresult_json\x18\x01 \x01(\t2J\n\rMasterService\x12\x39\n\x0c\x45xecuteQuery\x12\x13.query.QueryRequest\x1a\x14.query.QueryResponse2O\n\x0cQueryService\x12?\n\x0f\x45xecuteSubQuery\x12\x16.query.SubQueryRequest\x1a\x14.query.PartialResultb\x06proto3')
+DESCRIPTOR = _descriptor_pool.Default().AddSerializedFile(b'\n\x0bquery.proto\x12\x05query\"@\n\x0cQueryRequest\x12\x0b\n\x03sql\x18\x01 \x01(\t\x12#\n\x06\x66ormat\x18\x02 \x01(\x0e\x32\x13.query.ResultFormat\"o\n\rQueryResponse\x12\x13\n\x0bresult_json\x18\x01 \x01(\t\x12\r\n\x05\x65rror\x18\x02 \x01(\x08\x12\x15\n\rerror_message\x18\x03 \x01(\t\x12#\n\x07\x63olumns\x18\x04 \x01(\x0b\x32\x12.query.ColumnBatch\"r\n\x0f\x42ulkLoadRequest\x12\r\n\x05table\x18\x01 \x01(\t\x12!\n\x06\x66ormat\x18\x02 \x01(\x0e\x32\x11.query.LoadFormat\x12\x0f\n\x07\x63olumns\x18\x03 \x03(\t\x12\x0e\n\x06header\x18\x04 \x01(\x08\x12\x0c\n\x04\x64\x61ta\x18\x05 \x01(\x0c\"M\n\x10\x42ulkLoadResponse\x12\x13\n\x0brows_loaded\x18\x01 \x01(\x03\x12\r\n\x05\x65rror\x18\x02 \x01(\x08\x12\x15\n\rerror_message\x18\x03 \x01(\t\"r\n\x0fSubQueryRequest\x12\x11\n\tquery_sql\x18\x01 \x01(\t\x12\x13\n\x0bparams_json\x18\x02 \x01(\t\x12\x12\n\nbatch_size\x18\x03 \x01(\x05\x12#\n\x06\x66ormat\x18\x04 \x01(\x0e\x32\x13.query.ResultFormat\"E\n\x11\x42ulkInsertRequest\x12\r\n\x05table\x18\x01 \x01(\t\x12\x0f\n\x07\x63olumns\x18\x02 \x03(\t\x12\x10\n\x08\x63sv_data\x18\x03 \x01(\x0c\"#\n\x11StatisticsRequest\x12\x0e\n\x06tables\x18\x01 \x03(\t\"I\n\rPartialResult\x12\x13\n\x0bresult_json\x18\x01 \x01(\t\x12#\n\x07\x63olumns\x18\x02 \x01(\x0b\x32\x12.query.ColumnBatch\"\x94\x01\n\x06\x43olumn\x12\x0c\n\x04name\x18\x01 \x01(\t\x12\x1f\n\x04type\x18\x02 \x01(\x0e\x32\x11.query.ColumnType\x12\r\n\x05scale\x18\x03 \x01(\x05\x12\r\n\x05nulls\x18\x04 \x03(\x08\x12\x0c\n\x04ints\x18\x05 \x03(\x12\x12\x0f\n\x07\x64oubles\x18\x06 \x03(\x01\x12\x0f\n\x07strings\x18\x07 \x03(\t\x12\r\n\x05\x62ools\x18\x08 \x03(\x08\"?\n\x0b\x43olumnBatch\x12\x10\n\x08num_rows\x18\x01 \x01(\x05\x12\x1e\n\x07\x63olumns\x18\x02 \x03(\x0b\x32\r.query.Column*!\n\nLoadFormat\x12\x07\n\x03\x43SV\x10\x00\x12\n\n\x06NDJSON\x10\x01*&\n\x0cResultFormat\x12\x08\n\x04JSON\x10\x00\x12\x0c\n\x08\x43OLUMNAR\x10\x01*q\n\nColumnType\x12\n\n\x06STRING\x10\x00\x12\t\n\x05INT64\x10\x01\x12\x0b\n\x07\x46LOAT64\x10\x02\x12\x0b\n\x07\x44\x45\x43IMAL\x10\x03\x12\x08\n\x04\x42OOL\x10\x04\x12\x08\n\x04\x44\x41TE\x10\x05\x12\r\n\tTIMESTAMP\x10\x06\x12\x0f\n\x0bTIMESTAMPTZ\x10\x07\x32\x89\x01\n\rMasterService\x12\x39\n\x0c\x45xecuteQuery\x12\x13.query.QueryRequest\x1a\x14.query.QueryResponse\x12=\n\x08\x42ulkLoad\x12\x16.query.BulkLoadRequest\x1a\x17.query.BulkLoadResponse(\x01\x32\x9b\x02\n\x0cQueryService\x12?\n\x0f\x45xecuteSubQuery\x12\x16.query.SubQueryRequest\x1a\x14.query.PartialResult\x12G\n\x15\x45xecuteSubQueryStream\x12\x16.query.SubQueryRequest\x1a\x14.query.PartialResult0\x01\x12<\n\nBulkInsert\x12\x18.query.BulkInsertRequest\x1a\x14.query.PartialResult\x12\x43\n\x11\x43ollectStatistics\x12\x18.query.StatisticsRequest\x1a\x14.query.PartialResultb\x06proto3')
 
 _globals = globals()
 _builder.BuildMessageAndEnumDescriptors(DESCRIPTOR, _globals)
 _builder.BuildTopDescriptorsAndMessages(DESCRIPTOR, 'query_pb2', _globals)
 if not _descriptor._USE_C_DESCRIPTORS:
   DESCRIPTOR._loaded_options = None
+  _globals['_LOADFORMAT']._serialized_start=911
+  _globals['_LOADFORMAT']._serialized_end=944
+  _globals['_RESULTFORMAT']._serialized_start=946
+  _globals['_RESULTFORMAT']._serialized_end=984
+  _globals['_COLUMNTYPE']._serialized_start=986
+  _globals['_COLUMNTYPE']._serialized_end=1099
   _globals['_QUERYREQUEST']._serialized_start=22
-  _globals['_QUERYREQUEST']._serialized_end=49
-  _globals['_QUERYRESPONSE']._serialized_start=51
-  _globals['_QUERYRESPONSE']._serialized_end=125
-  _globals['_SUBQUERYREQUEST']._serialized_start=127
-  _globals['_SUBQUERYREQUEST']._serialized_end=184
-  _globals['_PARTIALRESULT']._serialized_start=186
-  _globals['_PARTIALRESULT']._serialized_end=222
-  _globals['_MASTERSERVICE']._serialized_start=224
-  _globals['_MASTERSERVICE']._serialized_end=298
-  _globals['_QUERYSERVICE']._serialized_start=300
-  _globals['_QUERYSERVICE']._serialized_end=379
+  _globals['_QUERYREQUEST']._serialized_end=86
+  _globals['_QUERYRESPONSE']._serialized_start=88
+  _globals['_QUERYRESPONSE']._serialized_end=199
+  _globals['_BULKLOADREQUEST']._serialized_start=201
+  _globals['_BULKLOADREQUEST']._serialized_end=315
+  _globals['_BULKLOADRESPONSE']._serialized_start=317
+  _globals['_BULKLOADRESPONSE']._serialized_end=394
+  _globals['_SUBQUERYREQUEST']._serialized_start=396
+  _globals['_SUBQUERYREQUEST']._serialized_end=510
+  _globals['_BULKINSERTREQUEST']._serialized_start=512
+  _globals['_BULKINSERTREQUEST']._serialized_end=581
+  _globals['_STATISTICSREQUEST']._serialized_start=583
+  _globals['_STATISTICSREQUEST']._serialized_end=618
+  _globals['_PARTIALRESULT']._serialized_start=620
+  _globals['_PARTIALRESULT']._serialized_end=693
+  _globals['_COLUMN']._serialized_start=696
+  _globals['_COLUMN']._serialized_end=844
+  _globals['_COLUMNBATCH']._serialized_start=846
+  _globals['_COLUMNBATCH']._serialized_end=909
+  _globals['_MASTERSERVICE']._serialized_start=1102
+  _globals['_MASTERSERVICE']._serialized_end=1239
+  _globals['_QUERYSERVICE']._serialized_start=1242
+  _globals['_QUERYSERVICE']._serialized_end=1525
 # @@protoc_insertion_point(module_scope)
@@ -40,6 +40,11 @@ class MasterServiceStub(object):
                 request_serializer=query__pb2.QueryRequest.SerializeToString,
                 response_deserializer=query__pb2.QueryResponse.FromString,
                 _registered_method=True)
+        self.BulkLoad = channel.stream_unary(
+                '/query.MasterService/BulkLoad',
+                request_serializer=query__pb2.BulkLoadRequest.SerializeToString,
+                response_deserializer=query__pb2.BulkLoadResponse.FromString,
+                _registered_method=True)
 
 
 class MasterServiceServicer(object):
@@ -52,6 +57,13 @@ class MasterServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def BulkLoad(self, request_iterator, context):
+        """Streams CSV or NDJSON rows into a partitioned table.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_MasterServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -60,6 +72,11 @@ def add_MasterServiceServicer_to_server(servicer, server):
                     request_deserializer=query__pb2.QueryRequest.FromString,
                     response_serializer=query__pb2.QueryResponse.SerializeToString,
             ),
+            'BulkLoad': grpc.stream_unary_rpc_method_handler(
+                    servicer.BulkLoad,
+                    request_deserializer=query__pb2.BulkLoadRequest.FromString,
+                    response_serializer=query__pb2.BulkLoadResponse.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'query.MasterService', rpc_method_handlers)
@@ -99,6 +116,33 @@ class MasterService(object):
             metadata,
             _registered_method=True)
 
+    @staticmethod
+    def BulkLoad(request_iterator,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.stream_unary(
+            request_iterator,
+            target,
+            '/query.MasterService/BulkLoad',
+            query__pb2.BulkLoadRequest.SerializeToString,
+            query__pb2.BulkLoadResponse.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
 
 class QueryServiceStub(object):
     """Service for Master -> Worker communication
@@ -115,6 +159,21 @@ class QueryServiceStub(object):
                 request_serializer=query__pb2.SubQueryRequest.SerializeToString,
                 response_deserializer=query__pb2.PartialResult.FromString,
                 _registered_method=True)
+        self.ExecuteSubQueryStream = channel.unary_stream(
+                '/query.QueryService/ExecuteSubQueryStream',
+                request_serializer=query__pb2.SubQueryRequest.SerializeToString,
+                response_deserializer=query__pb2.PartialResult.FromString,
+                _registered_method=True)
+        self.BulkInsert = channel.unary_unary(
+                '/query.QueryService/BulkInsert',
+                request_serializer=query__pb2.BulkInsertRequest.SerializeToString,
+                response_deserializer=query__pb2.PartialResult.FromString,
+                _registered_method=True)
+        self.CollectStatistics = channel.unary_unary(
+                '/query.QueryService/CollectStatistics',
+                request_serializer=query__pb2.StatisticsRequest.SerializeToString,
+                response_deserializer=query__pb2.PartialResult.FromString,
+                _registered_method=True)
 
 
 class QueryServiceServicer(object):
@@ -127,6 +186,27 @@ class QueryServiceServicer(object):
         context.set_details('Method not implemented!')
         raise NotImplementedError('Method not implemented!')
 
+    def ExecuteSubQueryStream(self, request, context):
+        """Streams the rows of a read sub-query back in bounded batches.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def BulkInsert(self, request, context):
+        """Loads a batch of rows into one table with COPY, in a single transaction.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
+    def CollectStatistics(self, request, context):
+        """Row counts and column statistics of the named tables, for the planner.
+        """
+        context.set_code(grpc.StatusCode.UNIMPLEMENTED)
+        context.set_details('Method not implemented!')
+        raise NotImplementedError('Method not implemented!')
+
 
 def add_QueryServiceServicer_to_server(servicer, server):
     rpc_method_handlers = {
@@ -135,6 +215,21 @@ def add_QueryServiceServicer_to_server(servicer, server):
                     request_deserializer=query__pb2.SubQueryRequest.FromString,
                     response_serializer=query__pb2.PartialResult.SerializeToString,
             ),
+            'ExecuteSubQueryStream': grpc.unary_stream_rpc_method_handler(
+                    servicer.ExecuteSubQueryStream,
+                    request_deserializer=query__pb2.SubQueryRequest.FromString,
+                    response_serializer=query__pb2.PartialResult.SerializeToString,
+            ),
+            'BulkInsert': grpc.unary_unary_rpc_method_handler(
+                    servicer.BulkInsert,
+                    request_deserializer=query__pb2.BulkInsertRequest.FromString,
+                    response_serializer=query__pb2.PartialResult.SerializeToString,
+            ),
+            'CollectStatistics': grpc.unary_unary_rpc_method_handler(
+                    servicer.CollectStatistics,
+                    request_deserializer=query__pb2.StatisticsRequest.FromString,
+                    response_serializer=query__pb2.PartialResult.SerializeToString,
+            ),
     }
     generic_handler = grpc.method_handlers_generic_handler(
             'query.QueryService', rpc_method_handlers)
@@ -173,3 +268,84 @@ class QueryService(object):
             timeout,
             metadata,
             _registered_method=True)
+
+    @staticmethod
+    def ExecuteSubQueryStream(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_stream(
+            request,
+            target,
+            '/query.QueryService/ExecuteSubQueryStream',
+            query__pb2.SubQueryRequest.SerializeToString,
+            query__pb2.PartialResult.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def BulkInsert(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/query.QueryService/BulkInsert',
+            query__pb2.BulkInsertRequest.SerializeToString,
+            query__pb2.PartialResult.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
+
+    @staticmethod
+    def CollectStatistics(request,
+            target,
+            options=(),
+            channel_credentials=None,
+            call_credentials=None,
+            insecure=False,
+            compression=None,
+            wait_for_ready=None,
+            timeout=None,
+            metadata=None):
+        return grpc.experimental.unary_unary(
+            request,
+            target,
+            '/query.QueryService/CollectStatistics',
+            query__pb2.StatisticsRequest.SerializeToString,
+            query__pb2.PartialResult.FromString,
+            options,
+            channel_credentials,
+            insecure,
+            call_credentials,
+            compression,
+            wait_for_ready,
+            timeout,
+            metadata,
+            _registered_method=True)
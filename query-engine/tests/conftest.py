@@ -0,0 +1,6 @@
+import os
+import sys
+
+# The master's modules import each other and `protos` as top-level modules, as in its container.
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [os.path.join(ROOT, 'master'), ROOT, os.path.join(ROOT, 'protos')]
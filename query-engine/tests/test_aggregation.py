@@ -0,0 +1,39 @@
+import pytest
+import sqlglot
+
+from aggregation import AggregationPlan, group_distinct, is_aggregate_query, is_distinct_query
+
+def run(plan, *shards):
+    groups = plan.new_state()
+    for rows in shards:
+        plan.merge(groups, rows)
+    return plan.finalize(groups)
+
+def test_distinct_dedupes_rows_repeated_across_shards():
+    parsed = sqlglot.parse_one("SELECT DISTINCT city FROM customers ORDER BY city LIMIT 3", read='postgres')
+    assert is_distinct_query(parsed) and not is_aggregate_query(parsed)
+    plan = AggregationPlan(group_distinct(parsed, ['customer_id', 'city']))
+    assert plan.worker_query.sql(dialect='postgres') == "SELECT city AS _g0 FROM customers GROUP BY city"
+    north = [{'_g0': 'Bangalore'}, {'_g0': 'Chandigarh'}]
+    south = [{'_g0': 'Bangalore'}, {'_g0': 'Chennai'}, {'_g0': 'Chandigarh'}]
+    assert run(plan, north, south) == [{'city': 'Bangalore'}, {'city': 'Chandigarh'}, {'city': 'Chennai'}]
+
+def test_distinct_star_groups_by_every_column():
+    parsed = sqlglot.parse_one("SELECT DISTINCT * FROM t ORDER BY b DESC OFFSET 1", read='postgres')
+    plan = AggregationPlan(group_distinct(parsed, ['a', 'b']))
+    rows = [{'_g0': 1, '_g1': 'x'}, {'_g0': 2, '_g1': 'y'}]
+    assert run(plan, rows, rows) == [{'a': 1, 'b': 'x'}]
+
+def test_distinct_on_is_not_a_plain_distinct():
+    assert not is_distinct_query(sqlglot.parse_one("SELECT DISTINCT ON (a) a, b FROM t", read='postgres'))
+
+def test_aggregates_in_subqueries_do_not_make_an_aggregate_query():
+    parsed = sqlglot.parse_one("SELECT sale_id FROM sales WHERE sale_amount = (SELECT MAX(sale_amount) FROM sales)",
+                               read='postgres')
+    assert not is_aggregate_query(parsed)
+    assert is_aggregate_query(sqlglot.parse_one("SELECT MAX(a) FROM t WHERE b IN (SELECT b FROM u)", read='postgres'))
+
+def test_subqueries_in_aggregate_outputs_are_rejected():
+    parsed = sqlglot.parse_one("SELECT COUNT(*), (SELECT MAX(a) FROM u) FROM t", read='postgres')
+    with pytest.raises(Exception, match="Subqueries are not supported"):
+        AggregationPlan(parsed)
@@ -0,0 +1,113 @@
+import pytest
+import sqlglot
+
+import memory
+from joins import JoinPlan
+from memory import MemoryPool, RowBuffer, estimate_bytes, partition
+
+MB = 2 ** 20
+
+def pool(limit=MB, work_mem=MB, memory_limit=MB, spill_limit=MB, partitions=4):
+    return MemoryPool(limit, work_mem, memory_limit, spill_limit, partitions=partitions)
+
+def rows(count, start=0):
+    return [{'id': i, 'name': f"row {i}"} for i in range(start, start + count)]
+
+def test_query_is_current_inside_the_block():
+    shared = pool()
+    assert memory.current() is None
+    with shared.query() as query_memory:
+        assert memory.current() is query_memory
+        with shared.query() as nested:
+            assert nested is query_memory
+    assert memory.current() is None
+
+def test_reserve_stops_at_work_mem_and_shared_limit():
+    shared = pool(limit=300, work_mem=200)
+    with shared.query() as first:
+        assert first.reserve(150)
+        assert not first.reserve(100)
+        assert first.reserve(50)
+        assert shared.used() == 200
+    assert shared.used() == 0
+    with shared.query() as query_memory:
+        shared.reserve(250)
+        assert not query_memory.reserve(100)
+        shared.release(250)
+
+def test_hold_fails_past_memory_limit():
+    shared = pool(memory_limit=100)
+    with shared.query() as query_memory:
+        query_memory.hold(60)
+        with pytest.raises(Exception, match="memory limit"):
+            query_memory.hold(60)
+        assert query_memory.peak == 60
+    assert shared.used() == 0
+
+def test_row_buffer_stays_in_memory_within_budget():
+    shared = pool()
+    with shared.query() as query_memory:
+        buffer = RowBuffer(query_memory)
+        buffer.extend(rows(10))
+        assert not buffer.spilled
+        assert list(buffer) == rows(10)
+        assert shared.used() == estimate_bytes(rows(10))
+    assert shared.used() == 0
+
+def test_row_buffer_spills_and_reads_back():
+    batch = rows(100)
+    shared = pool(work_mem=estimate_bytes(batch) + 1)
+    with shared.query() as query_memory:
+        buffer = RowBuffer(query_memory)
+        buffer.extend(batch)
+        buffer.extend(rows(100, 100))
+        assert buffer.spilled
+        assert len(buffer) == 200
+        assert buffer.tolist() == rows(200)
+        assert shared.used() == 0
+        assert shared.spilled() > 0
+    assert shared.spilled() == 0
+
+def test_spill_limit():
+    shared = pool(work_mem=0, spill_limit=100)
+    with shared.query() as query_memory:
+        with pytest.raises(Exception, match="spill limit"):
+            RowBuffer(query_memory).extend(rows(100))
+
+def test_partition_keeps_equal_keys_together():
+    shared = pool(work_mem=0, partitions=4)
+    chunks = [[{'k': i % 10, 'v': i} for i in range(100)], [{'k': None, 'v': -1}, {'k': None, 'v': -2}]]
+    with shared.query() as query_memory:
+        files = partition(chunks, ['k'], query_memory)
+        partitions = [[row for chunk in spill_file.chunks() for row in chunk] for spill_file in files]
+    assert len(partitions) == 4
+    assert sum(len(part) for part in partitions) == 102
+    for key in range(10):
+        assert len([part for part in partitions if any(row['k'] == key for row in part)]) == 1
+    assert [row['v'] for row in partitions[0] if row['k'] is None] == [-1, -2]
+
+def test_partition_without_keys_is_one_file():
+    shared = pool()
+    with shared.query() as query_memory:
+        files = partition([rows(5)], [], query_memory)
+        assert len(files) == 1
+        assert next(files[0].chunks()) == rows(5)
+
+def test_join_with_large_output_spills_instead_of_failing():
+    plan = JoinPlan(sqlglot.parse_one("SELECT a.product_name, COUNT(*) AS n FROM sales a JOIN sales b "
+                                      "ON a.product_name = b.product_name GROUP BY a.product_name", read='postgres'),
+                    {'sales': {'columns': ['sale_id', 'product_name']}})
+    # 100 rows over 2 products join into 5,000 rows, past both budgets.
+    shared = pool(work_mem=64 * 1024, memory_limit=100 * 1024, partitions=4)
+    with shared.query() as query_memory:
+        inputs = []
+        for qualifier in ('a', 'b'):
+            buffer = RowBuffer(query_memory)
+            buffer.extend([{f"{qualifier}.product_name": f"product {i % 2}"} for i in range(100)])
+            assert not buffer.spilled
+            inputs.append(buffer)
+        result = plan.project(plan.join(inputs, query_memory), query_memory)
+        assert query_memory.spilled_total > 0
+    assert sorted(result, key=lambda row: row['product_name']) == \
+        [{'product_name': f"product {i}", 'n': 2500} for i in range(2)]
+    assert shared.used() == 0
@@ -0,0 +1,52 @@
+import sqlglot
+
+from plan_cache import PlanCache, Shape, escape_percent, parameterize
+
+def test_shape_masks_literals():
+    shape = Shape("SELECT * FROM sales WHERE sale_amount > 100.5 AND product_name = 'It''s' AND sale_id = 7")
+    assert shape.text == "SELECT * FROM sales WHERE sale_amount > ? AND product_name = ? AND sale_id = ?"
+    assert shape.values == [100.5, "It's", 7]
+
+def test_shape_keeps_quoted_identifiers_and_names():
+    shape = Shape('SELECT "col 1", t2.x FROM t2 WHERE x = 1')
+    assert shape.text == 'SELECT "col 1", t2.x FROM t2 WHERE x = ?'
+    assert shape.values == [1]
+
+def test_same_shape_for_different_literals():
+    assert Shape("SELECT * FROM t WHERE a = 1").text == Shape("SELECT * FROM t WHERE a = 25").text
+
+def parameterized(sql, partition_keys=('region',)):
+    shape = Shape(sql)
+    parsed = sqlglot.parse_one(sql, read='postgres')
+    return parameterize(parsed, shape, partition_keys), parsed.sql(dialect='postgres')
+
+def test_parameterize_binds_where_literals():
+    positions, sql = parameterized("SELECT * FROM customers WHERE city = 'Delhi' AND customer_id > 5")
+    assert positions == [0, 1]
+    assert sql == "SELECT * FROM customers WHERE city = %(p0)s AND customer_id > %(p1)s"
+
+def test_parameterize_keeps_partition_key_and_limit():
+    positions, sql = parameterized("SELECT * FROM customers WHERE region = 'North' AND city = 'Delhi' LIMIT 3")
+    assert positions == [1]
+    assert "region = 'North'" in sql and "LIMIT 3" in sql
+
+def test_parameterize_skips_joins():
+    positions, _ = parameterized("SELECT * FROM a JOIN b ON a.id = b.id WHERE a.x = 1")
+    assert positions == []
+
+def test_escape_percent():
+    assert escape_percent("x LIKE 'a%' AND y = %(p0)s") == "x LIKE 'a%%' AND y = %(p0)s"
+
+def test_plan_cache_binds_new_literals():
+    cache = PlanCache(2)
+    cache.store(Shape("SELECT * FROM t WHERE a = 1 LIMIT 5"), [0], 'template')
+    assert cache.lookup(Shape("SELECT * FROM t WHERE a = 2 LIMIT 5")) == ('template', {'p0': 2})
+    # LIMIT is not a parameter, so it is part of the key.
+    assert cache.lookup(Shape("SELECT * FROM t WHERE a = 2 LIMIT 6")) is None
+
+def test_plan_cache_evicts_least_recently_used():
+    cache = PlanCache(1)
+    cache.store(Shape("SELECT a FROM t WHERE a = 1"), [0], 'first')
+    cache.store(Shape("SELECT b FROM t WHERE b = 1"), [0], 'second')
+    assert cache.lookup(Shape("SELECT a FROM t WHERE a = 1")) is None
+    assert cache.stats()['evictions'] == 1
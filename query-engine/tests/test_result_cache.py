@@ -0,0 +1,24 @@
+from result_cache import ResultCache
+
+def test_put_and_invalidate():
+    cache = ResultCache(1000)
+    cache.put('q', 'rows', 10, ('sales',), cache.snapshot(('sales',)))
+    assert cache.get('q') == 'rows'
+    cache.invalidate('sales')
+    assert cache.get('q') is None
+
+def test_write_in_flight_fences_the_result():
+    cache = ResultCache(1000)
+    snapshot = cache.snapshot(('sales',))
+    cache.invalidate('sales')
+    cache.put('q', 'rows', 10, ('sales',), snapshot)
+    assert cache.get('q') is None
+
+def test_clear_fences_tables_without_entries():
+    cache = ResultCache(1000)
+    snapshot = cache.snapshot(('customers',))
+    cache.clear()
+    cache.put('q', 'rows', 10, ('customers',), snapshot)
+    assert cache.get('q') is None
+    cache.put('q', 'rows', 10, ('customers',), cache.snapshot(('customers',)))
+    assert cache.get('q') == 'rows'
@@ -0,0 +1,104 @@
+import threading
+import time
+
+import pytest
+
+from scheduler import AdmissionController, Overloaded, WorkerSlots, classify, plan_cost
+
+def wait_until(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+def test_classify_and_cost():
+    assert classify([{'type': 'broadcast', 'nodes': ['a', 'b']}]) == 'interactive'
+    assert classify([{'type': 'fetch_for_join', 'nodes': ['a']}]) == 'analytical'
+    assert classify([{'type': 'ship_join', 'fallback': [{'type': 'master_hash_join'}]}]) == 'analytical'
+    assert plan_cost([{'type': 'broadcast', 'nodes': ['a', 'b']}, {'type': 'fetch_for_join', 'nodes': ['c']}]) == 3
+    assert plan_cost([]) == 1
+
+def test_class_limit_leaves_slots_to_other_classes():
+    admission = AdmissionController(2, {'analytical': 1}, queue_timeout=0.05)
+    admission.acquire('analytical', 'a')
+    with pytest.raises(Overloaded):
+        admission.acquire('analytical', 'b')
+    admission.acquire('interactive', 'b')
+    assert admission.running() == {('interactive',): 1, ('analytical',): 1}
+
+def test_full_queue_rejects():
+    admission = AdmissionController(1, max_queued=0)
+    admission.acquire('interactive', 'a')
+    with pytest.raises(Overloaded, match='queue is full'):
+        admission.acquire('interactive', 'a')
+
+def test_fair_order_between_clients():
+    admission = AdmissionController(1, queue_timeout=5)
+    admission.acquire('interactive', 'holder')
+    order = []
+
+    def run(name, client):
+        with admission.admitted('interactive', client):
+            order.append(name)
+
+    threads = []
+    for name, client in [('a1', 'a'), ('a2', 'a'), ('a3', 'a'), ('b1', 'b')]:
+        threads.append(threading.Thread(target=run, args=(name, client)))
+        threads[-1].start()
+        wait_until(lambda: admission.queued()[('interactive',)] == len(threads))
+    admission.release('interactive')
+    for thread in threads:
+        thread.join()
+    # Client b's first query is not stuck behind everything client a queued before it.
+    assert order.index('b1') < order.index('a3')
+    assert admission.running() == {('interactive',): 0, ('analytical',): 0}
+
+def test_weighted_classes():
+    admission = AdmissionController(1, weights={'interactive': 4, 'analytical': 1}, queue_timeout=5)
+    admission.acquire('interactive', 'holder')
+    order = []
+
+    def run(name, query_class):
+        with admission.admitted(query_class, 'client'):
+            order.append(name)
+
+    threads = []
+    for name, query_class in [('x1', 'analytical'), ('x2', 'analytical'), ('i1', 'interactive'), ('i2', 'interactive')]:
+        threads.append(threading.Thread(target=run, args=(name, query_class)))
+        threads[-1].start()
+        wait_until(lambda: sum(admission.queued().values()) == len(threads))
+    admission.release('interactive')
+    for thread in threads:
+        thread.join()
+    assert order.index('i2') < order.index('x2')
+
+def test_worker_slots_prefer_interactive():
+    slots = WorkerSlots(1, timeout=5)
+    slots.acquire('w')
+    assert not slots.try_acquire('w')
+    admission = AdmissionController(4)
+    order = []
+
+    def run(query_class):
+        with admission.admitted(query_class, 'client'):
+            slots.acquire('w')
+            order.append(query_class)
+            slots.release('w')
+
+    threads = []
+    for query_class in ('analytical', 'interactive'):
+        threads.append(threading.Thread(target=run, args=(query_class,)))
+        threads[-1].start()
+        wait_until(lambda: slots.queued()[('w',)] == len(threads))
+    slots.release('w')
+    for thread in threads:
+        thread.join()
+    assert order == ['interactive', 'analytical']
+    assert slots.in_flight() == {('w',): 0}
+
+def test_worker_slot_timeout():
+    slots = WorkerSlots(1, timeout=0.05)
+    slots.acquire('w')
+    with pytest.raises(Exception, match='503'):
+        slots.acquire('w')
+    assert slots.queued() == {('w',): 0}
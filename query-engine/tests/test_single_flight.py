@@ -0,0 +1,166 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from single_flight import SharedStreams, SingleFlight
+
+def run_threads(count, target):
+    threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+
+def test_single_flight_shares_one_call():
+    flight, calls, results = SingleFlight(), [], {}
+    release = threading.Event()
+
+    def work():
+        calls.append(1)
+        release.wait(5)
+        return 42
+
+    def caller(i):
+        results[i] = flight.do('q', work)
+    threads = [threading.Thread(target=caller, args=(i,)) for i in range(5)]
+    threads[0].start()
+    time.sleep(0.05)
+    for thread in threads[1:]:
+        thread.start()
+    time.sleep(0.05)
+    release.set()
+    for thread in threads:
+        thread.join(5)
+    assert len(calls) == 1
+    assert sorted(results.values()) == [(42, False)] + [(42, True)] * 4
+    # Nothing outlives the flight.
+    assert flight.do('q', lambda: 7) == (7, False)
+
+def test_single_flight_shares_errors():
+    flight, errors = SingleFlight(), []
+
+    def work():
+        time.sleep(0.05)
+        raise ValueError('boom')
+
+    def caller(i):
+        try:
+            flight.do('q', work)
+        except ValueError:
+            errors.append(i)
+    run_threads(4, caller)
+    assert sorted(errors) == [0, 1, 2, 3]
+
+def test_do_async_survives_a_cancelled_caller():
+    flight, calls = SingleFlight(), []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 42
+
+    async def caller(timeout):
+        try:
+            return await asyncio.wait_for(flight.do_async('q', work), timeout)
+        except TimeoutError:
+            return 'timeout'
+
+    async def main():
+        return await asyncio.gather(caller(0.01), caller(None), caller(None))
+    timed_out, *results = asyncio.run(main())
+    assert timed_out == 'timeout'
+    assert [result for result, _ in results] == [42, 42]
+    assert calls == [1]
+
+def counting_source(produced, count, fail_at=None, closed=None):
+    def source():
+        try:
+            for i in range(count):
+                time.sleep(0.001)
+                if i == fail_at:
+                    raise ValueError('boom')
+                produced.append(i)
+                yield [i]
+        finally:
+            if closed is not None:
+                closed.append(1)
+    return source
+
+def test_shared_stream_gives_every_reader_every_batch():
+    streams, produced, results = SharedStreams(8), [], {}
+
+    def reader(i):
+        time.sleep(0.001 * i)
+        results[i] = [batch[0] for batch in streams.open('k', counting_source(produced, 50))]
+    run_threads(6, reader)
+    assert results == {i: list(range(50)) for i in range(6)}
+    # Readers that came after the first batch was dropped started a stream of their own.
+    assert len(produced) % 50 == 0 and len(produced) < 6 * 50
+
+def test_last_reader_leaving_closes_the_source():
+    streams, closed = SharedStreams(8), []
+    reader = streams.open('k', counting_source([], 50, closed=closed))
+    assert next(reader) == [0]
+    reader.close()
+    assert closed == [1]
+    assert not streams._streams
+
+def test_shared_stream_errors_reach_every_reader():
+    streams, errors = SharedStreams(8), []
+
+    def reader(i):
+        try:
+            list(streams.open('k', counting_source([], 50, fail_at=5)))
+        except ValueError:
+            errors.append(i)
+    run_threads(4, reader)
+    assert sorted(errors) == [0, 1, 2, 3]
+
+def test_fast_reader_waits_for_slow_one():
+    streams, produced, fast = SharedStreams(4), [], []
+    slow, reader = streams.open('k', counting_source(produced, 60)), streams.open('k', lambda: None)
+    assert next(slow) == [0]
+    thread = threading.Thread(target=lambda: fast.extend(batch[0] for batch in reader))
+    thread.start()
+    time.sleep(0.1)
+    assert len(produced) <= 5
+    slow.close()
+    thread.join(5)
+    assert fast == list(range(60))
+
+def test_fast_async_reader_waits_for_slow_one():
+    streams, produced = SharedStreams(4), []
+
+    async def source():
+        for i in range(60):
+            await asyncio.sleep(0)
+            produced.append(i)
+            yield [i]
+
+    async def main():
+        slow, fast = streams.open_async('k', source), streams.open_async('k', source)
+        assert await slow.__anext__() == [0]
+        read = asyncio.ensure_future(drain(fast))
+        await asyncio.sleep(0.05)
+        assert len(produced) <= 5
+        await slow.aclose()
+        return await asyncio.wait_for(read, 5)
+    assert asyncio.run(main()) == list(range(60))
+
+async def drain(reader):
+    return [batch[0] async for batch in reader]
+
+@pytest.mark.parametrize('max_batches', [1, 3])
+def test_readers_at_different_speeds_are_complete(max_batches):
+    streams, results = SharedStreams(max_batches), {}
+
+    def reader(i):
+        batches = []
+        for batch in streams.open('k', counting_source([], 30)):
+            batches.append(batch[0])
+            time.sleep(0.002 * i)
+        results[i] = batches
+    run_threads(3, reader)
+    assert results == {i: list(range(30)) for i in range(3)}
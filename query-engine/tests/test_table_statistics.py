@@ -0,0 +1,49 @@
+import pytest
+import sqlglot
+
+from table_statistics import DEFAULT_EQ_SELECTIVITY, DEFAULT_RANGE_SELECTIVITY, selectivity
+
+STATS = {
+    'table': 'sales',
+    'rows': 1000,
+    'columns': {
+        'region': {'null_frac': 0.0, 'ndv': 4, 'mcv': ['North', 'South'], 'mcf': [0.5, 0.3], 'histogram': []},
+        'amount': {'null_frac': 0.1, 'ndv': 900, 'mcv': [], 'mcf': [], 'histogram': ['0', '100', '200', '300', '400']},
+    },
+}
+
+def estimate(where, qualifier='s'):
+    return selectivity(sqlglot.parse_one(f"SELECT * FROM sales AS s WHERE {where}", read='postgres').args['where'],
+                       STATS, qualifier)
+
+def test_equality_uses_most_common_values():
+    assert estimate("region = 'North'") == pytest.approx(0.5)
+    assert estimate("'South' = s.region") == pytest.approx(0.3)
+    # The other 20% of the rows spread over the two remaining values.
+    assert estimate("region = 'East'") == pytest.approx(0.1)
+    assert estimate("region <> 'North'") == pytest.approx(0.5)
+
+def test_in_list_adds_up():
+    assert estimate("region IN ('North', 'South')") == pytest.approx(0.8)
+
+def test_ranges_interpolate_the_histogram():
+    assert estimate("amount < 100") == pytest.approx(0.9 * 0.25)
+    assert estimate("amount >= 150") == pytest.approx(0.9 * 0.625)
+    assert estimate("amount BETWEEN 100 AND 300") == pytest.approx(0.9 * 0.5)
+    assert estimate("amount > 1000") == pytest.approx(0.0)
+
+def test_null_and_boolean_logic():
+    assert estimate("amount IS NULL") == pytest.approx(0.1)
+    assert estimate("NOT amount IS NULL") == pytest.approx(0.9)
+    assert estimate("region = 'North' AND amount < 100") == pytest.approx(0.5 * 0.225)
+    assert estimate("region = 'North' OR region = 'South'") == pytest.approx(0.5 + 0.3 - 0.15)
+
+def test_defaults_without_statistics():
+    assert estimate("other_column = 1") == DEFAULT_EQ_SELECTIVITY
+    assert estimate("other_column > 1") == DEFAULT_RANGE_SELECTIVITY
+    assert estimate("c.region = 'North'") == DEFAULT_EQ_SELECTIVITY
+    assert estimate("amount > region") == DEFAULT_RANGE_SELECTIVITY
+
+def test_unknown_values_use_distinct_count():
+    where = sqlglot.parse_one("SELECT * FROM sales WHERE amount = %(p0)s", read='postgres').args['where']
+    assert selectivity(where, STATS, 'sales') == pytest.approx(0.9 / 900)
@@ -0,0 +1,98 @@
+from decimal import Decimal
+
+import pytest
+import sqlglot
+from sqlglot import exp
+
+from expressions import compile_expression
+from vectorized import Batch, compile_aggregate, compile_vector, hash_join, sort_indices
+
+NAMES = ['a', 'b', 'c', 's']
+ROWS = [
+    {'a': 1, 'b': 2, 'c': Decimal('1.50'), 's': 'x'},
+    {'a': -7, 'b': 3, 'c': Decimal('-2.25'), 's': 'y'},
+    {'a': None, 'b': 4, 'c': None, 's': None},
+    {'a': 10, 'b': None, 'c': Decimal('0'), 's': 'x'},
+    {'a': 0, 'b': -5, 'c': Decimal('3'), 's': 'z'},
+]
+BIG = [
+    {'a': 2 ** 62, 'b': 2 ** 62, 'c': None, 's': None},
+    {'a': -2 ** 63, 'b': -1, 'c': None, 's': None},
+    {'a': 2 ** 63 - 1, 'b': 2, 'c': None, 's': None},
+]
+
+def resolve(column):
+    return column.name
+
+def parse(sql):
+    return sqlglot.parse_one(sql, read='postgres')
+
+def by_rows(sql, rows):
+    evaluate = compile_expression(parse(sql), resolve)
+    return [evaluate(row) for row in rows]
+
+def by_batch(sql, rows):
+    return compile_vector(parse(sql), resolve)(Batch.from_rows(rows, NAMES)).expand(len(rows)).tolist()
+
+@pytest.mark.parametrize('sql', [
+    'a + b', 'a - b', 'a * b', 'a / b', 'a % b', '-a', 'a + 1', 'c * 2', 'c + a', 'c / 2',
+    'a = b', 'a < b', 'a >= 0', 'c > 0', "s = 'x'", "s <> 'x'", 'a IS NULL', 'NOT a IS NULL',
+    'a > 0 AND b > 0', 'a > 0 OR b > 0', 'NOT a > 0', 'a IN (1, 10, NULL)', 'a BETWEEN -7 AND 1',
+])
+def test_matches_row_evaluator(sql):
+    assert by_batch(sql, ROWS) == by_rows(sql, ROWS)
+
+@pytest.mark.parametrize('sql', ['a + b', 'a - b', 'a * b', '-a', 'a / b', 'a % b'])
+def test_int64_overflow_matches_row_evaluator(sql):
+    assert by_batch(sql, BIG) == by_rows(sql, BIG)
+
+def test_int64_overflow_gives_exact_integers():
+    assert by_batch('a + b', BIG)[0] == 2 ** 63
+    assert by_batch('-a', BIG)[1] == 2 ** 63
+    assert by_batch('a * b', BIG)[2] == 2 ** 64 - 2
+
+def aggregate(sql, rows):
+    select = parse(sql)
+    partials = [(None, node.unalias(), None) for node in select.expressions]
+    return compile_aggregate(select.args['group'].expressions, partials, resolve)(Batch.from_rows(rows, NAMES))
+
+def test_aggregate_partials_per_group():
+    result = aggregate('SELECT COUNT(*), COUNT(a), SUM(a), MIN(c), MAX(b) FROM t GROUP BY s', ROWS)
+    assert result == {
+        ('x',): [2, 2, 11, Decimal('0'), 2],
+        ('y',): [1, 1, -7, Decimal('-2.25'), 3],
+        (None,): [1, 0, None, None, 4],
+        ('z',): [1, 1, 0, Decimal('3'), -5],
+    }
+
+def test_aggregate_filter():
+    assert aggregate('SELECT COUNT(*) FILTER (WHERE a > 0) FROM t GROUP BY s', ROWS)[('x',)] == [2]
+
+def test_sum_does_not_wrap_around():
+    rows = [dict(BIG[0], s='x'), dict(BIG[0], s='x')]
+    assert aggregate('SELECT SUM(a) FROM t GROUP BY s', rows) == {('x',): [2 ** 63]}
+
+def test_hash_join_matches_nested_loop():
+    left = Batch.from_rows([{'k': 1, 'l': 'a'}, {'k': 2, 'l': 'b'}, {'k': None, 'l': 'c'}, {'k': 2, 'l': 'd'}], ['k', 'l'])
+    right = Batch.from_rows([{'j': 2, 'r': 'x'}, {'j': 3, 'r': 'y'}, {'j': None, 'r': 'z'}], ['j', 'r'])
+    inner = hash_join(left, right, ['k'], ['j']).rows()
+    assert sorted((row['l'], row['r']) for row in inner) == [('b', 'x'), ('d', 'x')]
+    full = hash_join(left, right, ['k'], ['j'], how='FULL').rows()
+    assert sorted((row['l'] or '', row['r'] or '') for row in full) == \
+        [('', 'y'), ('', 'z'), ('a', ''), ('b', 'x'), ('c', ''), ('d', 'x')]
+
+def test_hash_join_composite_keys_and_condition():
+    left = Batch.from_rows([{'k': 1, 'm': 'a', 'v': 5}, {'k': 1, 'm': 'b', 'v': 1}], ['k', 'm', 'v'])
+    right = Batch.from_rows([{'j': 1, 'n': 'a', 'w': 3}, {'j': 1, 'n': 'b', 'w': 3}], ['j', 'n', 'w'])
+    condition = compile_vector(exp.GT(this=exp.column('v'), expression=exp.column('w')), resolve)
+    rows = hash_join(left, right, ['k', 'm'], ['j', 'n'], how='LEFT',
+                     condition=lambda batch: condition(batch).values.astype(bool)).rows()
+    assert sorted((row['m'], row['n']) for row in rows) == [('a', 'a'), ('b', None)]
+
+def test_sort_indices_matches_sorted():
+    batch = Batch.from_rows(ROWS, NAMES)
+    a, c = compile_vector(exp.column('a'), resolve), compile_vector(exp.column('c'), resolve)
+    assert sort_indices(batch, [(a, False, False)]).tolist() == [1, 4, 0, 3, 2]
+    assert sort_indices(batch, [(c, True, True)]).tolist() == [2, 4, 0, 3, 1]
+    s = compile_vector(exp.column('s'), resolve)
+    assert sort_indices(batch, [(s, False, True), (a, True, False)]).tolist() == [2, 3, 0, 1, 4]
@@ -1,10 +1,19 @@
 import grpc
+import io
 import os
 import psycopg2
 import json
+import threading
+import time
+import re
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 from concurrent import futures
+from psycopg2 import sql
 
-from protos import query_pb2, query_pb2_grpc
+from protos import columnar, query_pb2, query_pb2_grpc
+from protos.metrics import Counter, Gauge, Histogram, serve_metrics
 
 class AuthInterceptor(grpc.ServerInterceptor):
     def __init__(self, key):
@@ -19,70 +28,606 @@ class AuthInterceptor(grpc.ServerInterceptor):
                 context.abort(grpc.StatusCode.UNAUTHENTICATED, 'Invalid token')
             return grpc.unary_unary_rpc_method_handler(deny)
 
+WORKER_THREADS = int(os.getenv('WORKER_THREADS', '10'))
+DB_POOL_MIN = int(os.getenv('DB_POOL_MIN', '2'))
+DB_POOL_MAX = int(os.getenv('DB_POOL_MAX', str(WORKER_THREADS)))
+DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+DB_POOL_VALIDATE_AFTER = float(os.getenv('DB_POOL_VALIDATE_AFTER', '30'))
+WORKER_BATCH_ROWS = int(os.getenv('WORKER_BATCH_ROWS', '1000'))
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9100'))
+# Every connection prepares the sub-queries it has run WORKER_PREPARE_THRESHOLD times, keeping at most
+# WORKER_PREPARED_STATEMENTS of them (0 disables prepared statements).
+WORKER_PREPARED_STATEMENTS = int(os.getenv('WORKER_PREPARED_STATEMENTS', '256'))
+WORKER_PREPARE_THRESHOLD = int(os.getenv('WORKER_PREPARE_THRESHOLD', '2'))
+QUERY_ID_HEADER = 'x-query-id'
+
+# Statements that can be read through a server-side (DECLARE) cursor.
+ROW_RETURNING_STATEMENTS = ('SELECT', 'WITH', 'VALUES', 'TABLE')
+
+def encode_result(colnames, rows, result_format):
+    """Builds a PartialResult for `rows` in the format the master asked for."""
+    if result_format == query_pb2.COLUMNAR:
+        return query_pb2.PartialResult(columns=columnar.encode_rows(colnames, rows))
+    results = [dict(zip(colnames, row)) for row in rows]
+    return query_pb2.PartialResult(result_json=json.dumps(results, default=str))
+
+RPCS = Counter('dqps_worker_rpcs_total', "RPCs served, by method and outcome.", ('method', 'status'))
+RPC_SECONDS = Histogram('dqps_worker_rpc_seconds', "Time to serve an RPC.", ('method',))
+STAGE_SECONDS = Histogram('dqps_worker_stage_seconds',
+                          "RPC time by stage: queue (connection pool wait), db and encode.", ('method', 'stage'))
+ROWS = Counter('dqps_worker_rows_total', "Rows returned or loaded.", ('method',))
+STATEMENT_CACHE = Counter('dqps_worker_statement_cache_total',
+                          "Sub-queries by prepared-statement cache outcome (hit, miss or unprepared).", ('result',))
+STATEMENT_EVICTIONS = Counter('dqps_worker_statement_cache_evictions_total',
+                              "Prepared statements deallocated to make room for others.")
+
+class RpcTimer:
+    """Times the stages of one RPC for the trailing metadata and the metrics."""
+    HEADERS = {'queue': 'x-pool-wait-ms', 'db': 'x-db-ms', 'encode': 'x-encode-ms'}
+
+    def __init__(self, method, context):
+        self.method = method
+        self.context = context
+        metadata = dict(context.invocation_metadata() or ()) if context is not None else {}
+        self.query_id = metadata.get(QUERY_ID_HEADER, '-')
+        self.start = time.perf_counter()
+        self.stages = dict.fromkeys(self.HEADERS, 0.0)
+        self.rows = 0
+
+    @contextmanager
+    def stage(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] += time.perf_counter() - started
+
+    def finish(self, status):
+        if self.context is not None:
+            self.context.set_trailing_metadata(tuple(
+                (header, f"{self.stages[stage] * 1000:.3f}") for stage, header in self.HEADERS.items()))
+        RPCS.inc(method=self.method, status=status)
+        RPC_SECONDS.observe(time.perf_counter() - self.start, method=self.method)
+        ROWS.inc(self.rows, method=self.method)
+        for stage, seconds in self.stages.items():
+            STAGE_SECONDS.observe(seconds, method=self.method, stage=stage)
+
+class PoolTimeout(Exception):
+    pass
+
+class ConnectionPool:
+    """A bounded, thread-safe pool of database connections that validates idle ones before reuse."""
+    def __init__(self, connect, minconn=DB_POOL_MIN, maxconn=DB_POOL_MAX,
+                 timeout=DB_POOL_TIMEOUT, validate_after=DB_POOL_VALIDATE_AFTER):
+        self._connect = connect
+        self._maxconn = max(1, maxconn)
+        self._timeout = timeout
+        self._validate_after = validate_after
+        self._cond = threading.Condition()
+        self._idle = deque()
+        self._size = 0
+        self._in_use = 0
+        self._stats = {'acquired': 0, 'timeouts': 0, 'replaced': 0,
+                       'wait_total_s': 0.0, 'wait_max_s': 0.0}
+
+        for _ in range(min(minconn, self._maxconn)):
+            try:
+                self._idle.append((self._connect(), time.monotonic()))
+                self._size += 1
+            except Exception as e:
+                print(f"Failed to open pooled connection: {e}")
+                break
+
+    def _is_usable(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < self._validate_after:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def getconn(self):
+        start = time.monotonic()
+        deadline = start + self._timeout
+        while True:
+            with self._cond:
+                while not self._idle and self._size >= self._maxconn:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._stats['timeouts'] += 1
+                        raise PoolTimeout(f"Timed out after {self._timeout}s waiting for a database connection")
+                    self._cond.wait(remaining)
+                if self._idle:
+                    conn, idle_since = self._idle.pop()
+                else:
+                    conn, idle_since = None, None
+                    self._size += 1
+
+            if conn is None:
+                try:
+                    conn = self._connect()
+                except Exception:
+                    with self._cond:
+                        self._size -= 1
+                        self._cond.notify()
+                    raise
+            elif not self._is_usable(conn, idle_since):
+                self._discard(conn)
+                with self._cond:
+                    self._size -= 1
+                    self._stats['replaced'] += 1
+                continue
+            break
+
+        waited = time.monotonic() - start
+        with self._cond:
+            self._in_use += 1
+            self._stats['acquired'] += 1
+            self._stats['wait_total_s'] += waited
+            self._stats['wait_max_s'] = max(self._stats['wait_max_s'], waited)
+        return conn, waited
+
+    def putconn(self, conn, broken=False):
+        if not broken and not conn.closed:
+            try:
+                if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                broken = True
+        with self._cond:
+            self._in_use -= 1
+            if broken or conn.closed:
+                self._size -= 1
+                self._stats['replaced'] += 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+        if broken:
+            self._discard(conn)
+
+    @contextmanager
+    def connection(self):
+        conn, waited = self.getconn()
+        try:
+            yield conn, waited
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            self.putconn(conn, broken=True)
+            raise
+        except BaseException:
+            self.putconn(conn)
+            raise
+        else:
+            self.putconn(conn)
+
+    def stats(self):
+        with self._cond:
+            stats = dict(self._stats)
+            stats.update(size=self._size, idle=len(self._idle), in_use=self._in_use, max=self._maxconn)
+        stats['wait_avg_s'] = stats['wait_total_s'] / stats['acquired'] if stats['acquired'] else 0.0
+        return stats
+
+    def closeall(self):
+        with self._cond:
+            idle = list(self._idle)
+            self._idle.clear()
+            self._size -= len(idle)
+        for conn, _ in idle:
+            self._discard(conn)
+
+PREPARABLE_STATEMENTS = ('SELECT', 'WITH', 'VALUES', 'INSERT', 'UPDATE', 'DELETE')
+PLACEHOLDER = re.compile(r"%%|%\((\w+)\)s|%s")
+
+def positional(query, params):
+    """A psycopg2 query with $1, $2, ... placeholders, and the parameter keys in that order."""
+    if params is None:
+        return query, []
+    keys = []
+
+    def number(match):
+        if match.group(0) == '%%':
+            return '%'
+        key = match.group(1) if match.group(1) is not None else len(keys)
+        if key not in keys:
+            keys.append(key)
+        return f"${keys.index(key) + 1}"
+
+    return PLACEHOLDER.sub(number, query), keys
+
+def parameter_type(value):
+    """The declared type of a prepared statement's parameter with `value`, 'unknown' to infer it."""
+    if isinstance(value, bool):
+        return 'boolean'
+    if isinstance(value, int):
+        return 'bigint' if -2 ** 63 <= value < 2 ** 63 else 'numeric'
+    if isinstance(value, float):
+        return 'numeric'
+    return 'unknown'
+
+class PreparedStatements:
+    """The statements prepared on one connection, for sub-queries it has run `threshold` times."""
+    # Longer sub-queries are mostly one-off joins with shipped rows inlined.
+    MAX_QUERY_LENGTH = 16384
+
+    def __init__(self, conn, capacity=WORKER_PREPARED_STATEMENTS, threshold=WORKER_PREPARE_THRESHOLD):
+        self.conn = conn
+        self.capacity = capacity
+        self.threshold = max(threshold, 1)
+        # Keyed by (query, parameter types):
+        self._statements = OrderedDict()    # statement name and parameter keys
+        self._candidates = OrderedDict()    # runs so far, None when it cannot be prepared
+        self._rows = OrderedDict()          # most rows returned
+        self._next = 0
+
+    def statement(self, query, params, max_rows=None):
+        """The EXECUTE to run in place of `query` with the same `params`, or None."""
+        key = self._key(query, params)
+        if key in self._statements:
+            if max_rows is not None and self._rows.get(key, max_rows + 1) > max_rows:
+                STATEMENT_CACHE.inc(result='unprepared')
+                return None
+            self._statements.move_to_end(key)
+            STATEMENT_CACHE.inc(result='hit')
+            return self._execute(key, params)
+
+        text = query.rstrip().rstrip(';')
+        words = text.split(None, 1)
+        if not self.capacity or len(text) > self.MAX_QUERY_LENGTH or not words \
+                or words[0].upper() not in PREPARABLE_STATEMENTS or ';' in text:
+            STATEMENT_CACHE.inc(result='unprepared')
+            return None
+        runs = self._candidates.pop(key, 0)
+        if runs is not None:
+            runs += 1
+        if runs is None or runs < self.threshold or \
+                (max_rows is not None and self._rows.get(key, max_rows + 1) > max_rows):
+            self._candidates[key] = runs
+            if len(self._candidates) > self.capacity:
+                self._candidates.popitem(last=False)
+            STATEMENT_CACHE.inc(result='unprepared')
+            return None
+
+        body, keys = positional(text, params)
+        types = f" ({', '.join(parameter_type(params[param]) for param in keys)})" if keys else ''
+        name = f"dqps_stmt_{self._next}"
+        self._next += 1
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute(f"PREPARE {name}{types} AS {body}")
+        except psycopg2.Error as e:
+            # e.g. a parameter whose type PostgreSQL cannot infer.
+            print(f"Not preparing sub-query: {e}")
+            self._candidates[key] = None
+            STATEMENT_CACHE.inc(result='unprepared')
+            return None
+        self._statements[key] = (name, keys)
+        if len(self._statements) > self.capacity:
+            old_query, (old_name, _) = self._statements.popitem(last=False)
+            self._rows.pop(old_query, None)
+            self._deallocate(old_name)
+            STATEMENT_EVICTIONS.inc()
+        STATEMENT_CACHE.inc(result='miss')
+        return self._execute(key, params)
+
+    def _key(self, query, params):
+        # Parameters of other types make another statement, see parameter_type.
+        values = params.values() if isinstance(params, dict) else params or ()
+        return query, tuple(parameter_type(value) for value in values)
+
+    def _execute(self, key, params):
+        name, keys = self._statements[key]
+        if not keys:
+            return f"EXECUTE {name}"
+        if isinstance(params, dict):
+            return f"EXECUTE {name} ({', '.join(f'%({key})s' for key in keys)})"
+        return f"EXECUTE {name} ({', '.join('%s' for _ in keys)})"
+
+    def observe(self, query, params, rows):
+        """Records that `query` returned `rows` rows with `params`."""
+        key = self._key(query, params)
+        if key in self._statements or key in self._candidates:
+            self._rows[key] = max(self._rows.pop(key, 0), rows)
+            if len(self._rows) > 2 * self.capacity:
+                self._rows.popitem(last=False)
+
+    def forget(self, query, params):
+        """Drops the statement of `query`, after PostgreSQL could no longer execute it."""
+        name, _ = self._statements.pop(self._key(query, params))
+        self._deallocate(name)
+
+    def _deallocate(self, name):
+        try:
+            with self.conn.cursor() as cursor:
+                cursor.execute(f"DEALLOCATE {name}")
+        except psycopg2.Error:
+            pass
+
+class WorkerConnection(psycopg2.extensions.connection):
+    """A database connection with its own prepared statements."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.statements = PreparedStatements(self)
+
+# Errors of an EXECUTE that plain SQL would not hit: the statement's result type changed with the
+# table, or it was deallocated behind our back (e.g. DISCARD ALL by a connection pooler).
+STALE_STATEMENT_ERRORS = (psycopg2.errors.FeatureNotSupported, psycopg2.errors.InvalidSqlStatementName)
+
 class QueryServicer(query_pb2_grpc.QueryServiceServicer):
     """
     This class implements the gRPC service methods defined in query.proto.
     """
     def __init__(self):
         db_host = os.getenv('DATABASE_HOST', 'localhost')
-        
-        try:
-            self.db_conn = psycopg2.connect(
+
+        def connect():
+            conn = psycopg2.connect(
                 host=db_host,
                 database="distributed_db",
                 user="user",
-                password="password"
+                password="password",
+                connection_factory=WorkerConnection
             )
-            self.db_conn.autocommit = True
-            print(f"Worker connected to database at {db_host}")
-        except Exception as e:
-            print(f"Failed to connect to database: {e}")
+            conn.autocommit = True
+            return conn
+
+        self.pool = ConnectionPool(connect)
+        print(f"Worker connection pool for {db_host}: {self.pool.stats()}")
 
     def ExecuteSubQuery(self, request, context):
         """
         This method is called by the master. It executes the received SQL query.
         """
+        timer = RpcTimer('ExecuteSubQuery', context)
         query = request.query_sql
         params_json = request.params_json
-        print(f"Received query: {query}")
+        print(f"[{timer.query_id}] Received query: {query}")
         print(f"Params: {params_json}")
         
         try:
-            params = json.loads(params_json) if params_json else ()
+            params = json.loads(params_json) if params_json else None
 
-            cursor = self.db_conn.cursor()
-            cursor.execute(query, params)
-            
-            if cursor.description:
-                colnames = [desc[0] for desc in cursor.description]
+            with self.pool.connection() as (conn, waited):
+                timer.stages['queue'] = waited
+
+                cursor = conn.cursor()
+                with timer.stage('db'):
+                    self.execute(conn, cursor, query, params)
+                    rows = cursor.fetchall() if cursor.description else None
+                conn.statements.observe(query, params, len(rows) if rows is not None else 0)
                 
-                results = []
-                for row in cursor.fetchall():
-                    results.append(dict(zip(colnames, row)))
+                if rows is not None:
+                    colnames = [desc[0] for desc in cursor.description]
+                    timer.rows = len(rows)
+                    with timer.stage('encode'):
+                        result = encode_result(colnames, rows, request.format)
+                else:
+                    timer.rows = max(cursor.rowcount, 0)
+                    result_json = json.dumps([{"status": "success", "rows_affected": cursor.rowcount}])
+                    result = query_pb2.PartialResult(result_json=result_json)
                 
-                result_json = json.dumps(results, indent=2, default=str)
-            else:
-                result_json = json.dumps([{"status": "success", "rows_affected": cursor.rowcount}])
-            
-            cursor.close()
+                cursor.close()
             
-            return query_pb2.PartialResult(result_json=result_json)
+            timer.finish('ok')
+            return result
 
         except Exception as e:
-            print(f"An error occurred: {e}")
+            print(f"[{timer.query_id}] An error occurred: {e}")
+            timer.finish('error')
             return query_pb2.PartialResult(result_json=json.dumps({"error": str(e)}))
 
+    def execute(self, conn, cursor, query, params):
+        """Executes `query` on `cursor`, as a prepared statement once the connection has prepared it."""
+        prepared = conn.statements.statement(query, params)
+        if prepared:
+            try:
+                cursor.execute(prepared, params)
+                return
+            except STALE_STATEMENT_ERRORS:
+                conn.statements.forget(query, params)
+        cursor.execute(query, params)
+
+    def fetch_prepared(self, conn, query, params, batch_size, timer):
+        """(column names, rows) of a read known to fit one batch, run prepared; else None."""
+        prepared = conn.statements.statement(query, params, max_rows=batch_size)
+        if not prepared:
+            return None
+        with conn.cursor() as cursor:
+            try:
+                with timer.stage('db'):
+                    cursor.execute(prepared, params)
+                    rows = cursor.fetchall()
+            except STALE_STATEMENT_ERRORS:
+                conn.statements.forget(query, params)
+                return None
+            conn.statements.observe(query, params, len(rows))
+            return [desc[0] for desc in cursor.description], rows
+
+    def ExecuteSubQueryStream(self, request, context):
+        """Streaming variant of ExecuteSubQuery that sends reads back in batches of at most `batch_size` rows."""
+        query = request.query_sql
+        batch_size = request.batch_size or WORKER_BATCH_ROWS
+
+        words = query.split(None, 1)
+        if not words or words[0].upper() not in ROW_RETURNING_STATEMENTS:
+            yield self.ExecuteSubQuery(request, context)
+            return
+
+        timer = RpcTimer('ExecuteSubQueryStream', context)
+        print(f"[{timer.query_id}] Received streaming query: {query}")
+        print(f"Params: {request.params_json}")
+        status = 'cancelled'
+        try:
+            params = json.loads(request.params_json) if request.params_json else None
+
+            with self.pool.connection() as (conn, waited):
+                timer.stages['queue'] = waited
+
+                fetched = self.fetch_prepared(conn, query, params, batch_size, timer)
+                if fetched is not None:
+                    colnames, rows = fetched
+                    timer.rows = len(rows)
+                    for start in range(0, len(rows), batch_size):
+                        with timer.stage('encode'):
+                            result = encode_result(colnames, rows[start:start + batch_size], request.format)
+                        yield result
+                else:
+                    # Server-side cursors only live inside a transaction.
+                    conn.autocommit = False
+                    try:
+                        with conn.cursor(name=f"dqps_{uuid.uuid4().hex}") as cursor:
+                            cursor.itersize = batch_size
+                            with timer.stage('db'):
+                                cursor.execute(query, params)
+                            colnames = None
+                            while True:
+                                with timer.stage('db'):
+                                    rows = cursor.fetchmany(batch_size)
+                                if not rows:
+                                    break
+                                if colnames is None:
+                                    colnames = [desc[0] for desc in cursor.description]
+                                timer.rows += len(rows)
+                                with timer.stage('encode'):
+                                    result = encode_result(colnames, rows, request.format)
+                                yield result
+                    finally:
+                        try:
+                            conn.commit()
+                        finally:
+                            conn.autocommit = True
+                    conn.statements.observe(query, params, timer.rows)
+            status = 'ok'
+
+        except Exception as e:
+            print(f"[{timer.query_id}] An error occurred: {e}")
+            status = 'error'
+            yield query_pb2.PartialResult(result_json=json.dumps({"error": str(e)}))
+        finally:
+            timer.finish(status)
+
+    def BulkInsert(self, request, context):
+        """Loads a batch of CSV rows routed to this partition with COPY FROM STDIN, in one transaction."""
+        timer = RpcTimer('BulkInsert', context)
+        print(f"[{timer.query_id}] Received bulk insert into {request.table}: {len(request.csv_data)} bytes")
+        try:
+            statement = sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+                sql.Identifier(request.table), sql.SQL(', ').join(map(sql.Identifier, request.columns)))
+
+            with self.pool.connection() as (conn, waited):
+                timer.stages['queue'] = waited
+
+                conn.autocommit = False
+                try:
+                    with timer.stage('db'), conn.cursor() as cursor:
+                        cursor.copy_expert(statement.as_string(conn), io.BytesIO(request.csv_data))
+                        rows_affected = cursor.rowcount
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+                finally:
+                    conn.autocommit = True
+
+            timer.rows = rows_affected
+            timer.finish('ok')
+            return query_pb2.PartialResult(result_json=json.dumps([{"status": "success", "rows_affected": rows_affected}]))
+
+        except Exception as e:
+            print(f"[{timer.query_id}] An error occurred: {e}")
+            timer.finish('error')
+            return query_pb2.PartialResult(result_json=json.dumps({"error": str(e)}))
+
+    def CollectStatistics(self, request, context):
+        """Reports the planner statistics PostgreSQL keeps for the requested tables."""
+        timer = RpcTimer('CollectStatistics', context)
+        print(f"[{timer.query_id}] Received statistics request for: {', '.join(request.tables)}")
+        try:
+            tables = {}
+            with self.pool.connection() as (conn, waited):
+                timer.stages['queue'] = waited
+
+                with timer.stage('db'), conn.cursor() as cursor:
+                    relations = """
+                        SELECT c.relname, c.reltuples, pg_total_relation_size(c.oid)
+                        FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+                        WHERE n.nspname = current_schema() AND c.relkind IN ('r', 'p') AND c.relname = ANY(%s)
+                    """
+                    cursor.execute(relations, (list(request.tables),))
+                    found = cursor.fetchall()
+                    unanalyzed = [name for name, reltuples, _ in found if reltuples < 0]
+                    for name in unanalyzed:
+                        cursor.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(name)))
+                    if unanalyzed:
+                        cursor.execute(relations, (list(request.tables),))
+                        found = cursor.fetchall()
+                    for name, reltuples, size in found:
+                        tables[name] = {"table": name, "rows": max(reltuples, 0), "bytes": size, "columns": {}}
+
+                    cursor.execute("""
+                        SELECT tablename, attname, null_frac, n_distinct, most_common_vals::text::text[],
+                               most_common_freqs, histogram_bounds::text::text[]
+                        FROM pg_stats
+                        WHERE schemaname = current_schema() AND tablename = ANY(%s)
+                        ORDER BY inherited
+                    """, (list(tables),))
+                    for name, column, null_frac, n_distinct, mcv, mcf, histogram in cursor.fetchall():
+                        rows = tables[name]["rows"]
+                        # A negative n_distinct is minus the fraction of rows that are distinct.
+                        ndv = -n_distinct * rows if n_distinct < 0 else n_distinct
+                        tables[name]["columns"][column] = {
+                            "null_frac": null_frac, "ndv": ndv,
+                            "mcv": mcv or [], "mcf": mcf or [], "histogram": histogram or [],
+                        }
+
+            timer.rows = len(tables)
+            timer.finish('ok')
+            return query_pb2.PartialResult(result_json=json.dumps(list(tables.values())))
+
+        except Exception as e:
+            print(f"[{timer.query_id}] An error occurred: {e}")
+            timer.finish('error')
+            return query_pb2.PartialResult(result_json=json.dumps({"error": str(e)}))
+
+def register_pool_metrics(pool):
+    Gauge('dqps_worker_pool_connections', "Database connections in the pool, by state.",
+          lambda: {(state,): pool.stats()[state] for state in ('idle', 'in_use')}, ('state',))
+    Gauge('dqps_worker_pool_max_connections', "Size limit of the connection pool.", lambda: pool.stats()['max'])
+    Gauge('dqps_worker_pool_timeouts_total', "Requests that timed out waiting for a connection.",
+          lambda: pool.stats()['timeouts'], type='counter')
+    Gauge('dqps_worker_pool_replaced_total', "Broken or stale connections replaced.",
+          lambda: pool.stats()['replaced'], type='counter')
+
 def serve():
     """
     Starts the gRPC server and listens for incoming requests.
     """
     auth_interceptor = AuthInterceptor('super-secret-token')
     server = grpc.server(
-        futures.ThreadPoolExecutor(max_workers=10),
-        interceptors=(auth_interceptor,)
+        futures.ThreadPoolExecutor(max_workers=WORKER_THREADS),
+        interceptors=(auth_interceptor,),
+        options=[
+            # Accept the master's keepalive pings on idle pooled channels.
+            ('grpc.keepalive_permit_without_calls', 1),
+            ('grpc.http2.min_ping_interval_without_data_ms', 10000),
+            ('grpc.http2.max_ping_strikes', 0),
+        ]
     )
     
-    query_pb2_grpc.add_QueryServiceServicer_to_server(QueryServicer(), server)
+    servicer = QueryServicer()
+    query_pb2_grpc.add_QueryServiceServicer_to_server(servicer, server)
+    register_pool_metrics(servicer.pool)
+    if METRICS_PORT:
+        serve_metrics(METRICS_PORT)
+        print(f"Worker metrics served on port {METRICS_PORT} at /metrics")
     
     server.add_insecure_port('[::]:50051')
     